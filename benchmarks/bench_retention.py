@@ -0,0 +1,45 @@
+"""
+Time the retention planner on a large synthetic backup set.
+
+    python benchmarks/bench_retention.py [number of backups]
+
+Not part of the test suite.
+"""
+import sys
+import time
+from datetime import datetime, timedelta
+
+from django_backup.retention import RetentionPlan
+from django_backup.utils import TIME_FORMAT
+
+
+POLICY = {
+    'hourly': 48,
+    'daily': 30,
+    'weekly': 12,
+    'monthly': 24,
+    'yearly': 10,
+}
+
+
+def synthetic_backups(count, now=None):
+    """
+    One backup per hour going back from ``now``.
+    """
+    now = now or datetime.now()
+    return sorted(
+        'backup_%s.sql.gz' % (now - timedelta(hours=i)).strftime(TIME_FORMAT)
+        for i in range(count)
+    )
+
+
+def main(count=100000):
+    backups = synthetic_backups(count)
+    start = time.time()
+    plan = RetentionPlan(backups, POLICY)
+    elapsed = time.time() - start
+    print('%d backups: keep %d, remove %d in %.3fs' % (len(backups), len(plan.keep), len(plan.remove), elapsed))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,54 @@
+"""
+Compare two benchmark reports written by ``py.test benchmarks``.
+
+Usage: python benchmarks/compare.py old.json new.json
+"""
+import json
+import sys
+
+
+def load(path):
+    with open(path) as report_file:
+        report = json.load(report_file)
+    results = dict(
+        ((result['case'], result['size'], result['run'], result['stage']), result) for result in report['results']
+    )
+    runs = dict(((run['case'], run['size'], run['run']), run) for run in report['runs'])
+    return report, results, runs
+
+
+def change(old, new):
+    if not old or new is None:
+        return '      -'
+    return '%+6.1f%%' % ((new - old) * 100.0 / old)
+
+
+def main(old_path, new_path):
+    old_report, old, old_runs = load(old_path)
+    new_report, new, new_runs = load(new_path)
+    print('%s (%s) -> %s (%s)' % (old_report['version'], old_report['time'], new_report['version'], new_report['time']))
+    print('%-8s %8s %-36s %-16s %10s %8s' % ('case', 'size', 'run', 'stage', 'MB/s', 'time'))
+    for key in sorted(new):
+        result = new[key]
+        previous = old.get(key, {})
+        print('%-8s %8s %-36s %-16s %10s %8s' % (
+            key[0], key[1], key[2], key[3], result['mb_per_s'],
+            change(previous.get('seconds'), result['seconds']),
+        ))
+    print('')
+    print('%-8s %8s %-36s %8s %9s %10s' % ('case', 'size', 'run', 'time', 'peak rss', 'peak disk'))
+    for key in sorted(new_runs):
+        run = new_runs[key]
+        previous = old_runs.get(key, {})
+        print('%-8s %8s %-36s %8s %9s %10s' % (
+            key[0], key[1], key[2],
+            change(previous.get('seconds'), run['seconds']),
+            change(previous.get('peak_rss'), run['peak_rss']),
+            change(previous.get('peak_temp_disk'), run['peak_temp_disk']),
+        ))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit(__doc__.strip())
+    main(*sys.argv[1:])
@@ -0,0 +1,74 @@
+import os
+
+import pytest
+from django.conf import settings as django_settings
+
+from harness import LocalSFTPServer, Report
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('benchmarks')
+    group.addoption(
+        '--benchmark-output', dest='benchmark_output', default='benchmark.json',
+        help='File the JSON report of the run is written to'
+    )
+    group.addoption(
+        '--benchmark-sizes', dest='benchmark_sizes', default='1000,10000',
+        help='Comma separated numbers of database rows to benchmark with'
+    )
+    group.addoption(
+        '--benchmark-media-files', dest='benchmark_media_files', default='100,1000',
+        help='Comma separated numbers of 64KB media files to benchmark with'
+    )
+
+
+def _sizes(value):
+    return [int(size) for size in value.split(',') if size.strip()]
+
+
+def pytest_generate_tests(metafunc):
+    if 'rows' in metafunc.fixturenames:
+        metafunc.parametrize('rows', _sizes(metafunc.config.option.benchmark_sizes))
+    if 'media_files' in metafunc.fixturenames:
+        metafunc.parametrize('media_files', _sizes(metafunc.config.option.benchmark_media_files))
+
+
+@pytest.fixture(scope='session')
+def report(request, tmpdir_factory):
+    run_reports = str(tmpdir_factory.mktemp('reports').join('%(command)s.json'))
+    report = Report(django_settings.DATABASES['default']['ENGINE'], run_reports)
+
+    def write():
+        report.write(request.config.option.benchmark_output)
+    request.addfinalizer(write)
+    return report
+
+
+@pytest.fixture(scope='session')
+def local_sftpserver(request):
+    server = LocalSFTPServer()
+    request.addfinalizer(server.close)
+    return server
+
+
+@pytest.fixture
+def remote(tmpdir, settings, local_sftpserver, report, monkeypatch):
+    """
+    Configure backups to go to the local directory, the remote one on the
+    local SFTP server, temporary files to a directory of their own and run
+    reports to where ``report`` reads them. Returns the local, remote and
+    temporary directories.
+    """
+    local = tmpdir.mkdir('local')
+    remote = tmpdir.mkdir('remote')
+    temp = tmpdir.mkdir('temp')
+    settings.BACKUP_LOCAL_DIRECTORY = str(local)
+    settings.BACKUP_FTP_SERVER = '{}:{}'.format(local_sftpserver.host, local_sftpserver.port)
+    settings.BACKUP_FTP_USERNAME = 'username'
+    settings.BACKUP_FTP_PASSWORD = 'password'
+    settings.BACKUP_FTP_DIRECTORY = str(remote)
+    settings.RESTORE_FROM_FTP_DIRECTORY = str(remote)
+    settings.BACKUP_REPORT_FILE = report.run_reports
+    monkeypatch.setattr('tempfile.tempdir', str(temp))
+    monkeypatch.setenv('TMPDIR', str(temp))
+    return str(local), str(remote), str(temp)
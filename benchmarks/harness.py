@@ -0,0 +1,292 @@
+"""
+Helpers of the benchmark suite: a local SFTP server, synthetic data and the
+measurement of a command.
+"""
+import json
+import os
+import platform
+import random
+import resource
+import socket
+import string
+import threading
+import time
+from contextlib import contextmanager
+
+import django
+import paramiko
+from paramiko import (
+    AUTH_SUCCESSFUL, OPEN_SUCCEEDED, SFTP_OK, SFTPAttributes, SFTPHandle, SFTPServer, SFTPServerInterface,
+    ServerInterface,
+)
+
+import django_backup
+
+
+SAMPLE_INTERVAL = 0.05
+
+
+# Local SFTP server
+#
+# pytest-sftpserver keeps files in memory and can't write past the first
+# packet of a file, so the benchmarks use this server serving the local
+# filesystem instead.
+
+def _errno(function):
+    def wrapper(*args):
+        try:
+            result = function(*args)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK if result is None else result
+    return wrapper
+
+
+class _Handle(SFTPHandle):
+
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+
+class _Filesystem(SFTPServerInterface):
+
+    @_errno
+    def list_folder(self, path):
+        return [SFTPAttributes.from_stat(os.lstat(os.path.join(path, name)), name) for name in os.listdir(path)]
+
+    @_errno
+    def stat(self, path):
+        return SFTPAttributes.from_stat(os.stat(path))
+
+    @_errno
+    def lstat(self, path):
+        return SFTPAttributes.from_stat(os.lstat(path))
+
+    @_errno
+    def open(self, path, flags, attr):
+        fd = os.open(path, flags, 0o666)
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = _Handle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    @_errno
+    def remove(self, path):
+        os.remove(path)
+
+    @_errno
+    def rename(self, oldpath, newpath):
+        os.rename(oldpath, newpath)
+
+    @_errno
+    def mkdir(self, path, attr):
+        os.mkdir(path)
+
+    @_errno
+    def rmdir(self, path):
+        os.rmdir(path)
+
+    @_errno
+    def symlink(self, target_path, path):
+        os.symlink(target_path, path)
+
+    def canonicalize(self, path):
+        return os.path.normpath(os.path.join('/', path))
+
+
+class _Server(ServerInterface):
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        return AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return OPEN_SUCCEEDED
+
+
+class LocalSFTPServer(object):
+    """
+    SFTP server on 127.0.0.1 serving the local filesystem, accepting any
+    password.
+    """
+
+    def __init__(self):
+        self.key = paramiko.RSAKey.generate(2048)
+        self.socket = socket.socket()
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.listen(16)
+        self.host, self.port = self.socket.getsockname()
+        self.transports = []
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                client, address = self.socket.accept()
+            except socket.error:
+                return
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.key)
+            transport.set_subsystem_handler('sftp', SFTPServer, _Filesystem)
+            transport.start_server(server=_Server())
+            self.transports.append(transport)
+
+    def close(self):
+        self.socket.close()
+        for transport in self.transports:
+            transport.close()
+
+
+# Synthetic data
+
+def random_text(length, rng):
+    return ''.join(rng.choice(string.ascii_letters + ' ') for _ in range(length))
+
+
+def make_media_tree(directory, files, file_size, seed=0):
+    """
+    Write ``files`` files of ``file_size`` bytes into ``directory``, spread
+    over subdirectories. Half of every file is random, half repeats, so it
+    compresses about as well as typical uploads.
+    """
+    rng = random.Random(seed)
+    for i in range(files):
+        subdirectory = os.path.join(directory, 'dir%03d' % (i // 100))
+        if not os.path.isdir(subdirectory):
+            os.makedirs(subdirectory)
+        half = file_size // 2
+        data = os.urandom(half) + random_text(64, rng).encode('ascii') * ((file_size - half) // 64 + 1)
+        with open(os.path.join(subdirectory, 'file%05d.bin' % i), 'wb') as file_:
+            file_.write(data[:file_size])
+
+
+# Measurement
+
+def current_rss():
+    """
+    Resident set size of this process in bytes.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError):
+        # ru_maxrss is the peak so far, in kilobytes on Linux and bytes on OS X.
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if platform.system() == 'Darwin' else maxrss * 1024
+
+
+def disk_usage(directories):
+    total = 0
+    for directory in directories:
+        for root, dirs, files in os.walk(directory):
+            for name in files:
+                try:
+                    total += os.lstat(os.path.join(root, name)).st_size
+                except OSError:
+                    pass
+    return total
+
+
+class Sampler(threading.Thread):
+    """
+    Keeps the peak RSS and the peak disk usage of ``directories`` while it
+    runs.
+    """
+
+    def __init__(self, directories):
+        super(Sampler, self).__init__()
+        self.daemon = True
+        self.directories = directories
+        self.peak_rss = 0
+        self.peak_disk = 0
+        self.stopped = threading.Event()
+
+    def sample(self):
+        self.peak_rss = max(self.peak_rss, current_rss())
+        self.peak_disk = max(self.peak_disk, disk_usage(self.directories))
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.sample()
+            self.stopped.wait(SAMPLE_INTERVAL)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.sample()
+
+
+class Report(object):
+    """
+    Results of a benchmark run, written as JSON so that runs of different
+    versions can be compared with ``compare.py``. The commands write their
+    run reports to ``run_reports``, the BACKUP_REPORT_FILE of the benchmarks.
+    """
+
+    def __init__(self, engine, run_reports):
+        self.engine = engine
+        self.run_reports = run_reports
+        self.results = []
+        self.runs = []
+
+    @contextmanager
+    def measure(self, case, size, run, directories=()):
+        """
+        Measure the command ``run`` in the ``with`` block, which writes
+        temporary files into ``directories``. Every stage of its run report
+        becomes a result. The peak RSS and disk usage, sampled over the whole
+        run, go into ``runs``.
+        """
+        path = self.run_reports % {'command': run.split()[0]}
+        if os.path.exists(path):
+            os.remove(path)
+        sampler = Sampler(directories)
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+        with open(path) as run_report:
+            run_report = json.load(run_report)
+        self.runs.append({
+            'case': case,
+            'size': size,
+            'run': run,
+            'seconds': round(run_report['seconds'], 4),
+            'peak_rss': sampler.peak_rss,
+            'peak_temp_disk': sampler.peak_disk,
+        })
+        for stage in run_report['stages']:
+            self.results.append({
+                'case': case,
+                'size': size,
+                'run': run,
+                'stage': stage['name'],
+                'seconds': round(stage['seconds'], 4),
+                'bytes_in': stage['bytes_in'],
+                'bytes_out': stage['bytes_out'],
+                'mb_per_s': round(stage['throughput'] / 1e6, 3) if stage['throughput'] else None,
+            })
+
+    def write(self, path):
+        with open(path, 'w') as report_file:
+            json.dump({
+                'version': django_backup.__version__,
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'engine': self.engine,
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'results': self.results,
+                'runs': self.runs,
+            }, report_file, indent=2, sort_keys=True)
@@ -0,0 +1,74 @@
+"""
+Throughput of the backup and restore commands.
+
+Every case runs the complete command against a database of ``rows`` users or
+a media tree of ``media_files`` files, with the remote side on a local SFTP
+server, and records the time and MB/s of every stage of its run report, and
+the peak RSS and peak size of local backups and temporary files of the run.
+Run with::
+
+    py.test benchmarks --benchmark-output=results.json
+
+and compare two runs with ``python benchmarks/compare.py old.json new.json``.
+"""
+import os
+import random
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+
+from harness import make_media_tree, random_text
+
+
+def fill_database(rows):
+    rng = random.Random(rows)
+    User.objects.bulk_create(
+        User(
+            username='user%08d' % i,
+            first_name=random_text(20, rng),
+            last_name=random_text(20, rng),
+            email='user%08d@example.com' % i,
+            password=random_text(80, rng),
+        )
+        for i in range(rows)
+    )
+
+
+def clear(directory):
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+
+
+def test_database(transactional_db, remote, report, rows):
+    local, remote_dir, temp = remote
+    fill_database(rows)
+    watched = [local, temp]
+
+    with report.measure('database', rows, 'backup', watched):
+        call_command('backup')
+    with report.measure('database', rows, 'backup --compress', watched):
+        call_command('backup', compress=True)
+    with report.measure('database', rows, 'backup --compress --ftp', watched):
+        call_command('backup', compress=True, ftp=True, delete_local=True)
+    # Backups made within the same second have the same name.
+    clear(remote_dir)
+    with report.measure('database', rows, 'backup --compress --ftp --stream', watched):
+        call_command('backup', compress=True, ftp=True, stream=True, no_local=True)
+
+    with report.measure('database', rows, 'restore', watched):
+        call_command('restore')
+    with report.measure('database', rows, 'restore --stream', watched):
+        call_command('restore', stream=True)
+
+
+def test_media(transactional_db, remote, report, settings, tmpdir, media_files):
+    local, remote_dir, temp = remote
+    media = tmpdir.mkdir('media')
+    settings.DIRECTORY_TO_BACKUP = str(media)
+    make_media_tree(str(media), media_files, 64 * 1024)
+    watched = [local, temp]
+
+    with report.measure('media', media_files, 'backup --media --ftp', watched):
+        call_command('backup', media=True, ftp=True, delete_local=True)
+    with report.measure('media', media_files, 'restore --media', watched):
+        call_command('restore', media=True, no_database=True)
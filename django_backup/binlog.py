@@ -0,0 +1,108 @@
+"""
+Shipping MySQL binary logs between full backups.
+
+With BACKUP_MYSQL_BINLOGS full MySQL backups record the binary log position
+they were taken at. ``backup --logs`` then rotates the binary log and ships
+the complete logs written since the previous shipment in a
+backup_<timestamp>.binlog.tar, much cheaper than another full dump. Restore
+loads the latest full backup and replays the logs shipped after it, from its
+position on, or with ``--until`` only up to a point in time.
+
+Which log comes next is kept in a small local state file, committed once a
+shipment is stored. Without one every log the server still has is shipped;
+restore skips what predates the full backup.
+"""
+import json
+import re
+from datetime import datetime
+
+from django_backup.utils import get_date, is_log_backup
+
+
+STATE_NAME = '.binlog_state.json'
+POSITION_HEAD_SIZE = 64 * 1024
+POSITION_REGEX = re.compile(
+    br"^-- CHANGE (?:MASTER|REPLICATION SOURCE) TO (?:MASTER|SOURCE)_LOG_FILE='(?P<file>[^']+)',"
+    br" (?:MASTER|SOURCE)_LOG_POS=(?P<pos>\d+);", re.M,
+)
+
+
+def read_position(filename):
+    """
+    Return the binary log file and position a mysqldump --master-data=2 dump
+    was taken at, from the comment at its top. None if it has none.
+    """
+    with open(filename, 'rb') as dump:
+        match = POSITION_REGEX.search(dump.read(POSITION_HEAD_SIZE))
+    if match is None:
+        return None
+    return match.group('file').decode('utf-8'), int(match.group('pos'))
+
+
+def get_log_chain(backups, until=None):
+    """
+    Given the names of the backups of a database, return the backups to
+    restore in order: the latest full backup, taken before the datetime
+    ``until`` if given, and the binary log backups after it, up to the first
+    one shipped after ``until``. Empty when there's no such full backup.
+    """
+    chain = []
+    for backup in sorted(backups, key=get_date):
+        if is_log_backup(backup):
+            if chain:
+                chain.append(backup)
+        elif until is None or get_date(backup) <= until:
+            chain = [backup]
+        if chain and until is not None and get_date(chain[-1]) >= until:
+            break
+    return chain
+
+
+def check_sequence(logs, position):
+    """
+    Raise ValueError unless the binary log file names ``logs`` start with
+    the file of ``position`` and none is missing in between.
+    """
+    if not logs or logs[0] != position[0]:
+        raise ValueError('The binary log %s of the full backup has not been shipped' % position[0])
+    for previous, log in zip(logs, logs[1:]):
+        if int(log.rsplit('.', 1)[1]) != int(previous.rsplit('.', 1)[1]) + 1:
+            raise ValueError('Binary logs between %s and %s are missing' % (previous, log))
+
+
+def format_until(until):
+    """
+    ``until`` as mysqlbinlog's --stop-datetime wants it.
+    """
+    return datetime.strftime(until, '%Y-%m-%d %H:%M:%S')
+
+
+class LogState(object):
+    """
+    The next binary log to ship for every database alias, kept in the JSON
+    file ``path``. Shipments only stick once ``commit`` is called, which
+    should happen after they have safely been stored.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pending = {}
+        try:
+            with open(path) as state_file:
+                self.next_logs = json.load(state_file)
+        except (IOError, OSError):
+            self.next_logs = {}
+
+    def get(self, alias):
+        return self.next_logs.get(alias)
+
+    def ship(self, alias, next_log):
+        self.pending[alias] = next_log
+
+    def commit(self):
+        if not self.pending:
+            return
+        self.next_logs.update(self.pending)
+        self.pending = {}
+        with open(self.path, 'w') as state_file:
+            json.dump(self.next_logs, state_file, indent=2, sort_keys=True)
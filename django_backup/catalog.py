@@ -0,0 +1,104 @@
+"""
+Remote backup catalog.
+
+Listing a remote directory holding thousands of backups is slow, so the
+backup command can keep a catalog of its artifacts next to them: an
+append-only file of JSON lines, each recording an artifact that was added
+(name, type, timestamp, size and SHA-256) or removed. Restore and cleanup read
+the catalog instead of listing the directory. If it's lost, the
+``rebuild_catalog`` command recreates it from a listing.
+"""
+import json
+import posixpath
+
+from django_backup.transfer import partial_name
+
+
+CATALOG_NAME = '.backup_catalog.jsonl'
+
+
+class Catalog(object):
+    """
+    The catalog of the backups in ``remote_dir`` on the server ``sftp`` is
+    connected to.
+    """
+
+    def __init__(self, sftp, remote_dir):
+        self.sftp = sftp
+        self.remote_dir = remote_dir or ''
+        self.path = posixpath.join(self.remote_dir, CATALOG_NAME)
+
+    def read(self):
+        """
+        Return the entries of the backups currently in the catalog, sorted by
+        name, or None if there's no catalog.
+        """
+        try:
+            remote_file = self.sftp.open(self.path, 'rb')
+        except IOError:
+            return None
+        with remote_file:
+            remote_file.prefetch()
+            lines = remote_file.read().decode('utf-8').splitlines()
+        entries = {}
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line cut short by an interrupted append.
+                continue
+            if record.get('op') == 'remove':
+                entries.pop(record['name'], None)
+            else:
+                entries[record['name']] = record
+        return [entries[name] for name in sorted(entries)]
+
+    def names(self):
+        entries = self.read()
+        return None if entries is None else [entry['name'] for entry in entries]
+
+    def _append(self, records):
+        if not records:
+            return
+        # Starting with a newline ends a line cut short by an interrupted
+        # append. One write per batch, so that concurrent appends don't
+        # interleave lines.
+        data = '\n' + ''.join(json.dumps(record, sort_keys=True) + '\n' for record in records)
+        with self.sftp.open(self.path, 'a') as remote_file:
+            remote_file.write(data.encode('utf-8'))
+
+    def add(self, entries):
+        """
+        Record the backups described by ``entries``, dicts as returned by
+        ``make_entry``.
+        """
+        self._append([dict(entry, op='add') for entry in entries])
+
+    def remove(self, names):
+        self._append([{'op': 'remove', 'name': name} for name in names])
+
+    def rewrite(self, entries):
+        """
+        Replace the whole catalog by ``entries``.
+        """
+        partial_path = posixpath.join(self.remote_dir, partial_name(CATALOG_NAME))
+        data = ''.join(json.dumps(dict(entry, op='add'), sort_keys=True) + '\n' for entry in entries)
+        with self.sftp.open(partial_path, 'wb') as remote_file:
+            remote_file.write(data.encode('utf-8'))
+        try:
+            self.sftp.remove(self.path)
+        except IOError:
+            pass
+        self.sftp.rename(partial_path, self.path)
+
+
+def make_entry(name, type, timestamp, size=None, sha256=None):
+    return {
+        'name': name,
+        'type': type,
+        'timestamp': timestamp,
+        'size': size,
+        'sha256': sha256,
+    }
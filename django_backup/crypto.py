@@ -0,0 +1,195 @@
+"""
+Streaming authenticated encryption of backups.
+
+The data is split into chunks which are encrypted independently with
+AES-256-GCM, on a pool of threads, so encryption keeps up with compression and
+decryption can start as soon as the first chunk arrives. The key is derived
+from BACKUP_PASSWORD with PBKDF2 and a random salt stored in the header.
+
+Layout of an encrypted file::
+
+    header: MAGIC, salt (16 bytes), PBKDF2 iterations and chunk size (4 bytes
+            each, big-endian) and a random nonce prefix (8 bytes)
+    chunks: ciphertext length (4 bytes), last chunk flag (1 byte), ciphertext
+
+The nonce of a chunk is the nonce prefix followed by the chunk's index, and
+the header and the last chunk flag are authenticated with every chunk, so
+chunks can't be reordered, dropped, or cut off at the end without
+decryption failing.
+
+Needs the ``cryptography`` library.
+"""
+import hashlib
+import os
+import struct
+from collections import deque
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+
+MAGIC = b'DJBKAES1'
+EXTENSION = '.aes'
+ITERATIONS = 200000
+CHUNK_SIZE = 1024 * 1024
+SALT_SIZE = 16
+NONCE_PREFIX_SIZE = 8
+HEADER = struct.Struct('>8s%dsII%ds' % (SALT_SIZE, NONCE_PREFIX_SIZE))
+FRAME = struct.Struct('>IB')
+TAG_SIZE = 16
+
+
+class DecryptionError(ValueError):
+    pass
+
+
+def derive_key(password, salt, iterations=ITERATIONS):
+    if not isinstance(password, bytes):
+        password = password.encode('utf-8')
+    return hashlib.pbkdf2_hmac('sha256', password, salt, iterations, 32)
+
+
+def _cipher(key):
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    return AESGCM(key)
+
+
+def _nonce(prefix, index):
+    return prefix + struct.pack('>I', index)
+
+
+def is_encrypted(header):
+    return header.startswith(MAGIC)
+
+
+class _ChunkPool(object):
+    """
+    Runs the chunks of a stream through ``function`` on a pool of threads,
+    returning the results in order. At most two chunks per thread are in
+    flight.
+    """
+
+    def __init__(self, threads=None):
+        self.threads = threads or cpu_count()
+        self.pool = ThreadPool(self.threads)
+        self.pending = deque()
+
+    def submit(self, function, *args):
+        self.pending.append(self.pool.apply_async(function, args))
+
+    def collect(self, limit):
+        output = []
+        while self.pending and (len(self.pending) > limit or self.pending[0].ready()):
+            output.append(self.pending.popleft().get())
+        return b''.join(output)
+
+    def close(self):
+        output = self.collect(0)
+        self.pool.close()
+        self.pool.join()
+        return output
+
+
+class EncryptStage(object):
+    """
+    Encrypt the data passing through the pipeline with a key derived from
+    ``password``.
+    """
+
+    def __init__(self, password, threads=None, chunk_size=CHUNK_SIZE, iterations=ITERATIONS):
+        salt = os.urandom(SALT_SIZE)
+        self.prefix = os.urandom(NONCE_PREFIX_SIZE)
+        self.header = HEADER.pack(MAGIC, salt, iterations, chunk_size, self.prefix)
+        self.cipher = _cipher(derive_key(password, salt, iterations))
+        self.chunk_size = chunk_size
+        self.chunks = _ChunkPool(threads)
+        self.buffer = b''
+        self.index = 0
+        self.started = False
+
+    def _encrypt(self, index, data, last):
+        flag = 1 if last else 0
+        ciphertext = self.cipher.encrypt(_nonce(self.prefix, index), data, self.header + struct.pack('>B', flag))
+        return FRAME.pack(len(ciphertext), flag) + ciphertext
+
+    def _submit(self, data, last=False):
+        self.chunks.submit(self._encrypt, self.index, data, last)
+        self.index += 1
+
+    def _output(self, data):
+        if not self.started:
+            self.started = True
+            return self.header + data
+        return data
+
+    def process(self, data):
+        self.buffer += data
+        # The last chunk is marked as such, so a full chunk is only
+        # encrypted once it's known more data follows.
+        while len(self.buffer) > self.chunk_size:
+            self._submit(self.buffer[:self.chunk_size])
+            self.buffer = self.buffer[self.chunk_size:]
+        return self._output(self.chunks.collect(2 * self.chunks.threads))
+
+    def finish(self):
+        self._submit(self.buffer, last=True)
+        self.buffer = b''
+        return self._output(self.chunks.close())
+
+
+class DecryptStage(object):
+    """
+    Decrypt a stream written by EncryptStage. Raises DecryptionError if the
+    password is wrong or the data was corrupted, tampered with or cut short.
+    """
+
+    def __init__(self, password, threads=None):
+        self.password = password
+        self.threads = threads
+        self.buffer = b''
+        self.header = None
+        self.cipher = None
+        self.chunks = None
+        self.index = 0
+        self.last = False
+
+    def _read_header(self):
+        magic, salt, iterations, chunk_size, self.prefix = HEADER.unpack(self.buffer[:HEADER.size])
+        if magic != MAGIC:
+            raise DecryptionError('Not an encrypted backup')
+        self.header = self.buffer[:HEADER.size]
+        self.buffer = self.buffer[HEADER.size:]
+        self.cipher = _cipher(derive_key(self.password, salt, iterations))
+        self.chunks = _ChunkPool(self.threads)
+
+    def _decrypt(self, index, ciphertext, flag):
+        from cryptography.exceptions import InvalidTag
+        try:
+            return self.cipher.decrypt(_nonce(self.prefix, index), ciphertext, self.header + struct.pack('>B', flag))
+        except InvalidTag:
+            raise DecryptionError('Wrong BACKUP_PASSWORD or corrupted backup')
+
+    def process(self, data):
+        self.buffer += data
+        if self.header is None:
+            if len(self.buffer) < HEADER.size:
+                return b''
+            self._read_header()
+        while len(self.buffer) >= FRAME.size:
+            length, flag = FRAME.unpack(self.buffer[:FRAME.size])
+            if len(self.buffer) < FRAME.size + length:
+                break
+            if self.last or length < TAG_SIZE:
+                raise DecryptionError('Corrupted encrypted backup')
+            self.chunks.submit(self._decrypt, self.index, self.buffer[FRAME.size:FRAME.size + length], flag)
+            self.buffer = self.buffer[FRAME.size + length:]
+            self.index += 1
+            self.last = bool(flag)
+        return self.chunks.collect(2 * self.chunks.threads)
+
+    def finish(self):
+        if self.header is None:
+            raise DecryptionError('Not an encrypted backup')
+        output = self.chunks.close()
+        if self.buffer or not self.last:
+            raise DecryptionError('Encrypted backup is cut short')
+        return output
@@ -0,0 +1,140 @@
+"""
+Emailing backups without holding them in memory.
+
+EmailMessage.attach_file reads a whole file and the message is base64
+encoded in one go, so mailing a dump took several times its size in memory.
+Here no message carries more than ``max_size`` bytes of attachments, which
+are read and encoded a chunk at a time. With the default summary policy a
+backup larger than ``max_size`` isn't attached at all: a single message lists
+the size, SHA-256 and location of every file instead. With the split policy
+files that don't fit are split into numbered parts (name.part-001, ...)
+spread over several messages, sent one after the other and joined again with
+cat.
+"""
+import os
+from email.mime.base import MIMEBase
+
+from django.core.mail import EmailMessage
+
+from django_backup.metrics import path_size
+from django_backup.streams import DigestWriter, pump
+
+try:
+    from base64 import encodebytes
+except ImportError:  # Python 2
+    from base64 import encodestring as encodebytes
+
+
+EMAIL_MAX_SIZE = 10 * 1024 * 1024
+# A multiple of the 57 bytes encoded on one 76 characters line.
+ENCODE_CHUNK_SIZE = 57 * 16 * 1024
+PART_SUFFIX = '.part-%03d'
+POLICIES = ('summary', 'split')
+
+
+def plan_messages(files, max_size):
+    """
+    Spread the (path, size) ``files`` over messages with at most ``max_size``
+    bytes of attachments each. A file that fits in no message is split into
+    parts filling the messages up.
+
+    Returns a list of messages, each a list of (path, offset, length, name).
+    """
+    messages, message, room = [], [], max_size
+    for path, size in files:
+        name = os.path.basename(path)
+        if message and room < size <= max_size:
+            messages.append(message)
+            message, room = [], max_size
+        if size <= room:
+            message.append((path, 0, size, name))
+            room -= size
+            continue
+        offset, number = 0, 1
+        while offset < size:
+            if not room:
+                messages.append(message)
+                message, room = [], max_size
+            length = min(room, size - offset)
+            message.append((path, offset, length, name + PART_SUFFIX % number))
+            offset += length
+            room -= length
+            number += 1
+    if message:
+        messages.append(message)
+    return messages
+
+
+def encode_attachment(path, offset, length, name):
+    """
+    Return the ``length`` bytes of the file ``path`` from ``offset`` on as a
+    base64 encoded attachment named ``name``, read a chunk at a time.
+    """
+    lines = []
+    with open(path, 'rb') as source:
+        source.seek(offset)
+        while length > 0:
+            data = source.read(min(ENCODE_CHUNK_SIZE, length))
+            if not data:
+                raise IOError('%s is shorter than expected' % path)
+            length -= len(data)
+            lines.append(encodebytes(data))
+    payload = b''.join(lines)
+    if not isinstance(payload, str):
+        payload = payload.decode('ascii')
+    attachment = MIMEBase('application', 'octet-stream')
+    attachment.set_payload(payload)
+    attachment['Content-Transfer-Encoding'] = 'base64'
+    attachment.add_header('Content-Disposition', 'attachment', filename=name)
+    return attachment
+
+
+def describe(path, location):
+    """
+    Return a line with the size, SHA-256 and ``location`` of the backup
+    ``path``.
+    """
+    name = os.path.basename(path.rstrip(os.sep))
+    if os.path.isdir(path):
+        return '%s: directory of %s bytes, at %s' % (name, path_size(path), location)
+    digest = DigestWriter()
+    with open(path, 'rb') as source:
+        pump(source, digest)
+    return '%s: %s bytes, SHA-256 %s, at %s' % (name, digest.size, digest.hexdigest(), location)
+
+
+def backup_messages(paths, subject, body, from_email, to, max_size=EMAIL_MAX_SIZE, policy='summary', location=None):
+    """
+    Yield the messages sending the backup files ``paths``, built one at a
+    time so only one is held in memory. Directories can't be attached and
+    are only listed. ``location`` returns where a backup file is kept, for
+    the summary lines.
+    """
+    if policy not in POLICIES:
+        raise ValueError('Unknown email policy %r, use one of %s' % (policy, ', '.join(POLICIES)))
+    location = location or os.path.abspath
+    files = [(path, os.path.getsize(path)) for path in paths if not os.path.isdir(path)]
+    lines = [body]
+    if policy == 'summary' and sum(size for path, size in files) > max_size:
+        lines.append('The backup is larger than %s bytes and is not attached.' % max_size)
+        lines.extend(describe(path, location(path)) for path in paths)
+        yield _message(subject, lines, from_email, to)
+        return
+    lines.extend(describe(path, location(path)) for path in paths if os.path.isdir(path))
+    messages = plan_messages(files, max_size) or [[]]
+    if any(name != os.path.basename(path) for message in messages for path, _, _, name in message):
+        lines.append('Files sent in parts are joined with: cat name.part-* > name')
+    for number, message in enumerate(messages, 1):
+        email = _message(
+            subject if len(messages) < 2 else '%s (%s/%s)' % (subject, number, len(messages)),
+            lines, from_email, to,
+        )
+        for part in message:
+            email.attach(encode_attachment(*part))
+        yield email
+
+
+def _message(subject, lines, from_email, to):
+    email = EmailMessage(subject, '<br>\n'.join(lines), from_email, to)
+    email.content_subtype = 'html'
+    return email
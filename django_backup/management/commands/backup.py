@@ -1,24 +1,111 @@
+import io
+import json
 import os
+import posixpath
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import threading
 import time
+from contextlib import closing
 from copy import copy
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 from optparse import make_option
 
 from django_backup.utils import (
     GOOD_RSYNC_FLAG,
+    LOG_EXTENSION,
+    MANIFEST_NAME,
+    PG_FORMATS,
     TIME_FORMAT,
-    decide_remove,
+    db_backup_prefix,
+    decide_remove_db,
+    get_db_alias,
+    group_by_alias,
     is_db_backup,
+    is_log_backup,
     is_media_backup,
+    is_rsync_backup,
     is_backup,
+    describe_backup,
     BaseBackupCommand,
 )
+from django_backup.binlog import STATE_NAME as LOG_STATE_NAME, LogState
+from django_backup.crypto import EXTENSION as ENCRYPTED_EXTENSION, EncryptStage
+from django_backup.mail import POLICIES as EMAIL_POLICIES, backup_messages
+from django_backup.media import (
+    INCREMENTAL_SUFFIX, INDEX_NAME, MediaIndex, decide_remove_media, file_hash, is_incremental, write_archive,
+)
+from django_backup.metrics import path_size
+from django_backup.mysql import TableSplitter, defer_indexes, table_file_name
+from django_backup.repository import MANIFEST_EXTENSION, Repository, is_manifest, latest_manifest
+from django_backup.pool import remove_many
+from django_backup.retention import RetentionPlan
+from django_backup.shards import build_shards, is_shard
+from django_backup.sqlite import EXTENSION as SQLITE_EXTENSION, copy_database
+from django_backup.storage import archive_storage
+from django_backup.streams import (
+    BUFFER_SIZE, CODECS, CompressStage, DigestWriter, MultiWriter, StageWriter, get_codec, pump,
+)
+from django_backup.tablecache import CACHE_NAME as TABLE_CACHE_NAME, TableCache
+from django_backup.tasks import TaskGraph
+from django_backup.transfer import partial_name
 
 
 from django.core.management.base import BaseCommand, CommandError
-from django.core.mail import EmailMessage
+from django.apps import apps as django_apps
 from django.conf import settings
-from django.db import connection
+from django.db import connections, transaction
+
+
+# Lines mysqldump writes once it's inside its transaction, see do_mysql_parallel_backup.
+MYSQLDUMP_DATA_MARKER = b'-- Dumping data for table'
+MYSQLDUMP_SCHEMA_MARKER = b'-- Table structure for table'
+
+
+def dump_to_file(command, outfile, started=None, marker=None, env=None):
+    """
+    Run a dump command writing its output to ``outfile``, a file name or a
+    file-like object. ``started`` is set as soon as ``marker`` shows up in the
+    output, or when the command ends.
+
+    Returns the exit code of the command.
+    """
+    try:
+        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, env=env)
+        try:
+            out = outfile if hasattr(outfile, 'write') else open(outfile, 'wb')
+            with closing(out):
+                # The end of the previous read, in case the marker is split
+                # across two reads.
+                tail = b''
+                while True:
+                    data = os.read(process.stdout.fileno(), BUFFER_SIZE)
+                    if not data:
+                        break
+                    if started is not None and not started.is_set():
+                        if marker in tail + data:
+                            started.set()
+                        tail = (tail + data)[-len(marker):]
+                    out.write(data)
+        finally:
+            process.stdout.close()
+    finally:
+        if started is not None:
+            started.set()
+    return process.wait()
+
+
+def compress_callback(option, opt_str, value, parser):
+    """
+    --compress takes an optional codec name and defaults to gzip.
+    """
+    codec = 'gzip'
+    if parser.rargs and parser.rargs[0] in CODECS:
+        codec = parser.rargs.pop(0)
+    setattr(parser.values, option.dest, codec)
 
 
 # Based on: http://www.djangosnippets.org/snippets/823/
@@ -38,8 +125,13 @@ class Command(BaseBackupCommand):
         ),
         make_option(
             '--compress', '-c',
-            action='store_true', default=False, dest='compress',
-            help='Compress dump file'
+            action='callback', callback=compress_callback, default=False, dest='compress',
+            help='Compress dump file, optionally naming the codec: %s (default gzip)' % ', '.join(sorted(CODECS))
+        ),
+        make_option(
+            '--compress-level',
+            type='int', default=None, dest='compress_level',
+            help='Compression level, defaults to the codec\'s default'
         ),
         make_option(
             '--directory', '-d',
@@ -49,7 +141,12 @@ class Command(BaseBackupCommand):
         make_option(
             '--zipencrypt', '-z',
             action='store_true', default=False,
-            dest='zipencrypt', help='Compress and encrypt SQL dump file using zip'
+            dest='zipencrypt', help='Compress and encrypt SQL dump file using zip (legacy, see --encrypt)'
+        ),
+        make_option(
+            '--encrypt',
+            action='store_true', default=False, dest='encrypt',
+            help='Encrypt the SQL dump with AES-GCM and a key derived from BACKUP_PASSWORD'
         ),
         make_option(
             '--media', '-m',
@@ -61,6 +158,17 @@ class Command(BaseBackupCommand):
             action='store_true', default=False, dest='rsync',
             help='Backup media dir with rsync'
         ),
+        make_option(
+            '--incremental', '-i',
+            action='store_true', default=False, dest='incremental',
+            help='Only archive the media files changed since the last media backup'
+        ),
+        make_option(
+            '--shard-size',
+            type='int', default=None, dest='shard_size',
+            help='Split full media archives into shards of about this many megabytes, built in parallel, '
+                 'defaults to BACKUP_MEDIA_SHARD_SIZE'
+        ),
         make_option(
             '--cleandb',
             action='store_true', default=False, dest='clean_db',
@@ -116,30 +224,88 @@ class Command(BaseBackupCommand):
             action='store_true', default=False, dest='clean_remote_rsync',
             help='Clean up remote broken rsync backups'
         ),
+        make_option(
+            '--dry-run',
+            action='store_true', default=False, dest='dry_run',
+            help='Only show what the clean options would remove, without removing anything or doing a backup'
+        ),
         make_option(
             '--application', '-a',
             action='append', default=[], dest='apps',
             help='Optionally only back up certain Django apps'
         ),
+        make_option(
+            '--parallel', '-j',
+            type='int', default=0, dest='parallel',
+            help='Dump the database table by table with this many concurrent dumpers'
+        ),
+        make_option(
+            '--repository',
+            action='store_true', default=False, dest='repository',
+            help='Store the database dump in the deduplicating repository on the remote server, implies --stream'
+        ),
+        make_option(
+            '--stream', '-s',
+            action='store_true', default=False, dest='stream',
+            help='Stream the database dump through compression straight to the local and remote files'
+        ),
+        make_option(
+            '--database',
+            action='append', default=[], dest='databases',
+            help='Back up this database of settings.DATABASES, can be repeated, defaults to BACKUP_DATABASES'
+        ),
+        make_option(
+            '--all-databases',
+            action='store_true', default=False, dest='all_databases',
+            help='Back up every database of settings.DATABASES'
+        ),
+        make_option(
+            '--skip-unchanged',
+            action='store_true', default=False, dest='skip_unchanged',
+            help='With --parallel, reuse the previous dumps of the tables that did not change since'
+        ),
+        make_option(
+            '--logs',
+            action='store_true', default=False, dest='logs',
+            help='Instead of a full dump, ship the MySQL binary logs written since the last shipment, '
+                 'needs BACKUP_MYSQL_BINLOGS'
+        ),
+        make_option(
+            '--pg-format',
+            type='choice', choices=['plain', 'custom', 'directory'], default='plain', dest='pg_format',
+            help='Format of PostgreSQL dumps: plain SQL (default), or pg_dump\'s custom or directory archive, '
+                 'which restore can load with parallel jobs'
+        ),
     )
-    help = "Backup database. Only Mysql and Postgresql engines are implemented"
+    help = "Backup database. Only Mysql, Postgresql and SQLite engines are implemented"
 
     def handle(self, *args, **kwargs):
         try:
-            self._handle(*args, **kwargs)
+            with self.reporting('backup'):
+                self._handle(*args, **kwargs)
         finally:
             self.close_connection()
+            # Only set once _handle is under way.
+            if getattr(self, 'media_index', None):
+                self.media_index.close()
 
     def _handle(self, *args, **options):
         self.time_suffix = time.strftime(TIME_FORMAT)
         self.email = options.get('email')
         self.ftp = options.get('ftp')
         self.compress = options.get('compress')
-        self.directories = options.get('directories')
+        if self.compress is True:
+            self.compress = 'gzip'
+        self.compress_level = options.get('compress_level')
+        self.directories = list(options.get('directories') or [])
         self.zipencrypt = options.get('zipencrypt')
+        self.encrypt = options.get('encrypt')
         self.encrypt_password = os.environ.get('BACKUP_PASSWORD')
         self.media = options.get('media')
         self.rsync = options.get('rsync')
+        self.incremental = options.get('incremental')
+        self.shard_size = options.get('shard_size') or self.media_shard_size
+        self.media_index = None
         self.clean = options.get('clean')
         self.clean_db = options.get('clean_db')
         self.clean_media = options.get('clean_media')
@@ -153,104 +319,338 @@ class Command(BaseBackupCommand):
         self.no_local = options.get('no_local')
         self.delete_local = options.get('delete_local')
         self.apps = options.get('apps')
+        self.repository = options.get('repository')
+        self.stream = options.get('stream') or self.repository
+        self.parallel = options.get('parallel')
+        self.dry_run = options.get('dry_run')
+        self.pg_format = options.get('pg_format') or 'plain'
+        self.logs = options.get('logs')
+        self.log_state = None
+        self.binlog_position = None
+        self.skip_unchanged = options.get('skip_unchanged')
+        self.table_cache = None
+        aliases = self.get_database_aliases(options)
 
-        if self.zipencrypt and not self.encrypt_password:
+        if (self.zipencrypt or self.encrypt) and not self.encrypt_password:
             raise CommandError(
                 'Please specify a password for your backup file'
                 ' using the BACKUP_PASSWORD environment variable.'
             )
 
-        if self.clean_rsync:
-            self.stdout.write('cleaning broken rsync backups')
-            self.clean_broken_rsync()
-        else:
-            if self.clean_local_rsync:
-                self.stdout.write('cleaning local broken rsync backups')
-                self.clean_local_broken_rsync()
+        if self.zipencrypt and self.encrypt:
+            raise CommandError('Use either --encrypt or --zipencrypt.')
+
+        if self.encrypt:
+            try:
+                import cryptography  # noqa
+            except ImportError as e:
+                raise CommandError('--encrypt needs the cryptography library: %s' % e)
+
+        if self.encrypt and self.repository:
+            raise CommandError('--encrypt can not be used with --repository, whose chunks are stored unencrypted.')
+
+        if self.compress:
+            try:
+                self.codec = get_codec(self.compress)
+            except KeyError:
+                raise CommandError(
+                    'Unknown compression codec %s, use one of %s.' % (self.compress, ', '.join(sorted(CODECS)))
+                )
+            except ImportError as e:
+                raise CommandError('Compressing with %s needs a library that is not installed: %s' % (self.compress, e))
+
+        if self.repository and not self.ftp:
+            raise CommandError('--repository stores backups on the remote server and needs --ftp.')
+
+        if self.pg_format != 'plain':
+            engines = [database.engine for database in self.get_database_commands(aliases)]
+            if any(engine != 'django.db.backends.postgresql_psycopg2' for engine in engines):
+                raise CommandError('--pg-format is only supported for PostgreSQL.')
+            if self.pg_format == 'directory' and self.stream:
+                raise CommandError('--pg-format directory writes several files and can not be used with --stream.')
+            if self.pg_format == 'custom' and self.parallel:
+                raise CommandError('pg_dump can not write a custom format dump in parallel, '
+                                   'use --pg-format directory with --parallel.')
+
+        if self.stream or self.parallel or self.apps:
+            engines = [database.engine for database in self.get_database_commands(aliases)]
+            if 'django.db.backends.sqlite3' in engines:
+                raise CommandError('SQLite databases are copied whole and can not be backed up '
+                                   'with --stream, --repository, --parallel or --application.')
+
+        for app in self.apps:
+            try:
+                django_apps.get_app_config(app)
+            except LookupError:
+                raise CommandError('Unknown application %s.' % app)
 
-            if self.clean_remote_rsync:
-                self.stdout.write('cleaning remote broken rsync backups')
-                self.clean_remote_broken_rsync()
+        if self.skip_unchanged and not self.parallel:
+            raise CommandError('--skip-unchanged reuses the per table dumps of --parallel and needs it.')
 
-        if self.clean_db:
-            self.stdout.write('cleaning surplus database backups')
-            self.clean_surplus_db()
+        if self.logs:
+            if not self.mysql_binlogs:
+                raise CommandError('--logs needs BACKUP_MYSQL_BINLOGS = True, so that full backups record '
+                                   'their binary log position.')
+            engines = [database.engine for database in self.get_database_commands(aliases)]
+            if any(engine != 'django.db.backends.mysql' and 'mysql' not in engine for engine in engines):
+                raise CommandError('--logs is only supported for MySQL.')
+            if self.stream or self.parallel or self.apps:
+                raise CommandError('--logs can not be used with --stream, --repository, --parallel or --application.')
+            self.log_state = LogState(self.log_state_path or os.path.join(self.backup_dir, LOG_STATE_NAME))
 
-        if self.clean_local_db:
-            self.stdout.write('cleaning local surplus database backups')
-            self.clean_local_surplus_db()
+        if self.media and self.media_storage and (self.rsync or self.incremental):
+            raise CommandError('Media in BACKUP_MEDIA_STORAGE can not be backed up with --rsync or --incremental.')
 
-        if self.clean_remote_db:
-            self.stdout.write('cleaning remote surplus database backups')
-            self.clean_remote_surplus_db()
+        if self.stream and self.parallel:
+            raise CommandError('--parallel writes several files and can not be used with --stream.')
 
-        if self.clean_media:
-            self.stdout.write('cleaning surplus media backups')
-            self.clean_surplus_media()
+        if self.stream and self.zipencrypt:
+            raise CommandError('--zipencrypt needs a local file and can not be used with --stream.')
 
-        if self.clean_local_media:
-            self.stdout.write('cleaning local surplus media backups')
-            self.clean_local_surplus_media()
+        if self.stream and self.no_local and not self.ftp:
+            raise CommandError('--stream with --nolocal needs --ftp, otherwise the dump goes nowhere.')
 
-        if self.clean_remote_media:
-            self.stdout.write('cleaning remote surplus media backups')
-            self.clean_remote_surplus_media()
+        if self.stream and self.no_local and self.email:
+            raise CommandError('--email needs a local copy of the backup and can not be used with --stream --nolocal.')
+
+        if self.email and self.email_policy not in EMAIL_POLICIES:
+            raise CommandError('BACKUP_EMAIL_POLICY must be one of %s.' % ', '.join(EMAIL_POLICIES))
+
+        # Cleanups, dumps, the media archive, email and uploads run as a
+        # graph of tasks, see django_backup.tasks.
+        graph = TaskGraph(self.task_concurrency, {'database': self.database_concurrency, 'upload': 1})
+        local_cleanups, remote_cleanups = self.get_cleanups()
+        if remote_cleanups or (self.ftp and not self.dry_run):
+            # Remote tasks borrow connections of their own from the pool,
+            # uploads take turns on this one.
+            self.get_connection()
+            self.get_pool()
+        if local_cleanups:
+            graph.add('clean_local', lambda: self.run_cleanups(local_cleanups))
+        if remote_cleanups:
+            graph.add('clean_remote', lambda: self.on_own_connection(
+                self, lambda command: command.run_cleanups(remote_cleanups)))
+
+        if self.dry_run:
+            graph.run()
+            return
 
         if not os.path.exists(self.backup_dir):
             os.makedirs(self.backup_dir)
 
-        outfile = os.path.join(self.backup_dir, 'backup_%s.sql' % self.time_suffix)
+        # Cleanups go first so that they don't count the new backups. Local
+        # files are written after the local cleanup, remote ones after both.
+        after_local = [name for name in ('clean_local',) if name in graph]
+        after_remote = [name for name in ('clean_local', 'clean_remote') if name in graph]
 
-        # Doing backup
-        if self.engine == 'django.db.backends.mysql' or 'mysql' in self.engine:
-            self.stdout.write('Doing Mysql backup to database %s into %s' % (self.db, outfile))
-            self.do_mysql_backup(outfile)
-        # TODO reinstate postgres support
-        elif self.engine == 'django.db.backends.postgresql_psycopg2':
-            self.stdout.write('Doing Postgresql backup to database %s into %s' % (self.db, outfile))
-            self.do_postgresql_backup(outfile)
-        else:
-            raise CommandError('Backup in %s engine not implemented' % self.engine)
+        databases = self.get_database_commands(aliases)
+        for database in databases:
+            graph.add(
+                'database:%s' % database.alias, lambda database=database: self.backup_database_in_task(database),
+                after=after_remote if self.stream else after_local, group='database',
+            )
 
-        # Compressing backup
-        if self.compress:
-            compressed_outfile = outfile + '.gz'
-            self.stdout.write('Compressing backup file %s to %s' % (outfile, compressed_outfile))
-            self.do_compress(outfile, compressed_outfile)
-            outfile = compressed_outfile
+        # Backing up media directories,
+        if self.media and not self.media_storage:
+            self.directories = self.directories + [self.directory_to_backup]
+        if (self.media and self.media_storage) or self.directories:
+            graph.add('media', self.backup_media, after=after_remote if self.rsync else after_local)
+        produced = [name for name in ('media',) if name in graph] + [
+            'database:%s' % database.alias for database in databases
+        ]
 
-        if self.zipencrypt:
-            zip_encrypted_outfile = "{}.zip".format(outfile)
-            self.stdout.write('Zipping and cncrypting backup file {} to {}'.format(outfile, zip_encrypted_outfile))
-            self.do_encrypt(outfile, zip_encrypted_outfile)
-            outfile = zip_encrypted_outfile
+        def backup_files(results, databases=databases):
+            return results.get('media', []) + [results['database:%s' % database.alias] for database in databases]
 
-        # Backing up media directories,
-        if self.media:
-            self.directories += [self.directory_to_backup]
+        # Sending mail with backups
+        if self.email:
+            graph.add('email', lambda: self.email_backups(backup_files(graph.results)), after=produced)
 
-        # Backing up directories
-        dir_outfiles = []
+        # Every file is uploaded as soon as it's written.
+        if self.ftp:
+            if 'media' in graph and not self.rsync:
+                graph.add('upload:media', lambda: self.store_ftp(
+                    [os.path.join(os.getcwd(), x) for x in graph.results['media']], stage_name='media_upload',
+                ), after=['media'] + after_remote, group='upload')
+            for database in databases if not self.stream else []:
+                name = 'database:%s' % database.alias
+                graph.add('upload:%s' % database.alias, lambda database=database, name=name: database.store_ftp(
+                    [os.path.join(os.getcwd(), graph.results[name])],
+                ), after=[name] + after_remote, group='upload')
 
-        if self.directories:  # We need to do media backup
+        # The media index only describes what's safely stored once the
+        # archive is uploaded.
+        if self.incremental and 'media' in graph:
+            graph.add('media_index', lambda: self.media_index.commit(),
+                      after=[name for name in ('media', 'upload:media') if name in graph])
+
+        results = graph.run()
+        if self.ftp:
+            # A streamed database dump has no local file to upload.
+            upload_files = backup_files(results, [] if self.stream else databases)
+            self.remove_local_backups([os.path.join(os.getcwd(), x) for x in upload_files])
+
+        # The binary log state only describes what's safely stored from here
+        # on.
+        if self.log_state:
+            self.log_state.commit()
+
+    def get_cleanups(self):
+        """
+        Return the cleanups asked for, (message, method name) pairs, of the
+        local backups and of those on the remote server.
+        """
+        local_cleanups, remote_cleanups = [], []
+        for kind, method, both, local, remote in (
+            ('broken rsync', 'broken_rsync', self.clean_rsync, self.clean_local_rsync, self.clean_remote_rsync),
+            ('surplus database', 'surplus_db', self.clean_db, self.clean_local_db, self.clean_remote_db),
+            ('surplus media', 'surplus_media', self.clean_media, self.clean_local_media, self.clean_remote_media),
+        ):
+            if both or local:
+                local_cleanups.append(('cleaning local %s backups' % kind, 'clean_local_%s' % method))
+            if both or remote:
+                remote_cleanups.append(('cleaning remote %s backups' % kind, 'clean_remote_%s' % method))
+        return local_cleanups, remote_cleanups
+
+    def run_cleanups(self, cleanups):
+        for message, method in cleanups:
+            self.stdout.write(message)
+            getattr(self, method)()
+
+    def on_own_connection(self, command, function):
+        """
+        Call ``function`` with a copy of ``command`` using a connection to
+        the remote server borrowed from the pool, so that it can run next to
+        the tasks using other connections.
+        """
+        if getattr(self, '_ssh', None) is None:
+            return function(command)
+        with self.get_pool().connection() as ssh:
+            worker = copy(command)
+            worker._ssh = ssh
+            return function(worker)
+
+    def backup_database_in_task(self, database):
+        """
+        Back up ``database`` on the thread of its task. Returns the name of
+        the backup file.
+        """
+        try:
+            if self.stream:
+                return self.on_own_connection(database, lambda command: command.backup_database())
+            return database.backup_database()
+        finally:
+            # Database connections belong to the thread that opened them.
+            connections[database.alias].close()
+
+    def backup_media(self):
+        """
+        Back up the media and the extra directories. Returns the names of the
+        archives written.
+        """
+        dir_outfiles = []
+        if self.media and self.media_storage:
+            all_outfile = os.path.join(self.backup_dir, 'dir_%s.tar.gz' % self.time_suffix)
+            self.stdout.write('Archiving media storage %s into %s' % (self.media_storage, all_outfile))
+            with self.stage('media') as stage:
+                stage.bytes_in = archive_storage(
+                    self.get_media_storage(), all_outfile, self.directories, threads=self.media_fetch_threads,
+                )
+                stage.bytes_out = path_size(all_outfile)
+            dir_outfiles.append(all_outfile)
+        elif self.directories:  # We need to do media backup
             all_directories = ' '.join(self.directories)
             self.all_directories = all_directories
             if self.rsync:
-                self.do_media_rsync_backup()
+                with self.stage('media_rsync'):
+                    self.on_own_connection(self, lambda command: command.do_media_rsync_backup())
+            elif self.incremental:
+                with self.stage('media_incremental') as stage:
+                    dir_outfiles.append(self.do_incremental_media_backup())
+                    stage.bytes_out = path_size(dir_outfiles[-1])
+            elif self.shard_size:
+                prefix = os.path.join(self.backup_dir, 'dir_%s' % self.time_suffix)
+                with self.stage('media', sum(path_size(directory) for directory in self.directories)) as stage:
+                    dir_outfiles += self.do_sharded_media_backup(prefix)
+                    stage.bytes_out = sum(path_size(outfile) for outfile in dir_outfiles)
             else:
                 # Backup all the directories in one file.
                 all_outfile = os.path.join(self.backup_dir, 'dir_%s.tar.gz' % self.time_suffix)
-                self.compress_dir(all_directories, all_outfile)
+                with self.stage('media', sum(path_size(directory) for directory in self.directories)) as stage:
+                    self.compress_dir(all_directories, all_outfile)
+                    stage.bytes_out = path_size(all_outfile)
                 dir_outfiles.append(all_outfile)
+        return dir_outfiles
 
-        # Sending mail with backups
-        if self.email:
-            self.stdout.write("Sending e-mail with backups to '%s'" % self.email)
-            self.sendmail(settings.SERVER_EMAIL, [self.email], dir_outfiles + [outfile])
+    def email_backups(self, attachments):
+        self.stdout.write("Sending e-mail with backups to '%s'" % self.email)
+        with self.stage('email', sum(path_size(attachment) for attachment in attachments)):
+            self.sendmail(settings.SERVER_EMAIL, [self.email], attachments)
 
-        if self.ftp:
-            self.stdout.write("Saving to remote server")
-            self.store_ftp(local_files=[os.path.join(os.getcwd(), x) for x in dir_outfiles + [outfile]])
+    def backup_database(self):
+        """
+        Dump, compress and encrypt the database. Returns the name of the
+        backup file.
+        """
+        extension = PG_FORMATS.get(self.pg_format, '.sql')
+        if self.engine == 'django.db.backends.sqlite3':
+            extension = SQLITE_EXTENSION
+        if self.logs:
+            extension = LOG_EXTENSION
+        prefix = db_backup_prefix(self.alias)
+        outfile = os.path.join(self.backup_dir, '%s%s%s' % (prefix, self.time_suffix, extension))
+
+        # Doing backup
+        if self.stream:
+            self.stdout.write('Doing streamed backup of database %s' % self.db)
+            outfile = self.do_stream_backup(outfile)
+        elif self.logs:
+            with self.stage('binlog') as stage:
+                self.stdout.write('Shipping binary logs of database %s into %s' % (self.db, outfile))
+                self.do_mysql_log_backup(outfile)
+                stage.bytes_out = path_size(outfile)
+        else:
+            with self.stage('dump') as stage:
+                if self.pg_format != 'plain':
+                    self.stdout.write('Doing Postgresql %s format backup of database %s into %s' % (
+                        self.pg_format, self.db, outfile))
+                    self.do_postgresql_archive_backup(outfile)
+                elif self.parallel:
+                    outfile = os.path.join(self.backup_dir, '%s%s.tar' % (prefix, self.time_suffix))
+                    self.stdout.write('Doing parallel backup of database %s into %s' % (self.db, outfile))
+                    self.do_parallel_backup(outfile)
+                elif self.engine == 'django.db.backends.mysql' or 'mysql' in self.engine:
+                    self.stdout.write('Doing Mysql backup to database %s into %s' % (self.db, outfile))
+                    self.do_mysql_backup(outfile)
+                # TODO reinstate postgres support
+                elif self.engine == 'django.db.backends.postgresql_psycopg2':
+                    self.stdout.write('Doing Postgresql backup to database %s into %s' % (self.db, outfile))
+                    self.do_postgresql_backup(outfile)
+                elif self.engine == 'django.db.backends.sqlite3':
+                    self.stdout.write('Doing SQLite backup of database %s into %s' % (self.db, outfile))
+                    self.do_sqlite_backup(outfile)
+                else:
+                    raise CommandError('Backup in %s engine not implemented' % self.engine)
+                stage.bytes_out = path_size(outfile)
+
+        # Compressing and encrypting backup in one pass
+        if (self.compress or self.encrypt) and not self.stream:
+            new_outfile = outfile + self.get_extension()
+            names = [name for name, enabled in (('compress', self.compress), ('encrypt', self.encrypt)) if enabled]
+            self.stdout.write('%s backup file %s to %s' % (' and '.join(names).capitalize(), outfile, new_outfile))
+            with self.stage('+'.join(names), path_size(outfile)) as stage:
+                self.do_compress(outfile, new_outfile)
+                stage.bytes_out = path_size(new_outfile)
+            outfile = new_outfile
+
+        if self.zipencrypt:
+            zip_encrypted_outfile = "{}.zip".format(outfile)
+            self.stdout.write('Zipping and cncrypting backup file {} to {}'.format(outfile, zip_encrypted_outfile))
+            with self.stage('encrypt', path_size(outfile)) as stage:
+                self.do_encrypt(outfile, zip_encrypted_outfile)
+                stage.bytes_out = path_size(zip_encrypted_outfile)
+            outfile = zip_encrypted_outfile
+        return outfile
 
     def compress_dir(self, directory, outfile):
         self.stdout.write('Backup directories ...')
@@ -259,6 +659,43 @@ class Command(BaseBackupCommand):
         self.stdout.write('Running Command: %s' % command)
         os.system(command)
 
+    def do_sharded_media_backup(self, prefix):
+        """
+        Archive the directories into shards of about --shard-size megabytes,
+        compressed on a pool of BACKUP_COMPRESSION_THREADS processes, and a
+        manifest listing them. Returns the names of the shards and the
+        manifest.
+        """
+        self.stdout.write('Backup directories into shards of %s MB ...' % self.shard_size)
+        outfiles = build_shards(
+            self.directories, prefix, self.shard_size * 1024 * 1024, processes=self.compression_threads,
+        )
+        self.stdout.write('Wrote %s shards and %s' % (len(outfiles) - 1, outfiles[-1]))
+        return outfiles
+
+    def do_incremental_media_backup(self):
+        """
+        Archive the files changed since the last media backup into a
+        dir_<timestamp>.inc.tar.gz, or every file into a dir_<timestamp>.tar.gz
+        when there's no index yet or BACKUP_MEDIA_INCREMENTAL_CHAIN incremental
+        archives have been made since the last full one.
+
+        Returns the name of the archive.
+        """
+        self.media_index = MediaIndex(self.media_index_path or os.path.join(self.backup_dir, INDEX_NAME))
+        chain = self.media_index.get_meta('chain', 0)
+        full = self.media_index.is_empty() or chain >= self.media_incremental_chain
+        changed, deleted = self.media_index.scan(self.directories, full=full)
+        if full:
+            outfile = os.path.join(self.backup_dir, 'dir_%s.tar.gz' % self.time_suffix)
+            self.media_index.set_meta('chain', 0)
+        else:
+            outfile = os.path.join(self.backup_dir, 'dir_%s%s' % (self.time_suffix, INCREMENTAL_SUFFIX))
+            self.media_index.set_meta('chain', chain + 1)
+        self.stdout.write('Archiving %s changed files, %s deleted, into %s' % (len(changed), len(deleted), outfile))
+        write_archive(outfile, changed, deleted, full)
+        return outfile
+
     @staticmethod
     def get_blacklist_tables():
         """
@@ -266,35 +703,53 @@ class Command(BaseBackupCommand):
         """
         return getattr(settings, 'BACKUP_TABLES_BLACKLIST', [])
 
-    @staticmethod
-    def get_tables_for_apps(*apps):
+    def get_tables_for_apps(self, *apps):
         """
-        Get table names for all for the given applications.
+        Get the existing tables of the models of the given applications,
+        including the tables of their many to many relations.
         """
-        
-        tables = connection.introspection.django_table_names(only_existing=True)
-        
-        def check_table(table):
-            return any(table.startswith('%s_' % app) for app in apps)
-        
-        return list(filter(check_table, tables))
+        existing = set(self.db_connection.introspection.table_names())
+        tables = []
+        for app in apps:
+            for model in django_apps.get_app_config(app).get_models(include_auto_created=True):
+                table = model._meta.db_table
+                if model._meta.managed and not model._meta.proxy and table in existing and table not in tables:
+                    tables.append(table)
+        return tables
 
-    def store_ftp(self, local_files=None):
+    def store_ftp(self, local_files=None, stage_name='upload'):
         
         if not local_files:
             local_files = []
             
-        sftp = self.get_connection()
-        
-        if self.remote_dir:
-            try:
-                sftp.mkdir(self.remote_dir)
-            except IOError:
-                pass
+        self.stdout.write("Saving to remote server")
+        self.make_remote_dir()
+
+        files = []
         for local_file in local_files:
             filename = os.path.split(local_file)[-1]
             self.stdout.write('Saving %s to remote server ' % local_file)
-            sftp.put(local_file, os.path.join(self.remote_dir or '', filename))
+            files.append((local_file, os.path.join(self.remote_dir or '', filename)))
+        transfer = self.get_transfer()
+        with self.stage(stage_name, sum(path_size(local_file) for local_file in local_files)) as stage:
+            hashes = transfer.put(files, checksum=self.use_catalog)
+            stage.retries = transfer.retried
+        if self.use_catalog:
+            # Files with a range that failed midway are read again.
+            self.catalog_add([
+                describe_backup(
+                    os.path.basename(local_file), os.path.getsize(local_file),
+                    hashes[local_file] or file_hash(local_file),
+                )
+                for local_file in local_files
+            ])
+
+    def remove_local_backups(self, local_files):
+        """
+        Once everything is stored, remove all local backups with
+        --deletelocal or the files of this run, ``local_files``, with
+        --nolocal.
+        """
         if self.delete_local:
             backups = os.listdir(self.backup_dir)
             backups = list(filter(is_backup, backups))
@@ -325,30 +780,81 @@ class Command(BaseBackupCommand):
                 self.stdout.write('Running Command: %s' % command)
                 os.system(command)
 
-    @staticmethod
-    def sendmail(address_from, addresses_to, attachments):
+    def sendmail(self, address_from, addresses_to, attachments):
+        """
+        Mail the backup files ``attachments``, or only a summary of them when
+        they're larger than BACKUP_EMAIL_MAX_SIZE bytes, unless
+        BACKUP_EMAIL_POLICY is 'split' and they're spread over messages of at
+        most that many bytes of attachments.
+        """
         subject = "Your DB-backup for " + datetime.now().strftime("%d %b %Y")
         body = "Timestamp of the backup is " + datetime.now().strftime("%d %b %Y")
 
-        email = EmailMessage(subject, body, address_from, addresses_to)
-        email.content_subtype = 'html'
-        for attachment in attachments:
-            email.attach_file(attachment)
-        email.send()
+        def location(path):
+            if self.ftp:
+                return '%s:%s' % (self.ftp_server, posixpath.join(self.remote_dir, os.path.basename(path)))
+            return os.path.abspath(path)
 
-    @staticmethod
-    def do_compress(infile, outfile):
-        os.system('gzip --stdout %s > %s' % (infile, outfile))
-        os.system('rm %s' % infile)
+        messages = backup_messages(
+            attachments, subject, body, address_from, addresses_to,
+            max_size=self.email_max_size, policy=self.email_policy, location=location,
+        )
+        for email in messages:
+            email.send()
+
+    def get_compress_stage(self):
+        return CompressStage(
+            self.codec, self.compress_level,
+            threads=self.compression_threads, block_size=self.compression_block_size,
+        )
+
+    def get_encrypt_stage(self):
+        return EncryptStage(self.encrypt_password, threads=self.compression_threads)
+
+    def get_stages(self):
+        """
+        Return the stages the database dump goes through: compression, then
+        encryption.
+        """
+        stages = []
+        if self.compress:
+            stages.append(self.get_compress_stage())
+        if self.encrypt:
+            stages.append(self.get_encrypt_stage())
+        return stages
+
+    def get_extension(self):
+        return (self.codec.extension if self.compress else '') + (ENCRYPTED_EXTENSION if self.encrypt else '')
+
+    def do_compress(self, infile, outfile):
+        with open(infile, 'rb') as source:
+            with open(outfile, 'wb') as sink:
+                pump(source, sink, self.get_stages(), buffer_size=self.buffer_size)
+        os.remove(infile)
 
     def do_encrypt(self, infile, outfile):
         os.system('zip -P %s %s %s' % (self.encrypt_password, outfile, infile))
         os.system('rm %s' % infile)
 
+    def get_dump_command(self):
+        """
+        Return the shell command writing the SQL dump of the database to stdout.
+        """
+        if self.engine == 'django.db.backends.mysql' or 'mysql' in self.engine:
+            return self.get_mysql_dump_command()
+        elif self.engine == 'django.db.backends.postgresql_psycopg2':
+            if self.pg_format == 'custom':
+                return self.get_postgresql_archive_command('custom')
+            return self.get_postgresql_dump_command()
+        raise CommandError('Backup in %s engine not implemented' % self.engine)
+
     def do_mysql_backup(self, outfile):
+        os.system('%s > %s' % (self.get_mysql_dump_command(), outfile))
 
-        if self.apps:
-            raise NotImplementedError("Backuping up only ceratain apps not implemented in MySQL")
+    def get_mysql_dump_args(self):
+        return self.get_mysql_connection_args() + [self.db]
+
+    def get_mysql_connection_args(self):
         args = []
         if self.user:
             args += ["--user='%s'" % self.user]
@@ -358,24 +864,91 @@ class Command(BaseBackupCommand):
             args += ["--{}='{}'".format("socket" if self.host.startswith('/') else "host", self.host)]
         if self.port:
             args += ["--port=%s" % self.port]
-        args += [self.db]
+        return args
+
+    def get_mysql_dump_command(self):
+
+        args = self.get_mysql_dump_args()
+        if self.mysql_binlogs:
+            # Record the binary log position the dump is consistent with.
+            args = ['--single-transaction', '--master-data=2'] + args
         base_args = copy(args)
         blacklist_tables = self.get_blacklist_tables()
-        if blacklist_tables:
-            all_tables = connection.introspection.get_table_list(connection.cursor())
+        if self.apps:
+            # mysqldump streams the rows of the tables listed (--quick) as
+            # multi-row INSERTs, each table dropped and created again first.
+            app_tables = self.get_tables_for_apps(*self.apps)
+            tables = [table for table in app_tables if table not in blacklist_tables]
+            if not tables:
+                raise CommandError('The applications %s have no tables to back up.' % ', '.join(self.apps))
+            args += tables
+            blacklist_tables = [table for table in app_tables if table in blacklist_tables]
+        elif blacklist_tables:
+            all_tables = self.db_connection.introspection.get_table_list(self.db_connection.cursor())
             tables = list(set(all_tables) - set(blacklist_tables))
             args += tables
-        os.system('%s %s > %s' % (getattr(settings, 'BACKUP_SQLDUMP_PATH', 'mysqldump'), ' '.join(args), outfile))
-        
+        cmd = '%s %s' % (getattr(settings, 'BACKUP_SQLDUMP_PATH', 'mysqldump'), ' '.join(args))
+
         # Append table structures of blacklist_tables
         if blacklist_tables:
-            all_tables = connection.introspection.get_table_list(connection.cursor())
-            blacklist_tables = list(set(all_tables) and set(blacklist_tables))
+            if not self.apps:
+                all_tables = self.db_connection.introspection.get_table_list(self.db_connection.cursor())
+                blacklist_tables = list(set(all_tables) and set(blacklist_tables))
             args = base_args + ['-d'] + blacklist_tables
-            cmd = '%s %s >> %s' % (getattr(settings, 'BACKUP_SQLDUMP_PATH', 'mysqldump'), ' '.join(args), outfile)
-            os.system(cmd)
+            cmd = '(%s; %s %s)' % (cmd, getattr(settings, 'BACKUP_SQLDUMP_PATH', 'mysqldump'), ' '.join(args))
+        return cmd
+
+    def do_mysql_log_backup(self, outfile):
+        """
+        Rotate the binary log and bundle the complete logs from the next one
+        to ship on, all of them the first time, into the tar archive
+        ``outfile``. The next log to ship is committed to the log state once
+        the archive is stored.
+        """
+        cursor = self.db_connection.cursor()
+        cursor.execute('FLUSH BINARY LOGS')
+        cursor.execute('SHOW BINARY LOGS')
+        logs = [row[0] for row in cursor.fetchall()]
+        # The log written to from now on is shipped next time.
+        next_log = logs.pop()
+        first_log = self.log_state.get(self.alias)
+        logs = [log for log in logs if first_log is None or log >= first_log]
+
+        workdir = tempfile.mkdtemp(prefix='.binlog_', dir=self.backup_dir)
+        try:
+            if logs:
+                command = '%s --read-from-remote-server --raw --result-file=%s %s %s' % (
+                    getattr(settings, 'BACKUP_MYSQLBINLOG_PATH', 'mysqlbinlog'), workdir + os.sep,
+                    ' '.join(self.get_mysql_connection_args()), ' '.join(logs),
+                )
+                self.stdout.write('Running Command: %s' % command)
+                self.check_dump_results([(os.path.basename(outfile), command)], [subprocess.call(command, shell=True)])
+            archive = tarfile.open(outfile, 'w')
+            try:
+                for log in logs:
+                    archive.add(os.path.join(workdir, log), log)
+            finally:
+                archive.close()
+        finally:
+            shutil.rmtree(workdir)
+        self.log_state.ship(self.alias, next_log)
 
     def do_postgresql_backup(self, outfile):
+        pgdump_cmd = '%s > %s' % (self.get_postgresql_dump_command(), outfile)
+        self.stdout.write(pgdump_cmd)
+        subprocess.call(pgdump_cmd, shell=True, env=self.get_environ())
+
+    def do_sqlite_backup(self, outfile):
+        """
+        Copy the database with sqlite3's online backup API,
+        BACKUP_SQLITE_PAGES pages at a time with a pause of
+        BACKUP_SQLITE_PAUSE seconds in between, so writers aren't held up.
+        """
+        if not self.db or self.db == ':memory:' or self.db.startswith('file:'):
+            raise CommandError('Only SQLite databases in a file can be backed up, not %r.' % self.db)
+        copy_database(self.db, outfile, pages=self.sqlite_pages, pause=self.sqlite_pause)
+
+    def get_postgresql_base_command(self):
         args = []
         if self.user:
             args += ["--username=%s" % self.user]
@@ -386,17 +959,418 @@ class Command(BaseBackupCommand):
         if self.db:
             args += [self.db]
         pgdump_path = getattr(settings, 'BACKUP_PG_DUMP_PATH', 'pg_dump')
+        return '%s %s' % (pgdump_path, ' '.join(args))
 
-        if self.passwd:
-            os.environ['PGPASSWORD'] = self.passwd
+    def get_postgresql_dump_command(self):
         table_args = ' '.join(
             '-t %s ' % table for table in self.get_tables_for_apps(*self.apps)
         )
         if table_args:
             table_args = '-a %s' % table_args
-        pgdump_cmd = '%s %s %s > %s' % (pgdump_path, ' '.join(args), table_args or '--clean', outfile)
-        self.stdout.write(pgdump_cmd)
-        os.system(pgdump_cmd)
+        return '%s %s' % (self.get_postgresql_base_command(), table_args or '--clean')
+
+    def get_postgresql_archive_command(self, pg_format, extra_args=()):
+        """
+        Return the pg_dump command writing a custom or directory format
+        archive, of the tables of --application if given.
+        """
+        args = ['--format=%s' % pg_format]
+        if self.compress or self.repository:
+            # Our codec compresses it faster, and the repository deduplicates
+            # better without pg_dump's compression.
+            args.append('--compress=0')
+        args += ['--table=%s' % table for table in self.get_tables_for_apps(*self.apps)]
+        args += list(extra_args)
+        return '%s %s' % (self.get_postgresql_base_command(), ' '.join(args))
+
+    def do_postgresql_archive_backup(self, outfile):
+        """
+        Dump the database with pg_dump in the --pg-format archive format.
+        pg_restore can load these in parallel and pick single tables out of
+        them. A directory format dump, made with --parallel concurrent
+        jobs, is bundled into the tar archive ``outfile``.
+        """
+        if self.pg_format == 'custom':
+            command = self.get_postgresql_archive_command('custom')
+            self.stdout.write('Running Command: %s > %s' % (command, outfile))
+            self.check_dump_results([(os.path.basename(outfile), command)], [dump_to_file(command, outfile, env=self.get_environ())])
+            return
+
+        workdir = tempfile.mkdtemp(prefix='.pgdir_', dir=self.backup_dir)
+        try:
+            dumpdir = os.path.join(workdir, 'dump')
+            extra_args = ['--file=%s' % dumpdir]
+            if self.parallel:
+                extra_args.append('--jobs=%s' % self.parallel)
+            command = self.get_postgresql_archive_command('directory', extra_args)
+            self.stdout.write('Running Command: %s' % command)
+            self.check_dump_results([(os.path.basename(outfile), command)], [subprocess.call(command, shell=True, env=self.get_environ())])
+            archive = tarfile.open(outfile, 'w')
+            try:
+                for name in sorted(os.listdir(dumpdir)):
+                    archive.add(os.path.join(dumpdir, name), name)
+            finally:
+                archive.close()
+        finally:
+            shutil.rmtree(workdir)
+
+    def get_tables_to_dump(self):
+        """
+        Tables whose data goes into a parallel backup: the tables of the
+        requested apps, or all tables, minus BACKUP_TABLES_BLACKLIST.
+        """
+        if self.apps:
+            tables = self.get_tables_for_apps(*self.apps)
+        else:
+            tables = self.db_connection.introspection.table_names()
+        blacklist_tables = set(self.get_blacklist_tables())
+        return [table for table in tables if table not in blacklist_tables]
+
+    def do_parallel_backup(self, outfile):
+        """
+        Dump the database table by table with --parallel concurrent dumpers
+        that all read the same consistent snapshot. The dump files are bundled
+        with a manifest into the tar archive ``outfile``.
+
+        The manifest lists the files as a sequence of steps. Steps have to be
+        restored in order, the files of a single step are independent.
+        """
+        tables = self.get_tables_to_dump()
+        is_mysql = self.engine == 'django.db.backends.mysql' or 'mysql' in self.engine
+        if self.skip_unchanged and is_mysql:
+            self.table_cache = TableCache(
+                os.path.join(self.table_cache_path or os.path.join(self.backup_dir, TABLE_CACHE_NAME), self.alias)
+            )
+        elif self.skip_unchanged:
+            # PostgreSQL's table statistics are collected asynchronously and
+            # lag behind committed writes, nothing cheap tells for sure that
+            # a table didn't change.
+            self.stdout.write('--skip-unchanged only applies to MySQL, dumping every table')
+        workdir = tempfile.mkdtemp(prefix='.parallel_', dir=self.backup_dir)
+        try:
+            if is_mysql:
+                steps = self.do_mysql_parallel_backup(workdir, tables)
+            elif self.engine == 'django.db.backends.postgresql_psycopg2':
+                steps = self.do_postgresql_parallel_backup(workdir, tables)
+            else:
+                raise CommandError('Backup in %s engine not implemented' % self.engine)
+
+            manifest = {
+                'engine': self.engine,
+                'steps': [step for step in steps if step],
+            }
+            if self.binlog_position:
+                manifest['binlog'] = self.binlog_position
+            with open(os.path.join(workdir, MANIFEST_NAME), 'w') as manifest_file:
+                json.dump(manifest, manifest_file, indent=2)
+
+            archive = tarfile.open(outfile, 'w')
+            try:
+                archive.add(os.path.join(workdir, MANIFEST_NAME), MANIFEST_NAME)
+                for step in manifest['steps']:
+                    for name in step:
+                        archive.add(os.path.join(workdir, name), name)
+            finally:
+                archive.close()
+            if self.table_cache:
+                self.table_cache.update(workdir, dict((table, table_file_name('data_', table)) for table in tables))
+        finally:
+            shutil.rmtree(workdir)
+
+    def do_postgresql_parallel_backup(self, workdir, tables):
+        """
+        Export a snapshot from our own connection and let one pg_dump per
+        table import it, so every table is dumped as of the same moment.
+        The snapshot stays valid until the surrounding transaction ends.
+        """
+        with transaction.atomic(using=self.alias):
+            cursor = self.db_connection.cursor()
+            cursor.execute('SELECT pg_export_snapshot()')
+            snapshot = cursor.fetchone()[0]
+            self.stdout.write('Exported snapshot %s' % snapshot)
+            base = '%s --snapshot=%s' % (self.get_postgresql_base_command(), snapshot)
+
+            jobs = [
+                ('data_%s.sql' % table, '%s --data-only --table=%s' % (base, table))
+                for table in tables
+            ]
+            if not self.apps:
+                # Indexes and constraints go after the data so that loading
+                # doesn't trip over foreign keys.
+                jobs.append(('pre-data.sql', '%s --section=pre-data --clean' % base))
+                jobs.append(('post-data.sql', '%s --section=post-data' % base))
+            self.run_dump_jobs(workdir, jobs)
+
+        pre_data = [] if self.apps else ['pre-data.sql']
+        post_data = [] if self.apps else ['post-data.sql']
+        return [pre_data, [name for name, _ in jobs if name.startswith('data_')], post_data]
+
+    def do_mysql_parallel_backup(self, workdir, tables):
+        """
+        Split the tables over --parallel mysqldump processes, balanced by size.
+
+        MySQL can't hand a snapshot from one connection to another, so we hold
+        a global read lock while the dumpers open their --single-transaction
+        snapshots and release it as soon as every one of them has started
+        dumping. Writers are blocked only for that short moment.
+
+        The output is shaped for a parallel restore, see django_backup.mysql:
+        the schema without secondary indexes and foreign keys, one data file
+        per table, one file per table adding its indexes back and a file
+        adding the foreign keys back.
+        """
+        base = '%s %s' % (getattr(settings, 'BACKUP_SQLDUMP_PATH', 'mysqldump'), ' '.join(self.get_mysql_dump_args()))
+
+        cursor = self.db_connection.cursor()
+        cursor.execute(
+            'SELECT table_name, data_length + index_length FROM information_schema.tables'
+            ' WHERE table_schema = DATABASE()'
+        )
+        sizes = dict(cursor.fetchall())
+
+        results = []
+        cursor.execute('FLUSH TABLES WITH READ LOCK')
+        try:
+            # Nothing is written while the lock is held, so the snapshots of
+            # the dumpers are consistent with the binary log position and
+            # the table signatures read here.
+            if self.mysql_binlogs:
+                cursor.execute('SHOW MASTER STATUS')
+                self.binlog_position = list(cursor.fetchone()[:2])
+            unchanged = []
+            if self.table_cache:
+                unchanged = self.table_cache.unchanged(self.get_mysql_table_signatures(cursor, tables))
+            jobs = self.get_mysql_parallel_jobs(base, [table for table in tables if table not in unchanged], sizes)
+            outfiles = [
+                TableSplitter(workdir) if name.startswith('data_') else os.path.join(workdir, name)
+                for name, _, _ in jobs
+            ]
+            started = [threading.Event() for _ in jobs]
+            if jobs:
+                pool = ThreadPool(len(jobs))
+                results = [
+                    pool.apply_async(dump_to_file, (command, outfile, event, marker))
+                    for (name, command, marker), outfile, event in zip(jobs, outfiles, started)
+                ]
+                pool.close()
+            for event in started:
+                event.wait()
+        finally:
+            cursor.execute('UNLOCK TABLES')
+        self.check_dump_results(jobs, [result.get() for result in results])
+
+        data = [name for outfile in outfiles if isinstance(outfile, TableSplitter) for name in outfile.names]
+        if unchanged:
+            self.stdout.write('Reusing the dumps of %s unchanged tables' % len(unchanged))
+            data += self.table_cache.copy(unchanged, workdir)
+        data.sort()
+        if self.apps:
+            return [data]
+        return [['schema.sql'], data] + self.defer_mysql_indexes(workdir)
+
+    def get_mysql_parallel_jobs(self, base, tables, sizes):
+        """
+        Return the (filename, command, marker) jobs dumping the data of
+        ``tables`` split over --parallel mysqldump processes, balanced by
+        their ``sizes``, and the schema.
+        """
+        groups = [[] for _ in range(self.parallel)]
+        group_sizes = [0] * self.parallel
+        for table in sorted(tables, key=lambda t: sizes.get(t) or 0, reverse=True):
+            i = group_sizes.index(min(group_sizes))
+            groups[i].append(table)
+            group_sizes[i] += sizes.get(table) or 0
+
+        jobs = [
+            ('data_%02d' % i, '%s --single-transaction --no-create-info %s' % (base, ' '.join(group)),
+             MYSQLDUMP_DATA_MARKER)
+            for i, group in enumerate(groups) if group
+        ]
+        if not self.apps:
+            jobs.append(('schema.sql', '%s --single-transaction --no-data' % base, MYSQLDUMP_SCHEMA_MARKER))
+        return jobs
+
+    def get_mysql_table_signatures(self, cursor, tables):
+        """
+        Return the signatures of ``tables`` for the table cache: their last
+        update time and columns. InnoDB forgets update times on restart, and
+        another write in the second the signature is read wouldn't change
+        it, so a table without, or updated in that second, has no signature.
+        MySQL 8 caches table statistics for information_schema_stats_expiry
+        seconds, the cache is bypassed.
+        """
+        cursor.execute("SHOW VARIABLES LIKE 'information_schema_stats_expiry'")
+        if cursor.fetchall():
+            cursor.execute('SET SESSION information_schema_stats_expiry = 0')
+        cursor.execute('SELECT NOW()')
+        now = str(cursor.fetchone()[0])
+        cursor.execute(
+            'SELECT table_name, update_time FROM information_schema.tables WHERE table_schema = DATABASE()'
+        )
+        update_times = dict((table, update_time and str(update_time)) for table, update_time in cursor.fetchall())
+        columns = self.get_table_columns(cursor, 'DATABASE()')
+        signatures = {}
+        for table in tables:
+            update_time = update_times.get(table)
+            signatures[table] = [update_time, columns.get(table)] if update_time and update_time < now else None
+        return signatures
+
+    def get_table_columns(self, cursor, schema):
+        """
+        Return a dict mapping the tables of ``schema`` to a list of their
+        columns and types.
+        """
+        cursor.execute(
+            'SELECT table_name, column_name, data_type FROM information_schema.columns'
+            ' WHERE table_schema = %s ORDER BY table_name, ordinal_position' % schema
+        )
+        columns = {}
+        for table, column, data_type in cursor.fetchall():
+            columns.setdefault(table, []).append('%s %s' % (column, data_type))
+        return columns
+
+    def defer_mysql_indexes(self, workdir):
+        """
+        Move the secondary indexes and foreign keys out of schema.sql into
+        files of their own. Returns the steps restoring them.
+        """
+        schema_path = os.path.join(workdir, 'schema.sql')
+        with io.open(schema_path, encoding='utf-8') as schema_file:
+            schema, indexes, constraints = defer_indexes(schema_file.read())
+        with io.open(schema_path, 'w', encoding='utf-8') as schema_file:
+            schema_file.write(schema)
+        for table, statement in indexes.items():
+            with io.open(os.path.join(workdir, table_file_name('indexes_', table)), 'w', encoding='utf-8') as out:
+                out.write(statement)
+        if constraints:
+            with io.open(os.path.join(workdir, 'constraints.sql'), 'w', encoding='utf-8') as out:
+                out.write(u'SET foreign_key_checks=0;\n' + u''.join(constraints))
+        return [
+            sorted(table_file_name('indexes_', table) for table in indexes),
+            ['constraints.sql'] if constraints else [],
+        ]
+
+    def run_dump_jobs(self, workdir, jobs):
+        """
+        Run (filename, command) dump jobs on a pool of --parallel threads.
+        """
+        environ = self.get_environ()
+        pool = ThreadPool(self.parallel)
+        try:
+            results = pool.map(
+                lambda job: dump_to_file(job[1], os.path.join(workdir, job[0]), env=environ), jobs
+            )
+        finally:
+            pool.close()
+        self.check_dump_results(jobs, results)
+
+    def check_dump_results(self, jobs, results):
+        for job, returncode in zip(jobs, results):
+            if returncode:
+                raise CommandError('Dumping %s failed with exit code %s' % (job[0], returncode))
+
+    def do_stream_backup(self, outfile):
+        """
+        Pipe the output of the database dumper through the compression and
+        encryption stages straight into the remote file and, unless --nolocal is given, into the
+        local backup file. Nothing but a buffer of BACKUP_BUFFER_SIZE bytes is
+        held at any time and no intermediate file is written.
+
+        Returns the name of the resulting backup file.
+        """
+        manifest_name = os.path.basename(outfile) + MANIFEST_EXTENSION
+        outfile += self.get_extension()
+        stages = self.get_stages()
+        filename = os.path.basename(outfile)
+
+        targets = []
+        local_file = remote_file = None
+        try:
+            if not self.no_local:
+                local_file = open(outfile, 'wb')
+                targets.append(local_file)
+            if self.repository:
+                # The repository chunks the plain dump and compresses every new
+                # chunk on its own, so only the local copy goes through `stages`.
+                targets = [StageWriter(target, stages) for target in targets]
+                stages = []
+                filename = manifest_name
+                repository = self.get_repository()
+                self.make_remote_dir()
+                previous = latest_manifest([
+                    name for name in self.get_connection().listdir(self.remote_dir or '.')
+                    if get_db_alias(name) == self.alias
+                ])
+                self.stdout.write('Storing dump in repository as %s, deduplicating against %s' % (filename, previous))
+                writer = repository.writer(filename, previous and repository.read_manifest(previous))
+                targets.append(writer)
+            elif self.ftp:
+                sftp = self.get_connection()
+                self.make_remote_dir()
+                # Upload under a temporary name so that a broken stream never
+                # looks like a complete backup to restore or cleanup.
+                remote_path = os.path.join(self.remote_dir or '', filename)
+                partial_path = os.path.join(self.remote_dir or '', partial_name(filename))
+                remote_file = sftp.open(partial_path, 'wb')
+                remote_file.set_pipelined(True)
+                targets.append(remote_file)
+
+            if self.use_catalog and not self.repository:
+                digest = DigestWriter()
+                targets.append(digest)
+
+            command = self.get_dump_command()
+            self.stdout.write('Running Command: %s | <stream> %s' % (command, filename))
+            with self.stage('stream') as stage:
+                process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, env=self.get_environ())
+                sink = MultiWriter(*targets)
+                try:
+                    stage.bytes_in = pump(process.stdout, sink, stages, buffer_size=self.buffer_size)
+                finally:
+                    process.stdout.close()
+                    sink.close()
+                stage.bytes_out = sink.size
+                returncode = process.wait()
+                if returncode:
+                    raise CommandError('Database dump failed with exit code %s' % returncode)
+            if self.repository:
+                # The catalog describes the manifest, the file named filename.
+                size, sha256 = writer.commit()
+                self.stdout.write('Uploaded %s bytes of new chunks for a %s bytes dump' % (writer.uploaded, writer.size))
+            elif self.ftp:
+                sftp.rename(partial_path, remote_path)
+        except BaseException:
+            # Neither a truncated local file nor a partial upload should stay
+            # around, interrupted or not.
+            self.remove_stream_leftovers(local_file, remote_file, remote_file and partial_path)
+            raise
+        if self.use_catalog and self.repository:
+            self.catalog_add([describe_backup(filename, size, sha256)])
+        elif self.use_catalog and self.ftp:
+            self.catalog_add([describe_backup(filename, digest.size, digest.hexdigest())])
+        return outfile
+
+    def remove_stream_leftovers(self, local_file=None, remote_file=None, remote_path=None):
+        """
+        Close and remove what a failed stream backup wrote: ``local_file``
+        and ``remote_file``, uploaded to ``remote_path``.
+        """
+        if local_file is not None:
+            local_file.close()
+            os.remove(local_file.name)
+        if remote_file is not None:
+            try:
+                remote_file.close()
+                self.get_connection().remove(remote_path)
+            except EnvironmentError:
+                pass
+
+    def get_repository(self):
+        return Repository(
+            self.get_connection(), self.remote_dir,
+            codec=self.codec if self.compress else None, level=self.compress_level,
+            chunk_size=self.repository_chunk_size,
+        )
 
     def clean_local_surplus_db(self):
         try:
@@ -405,9 +1379,12 @@ class Command(BaseBackupCommand):
             backups.sort()
             self.stdout.write('=' * 70)
             self.stdout.write('local db backups found: %s' % backups)
-            remove_list = decide_remove(backups, settings.BACKUP_DATABASE_COPIES)
+            remove_list = decide_remove_db(backups, settings.BACKUP_DATABASE_COPIES)
             self.stdout.write('=' * 70)
             self.stdout.write('local db backups to clean %s' % remove_list)
+            if self.dry_run:
+                self.write_retention_plan(backups, remove_list, settings.BACKUP_DATABASE_COPIES)
+                return
             remove_all = ' '.join([os.path.join(self.backup_dir, i) for i in remove_list])
             if remove_all:
                 self.stdout.write('=' * 70)
@@ -422,24 +1399,62 @@ class Command(BaseBackupCommand):
     def clean_remote_surplus_db(self):
         try:
             sftp = self.get_connection()
-            backups = [i.strip() for i in sftp.listdir(self.remote_dir)]
+            backups = self.list_remote_backups(self.remote_dir)
             backups = list(filter(is_db_backup, backups))
             backups.sort()
             self.stdout.write('=' * 70)
             self.stdout.write('remote db backups found: %s' % backups)
-            remove_list = decide_remove(backups, settings.BACKUP_DATABASE_COPIES)
+            remove_list = decide_remove_db(backups, settings.BACKUP_DATABASE_COPIES)
             self.stdout.write('=' * 70)
             self.stdout.write('remote db backups to clean %s' % remove_list)
+            if self.dry_run:
+                self.write_retention_plan(backups, remove_list, settings.BACKUP_DATABASE_COPIES)
+                return
             if remove_list:
                 self.stdout.write('=' * 70)
                 self.stdout.write('cleaning up remote db backups')
-                for file_ in remove_list:
-                    target_path = os.path.join(self.remote_dir, file_)
-                    self.stdout.write('Removing {}'.format(target_path))
-                    sftp.remove(target_path)
+                self.remove_remote_backups(remove_list)
+            repository = Repository(sftp, self.remote_dir)
+            if repository.exists():
+                self.stdout.write('=' * 70)
+                self.stdout.write('collecting garbage in remote repository')
+                manifests = [i for i in backups if is_manifest(i) and i not in remove_list]
+                removed = repository.collect_garbage(manifests)
+                self.stdout.write('removed %s unreferenced chunks' % len(removed))
         except ImportError:
             self.stderr.writeln('cleaned nothing, because BACKUP_DATABASE_COPIES is missing')
 
+    def remove_remote_backups(self, remove_list):
+        """
+        Remove backups from the remote directory, sending every removal on
+        the connection before waiting for the answers.
+        """
+        paths = [os.path.join(self.remote_dir, file_) for file_ in remove_list]
+        for target_path in paths:
+            self.stdout.write('Removing {}'.format(target_path))
+        # rsync backups are directories, which SFTP only removes when empty.
+        directories = [path for file_, path in zip(remove_list, paths) if is_rsync_backup(file_)]
+        if directories:
+            self.get_connection().execute('rm -rf %s' % ' '.join(directories))
+        failed = remove_many(self.get_connection(), [path for path in paths if path not in directories])
+        self.catalog_remove([file_ for file_, path in zip(remove_list, paths) if path not in failed])
+        if failed:
+            for path in sorted(failed):
+                self.stderr.write('Could not remove %s: %s' % (path, failed[path]))
+            raise CommandError('Could not remove %s remote backups' % len(failed))
+
+    def write_retention_plan(self, backups, remove_list, config):
+        self.stdout.write('--dry-run, nothing is removed:')
+        for alias, group in sorted(group_by_alias(backups).items()):
+            # Incremental media archives, shards and binary log backups share
+            # the fate of their full backup and manifest.
+            full_backups = [
+                backup for backup in group
+                if not is_incremental(backup) and not is_shard(backup) and not is_log_backup(backup)
+            ]
+            for line in RetentionPlan(full_backups, config).describe(group, remove_list):
+                self.stdout.write('\t%s' % line)
+
     def clean_surplus_db(self):
         self.clean_local_surplus_db()
         self.clean_remote_surplus_db()
@@ -456,9 +1471,12 @@ class Command(BaseBackupCommand):
             backups.sort()
             self.stdout.write('=' * 70)
             self.stdout.write('local media backups found: %s' % backups)
-            remove_list = decide_remove(backups, settings.BACKUP_MEDIA_COPIES)
+            remove_list = decide_remove_media(backups, settings.BACKUP_MEDIA_COPIES)
             self.stdout.write('=' * 70)
             self.stdout.write('local media backups to clean %s' % remove_list)
+            if self.dry_run:
+                self.write_retention_plan(backups, remove_list, settings.BACKUP_MEDIA_COPIES)
+                return
             remove_all = ' '.join([os.path.join(self.backup_dir, i) for i in remove_list])
             if remove_all:
                 self.stdout.write('=' * 70)
@@ -472,22 +1490,21 @@ class Command(BaseBackupCommand):
 
     def clean_remote_surplus_media(self):
         try:
-            sftp = self.get_connection()
-            backups = [i.strip() for i in sftp.listdir(self.remote_dir)]
+            backups = self.list_remote_backups(self.remote_dir)
             backups = list(filter(is_media_backup, backups))
             backups.sort()
             self.stdout.write('=' * 70)
             self.stdout.write('remote media backups found: %s' % backups)
-            remove_list = decide_remove(backups, settings.BACKUP_MEDIA_COPIES)
+            remove_list = decide_remove_media(backups, settings.BACKUP_MEDIA_COPIES)
             self.stdout.write('=' * 70)
             self.stdout.write('remote media backups to clean %s' % remove_list)
+            if self.dry_run:
+                self.write_retention_plan(backups, remove_list, settings.BACKUP_MEDIA_COPIES)
+                return
             if remove_list:
                 self.stdout.write('=' * 70)
                 self.stdout.write('cleaning up remote media backups')
-                for file_ in remove_list:
-                    target_path = os.path.join(self.remote_dir, file_)
-                    self.stdout.write('Removing {}'.format(target_path))
-                    sftp.remove(target_path)
+                self.remove_remote_backups(remove_list)
         except ImportError:
             self.stderr.writeln('cleaned nothing, because BACKUP_MEDIA_COPIES is missing')
 
@@ -524,21 +1541,22 @@ class Command(BaseBackupCommand):
                 'all_directories': self.all_directories,
                 'host': host,
                 'remote_backup_target': remote_backup_target,
-                'rsync_flag': GOOD_RSYNC_FLAG,
             }
             
             remote_rsync_cmd = 'rsync -az --copy-dirlinks --link-dest=%(remote_current_backup)s %(all_directories)s %(host)s:%(remote_backup_target)s' % remote_info
-            remote_mark_cmd = 'ssh %(host)s "touch %(remote_backup_target)s/%(rsync_flag)s"' % remote_info
-            remote_link_cmd = 'ssh %(host)s "rm -f %(remote_current_backup)s && ln -s %(remote_backup_target)s %(remote_current_backup)s"' % remote_info
-            
-            cmd = '\n'.join(['%s&&%s' % (remote_rsync_cmd, remote_mark_cmd), remote_link_cmd])
-            self.stdout.write(cmd)
+            self.stdout.write(remote_rsync_cmd)
+            self.make_remote_dir()
+            # Marking and linking go over the SFTP connection rather than two
+            # more ssh processes.
             sftp = self.get_connection()
+            if os.system(remote_rsync_cmd) == 0:
+                sftp.open(os.path.join(remote_backup_target, GOOD_RSYNC_FLAG), 'w').close()
+                self.catalog_add([describe_backup(os.path.basename(remote_backup_target))])
             try:
-                sftp.mkdir(self.remote_dir)
+                sftp.remove(remote_current_backup)
             except IOError:
                 pass
-            os.system(cmd)
+            sftp.symlink(remote_backup_target, remote_current_backup)
 
     def clean_broken_rsync(self):
         self.clean_local_broken_rsync()
@@ -559,7 +1577,8 @@ class Command(BaseBackupCommand):
 
         full_cmd = '\n'.join(commands)
         self.stdout.write(full_cmd)
-        sftp.execute(full_cmd)
+        if not self.dry_run:
+            sftp.execute(full_cmd)
 
     def clean_local_broken_rsync(self):
         # local(web server)
@@ -575,4 +1594,5 @@ class Command(BaseBackupCommand):
             commands.append(cmd)
         full_cmd = '\n'.join(commands)
         self.stdout.write(full_cmd)
-        os.system(full_cmd)
+        if not self.dry_run:
+            os.system(full_cmd)
@@ -0,0 +1,60 @@
+import hashlib
+import os
+import stat
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from django_backup.catalog import Catalog
+from django_backup.streams import BUFFER_SIZE
+from django_backup.utils import GOOD_RSYNC_FLAG, BaseBackupCommand, describe_backup, is_backup
+
+
+class Command(BaseBackupCommand):
+
+    help = "Recreates the remote backup catalog from a listing of the remote directory."
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--checksum',
+            action='store_true', default=False, dest='checksum',
+            help='Read every backup to record its checksum as well (slow)'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            self._handle(*args, **options)
+        finally:
+            self.close_connection()
+
+    def _handle(self, *args, **options):
+        sftp = self.get_connection()
+        self.stdout.write('Listing %s...' % (self.remote_dir or '.'))
+        entries = []
+        for attributes in sftp.listdir_attr(self.remote_dir or '.'):
+            name = attributes.filename
+            if not is_backup(name):
+                continue
+            if stat.S_ISDIR(attributes.st_mode):
+                # An rsync media backup, cataloged once it's complete.
+                if sftp.exists(os.path.join(self.remote_dir or '', name, GOOD_RSYNC_FLAG)):
+                    entries.append(describe_backup(name))
+                continue
+            sha256 = None
+            if options.get('checksum'):
+                self.stdout.write('\tchecksumming %s' % name)
+                sha256 = self.remote_hash(os.path.join(self.remote_dir or '', name))
+            entries.append(describe_backup(name, attributes.st_size, sha256))
+        Catalog(sftp, self.remote_dir).rewrite(sorted(entries, key=lambda entry: entry['name']))
+        self.stdout.write('Cataloged %s backups' % len(entries))
+
+    def remote_hash(self, path):
+        digest = hashlib.sha256()
+        with self.get_connection().open(path, 'rb') as remote_file:
+            remote_file.prefetch()
+            while True:
+                data = remote_file.read(BUFFER_SIZE)
+                if not data:
+                    break
+                digest.update(data)
+        return digest.hexdigest()
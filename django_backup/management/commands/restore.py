@@ -1,11 +1,33 @@
+import json
 import os
+import shutil
+import subprocess
+import tarfile
+import threading
 import time
+from datetime import datetime
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from optparse import make_option
-from tempfile import gettempdir
+from tempfile import gettempdir, mkdtemp
 
+from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 
-from django_backup.utils import BaseBackupCommand, TIME_FORMAT, is_db_backup, is_media_backup
+from django_backup.binlog import check_sequence, format_until, get_log_chain, read_position
+from django_backup.crypto import EXTENSION as ENCRYPTED_EXTENSION, DecryptionError, DecryptStage
+from django_backup.media import apply_incremental_archive, get_restore_chain, is_incremental
+from django_backup.metrics import path_size
+from django_backup.repository import MANIFEST_EXTENSION, Repository, is_manifest
+from django_backup.shards import extract_shards, is_shard_manifest, read_manifest
+from django_backup.sqlite import EXTENSION as SQLITE_EXTENSION, copy_database
+from django_backup.storage import extract_to_storage
+from django_backup.streams import (
+    CODECS, DecompressStage, DetectDecompressStage, MultiWriter, StageWriter, detect_codec, pump,
+)
+from django_backup.utils import (
+    BaseBackupCommand, MANIFEST_NAME, TIME_FORMAT, get_db_alias, get_pg_format, is_db_backup, is_media_backup,
+)
 
 
 class Command(BaseBackupCommand):
@@ -22,6 +44,40 @@ class Command(BaseBackupCommand):
             action='store_true', default=False, dest='no_database',
             help='Do not restore database'
         ),
+        make_option(
+            '--stream', '-s',
+            action='store_true', default=False, dest='stream',
+            help='Pipe the database backup from the remote server through decompression straight into the '
+                 'database client, without temporary files'
+        ),
+        make_option(
+            '--database',
+            action='append', default=[], dest='databases',
+            help='Restore this database of settings.DATABASES from its latest backup, can be repeated, '
+                 'defaults to BACKUP_DATABASES'
+        ),
+        make_option(
+            '--all-databases',
+            action='store_true', default=False, dest='all_databases',
+            help='Restore every database of settings.DATABASES'
+        ),
+        make_option(
+            '--jobs', '-j',
+            type='int', default=None, dest='jobs',
+            help='Load data and build indexes of --parallel and PostgreSQL custom and directory format backups '
+                 'with this many parallel jobs, defaults to the number of cores'
+        ),
+        make_option(
+            '--table', '-t',
+            action='append', default=[], dest='tables',
+            help='Only restore this table of a PostgreSQL custom or directory format backup, can be repeated'
+        ),
+        make_option(
+            '--until',
+            default=None, dest='until',
+            help='Restore the latest backup taken before this time, given as YYYYMMDD-HHMMSS, and replay the '
+                 'MySQL binary logs shipped after it up to then'
+        ),
     )
 
     @staticmethod
@@ -29,17 +85,33 @@ class Command(BaseBackupCommand):
         return time.strftime(TIME_FORMAT)
 
     def handle(self, *args, **options):
+        try:
+            with self.reporting('restore'):
+                self._handle(*args, **options)
+        finally:
+            self.close_connection()
+
+    def _handle(self, *args, **options):
 
         self.restore_media = options.get('media')
         self.no_restore_database = options.get('no_database')
+        self.stream = options.get('stream')
+        self.encrypt_password = os.environ.get('BACKUP_PASSWORD')
+        self.jobs = options.get('jobs') or cpu_count()
+        self.tables = options.get('tables') or []
+        self.until = options.get('until')
+        if self.until:
+            try:
+                self.until = datetime.strptime(self.until, TIME_FORMAT)
+            except ValueError:
+                raise CommandError('--until takes a time like %s, not %s.' % (self._time_suffix(), self.until))
         self.stdout.write('Connecting to %s...' % self.ftp_server)
-        sftp = self.get_connection()
+        self.get_connection()
         self.stdout.write('Connected.')
         try:
-            dir_list = sftp.listdir(self.remote_restore_dir)
+            backups = self.list_remote_backups(self.remote_restore_dir)
         except IOError:
             raise CommandError("Remote directory %s does not exist" % self.remote_restore_dir)
-        backups = [i.strip() for i in dir_list]
         db_backups = list(filter(is_db_backup, backups))
         db_backups.sort()
 
@@ -52,51 +124,464 @@ class Command(BaseBackupCommand):
 
         self.tempdir = gettempdir()
 
+        # The latest full backup of every database, and the binary logs
+        # shipped after it.
+        databases = []
+        db_remotes = {}
+        db_logs = {}
         if not self.no_restore_database:
-            db_remote = db_backups[-1]
+            databases = self.get_database_commands(self.get_database_aliases(options))
+            for database in databases:
+                database_backups = [backup for backup in db_backups if get_db_alias(backup) == database.alias]
+                chain = get_log_chain(database_backups, self.until)
+                if not chain:
+                    raise CommandError('No backup of database %s in %s%s' % (
+                        database.alias, self.remote_restore_dir,
+                        ' before %s' % options['until'] if self.until else ''))
+                db_remotes[database.alias] = chain[0]
+                db_logs[database.alias] = chain[1:]
+                if db_logs[database.alias] and self.stream:
+                    raise CommandError('--stream can not replay the binary logs shipped after %s.' % chain[0])
 
-            db_local = os.path.join(self.tempdir, db_remote)
-            self.stdout.write('Fetching database %s...' % db_remote)
-            sftp.get(os.path.join(self.remote_restore_dir, db_remote), db_local)
-            # unpacking zipfile
-            if os.path.splitext(db_local)[1] == '.zip':
-                db_local = self.unzip(db_local)
-            self.stdout.write('Uncompressing database...')
-            uncompressed = self.uncompress(db_local)
-
-            if uncompressed is 0:
-                sql_local = db_local[:-3]
-            else:
-                sql_local = db_local
+        # The databases and every media archive are downloaded at once, their
+        # ranges sharing the connections of one transfer.
+        downloads = []
+        for database in databases:
+            downloads += database.get_database_downloads(db_remotes[database.alias])
+            downloads += [
+                (os.path.join(self.remote_restore_dir, log), os.path.join(self.tempdir, log))
+                for log in db_logs[database.alias]
+            ]
 
+        media_locals = []
+        media_size = 0
         if self.restore_media:
-            self.stdout.write('Fetching media %s...' % media_remote)
-            media_local = os.path.join(self.tempdir, media_remote)
             media_remote_full_path = os.path.join(self.remote_restore_dir, media_remote)
+            media_is_folder = self.is_folder(media_remote_full_path)
+            if not media_is_folder:
+                # An incremental archive needs the full archive it's based on
+                # and every incremental archive in between.
+                for media_remote in get_restore_chain(media_backups):
+                    media_local = os.path.join(self.tempdir, media_remote)
+                    if is_shard_manifest(media_remote):
+                        # The manifest tells which shards to fetch.
+                        self.get_connection().get(os.path.join(self.remote_restore_dir, media_remote), media_local)
+                        downloads += self.get_shard_downloads(media_local)
+                        media_size += sum(shard['size'] for shard in read_manifest(media_local))
+                    else:
+                        downloads.append((os.path.join(self.remote_restore_dir, media_remote), media_local))
+                    media_locals.append(media_local)
 
+        if downloads:
+            self.stdout.write('Fetching %s...' % ', '.join(os.path.basename(local) for remote, local in downloads))
+            transfer = self.get_transfer()
+            with self.stage('download') as stage:
+                transfer.get(downloads)
+                stage.bytes_out = sum(path_size(local) for remote, local in downloads)
+                stage.retries = transfer.retried
+
+        if self.restore_media:
             # Check if the media is compressed or a folder
-            if self.is_folder(media_remote_full_path):
+            if media_is_folder:
                 media_dir = os.path.join(media_remote_full_path, "media")
                 # A trailing slash to transfer only the contents of the folder
                 remote_rsync = '%s@%s:%s/' % (self.ftp_username, self.ftp_server, media_dir)
                 rsync_restore_cmd = 'rsync -az %s %s' % (remote_rsync, self.directory_to_backup)
                 self.stdout.write('Running rsync restore command: %s' % rsync_restore_cmd)
-                os.system(rsync_restore_cmd)
+                with self.stage('media_rsync'):
+                    os.system(rsync_restore_cmd)
             else:
-                sftp.get(media_remote_full_path, media_local)
-                self.stdout.write('Uncompressing media...')
-                self.uncompress_media(media_local)
+                media_size += sum(
+                    path_size(media_local) for media_local in media_locals if not is_shard_manifest(media_local)
+                )
+                with self.stage('media', media_size):
+                    for media_local in media_locals:
+                        self.stdout.write('Uncompressing media %s...' % media_local)
+                        self.uncompress_media(media_local)
+
         # Doing restore
-        if not self.no_restore_database:
+        if databases:
+            self.for_each_database(
+                databases, lambda database: database.restore_database(db_remotes[database.alias], db_logs[database.alias])
+            )
+
+    def get_database_downloads(self, db_remote):
+        """
+        Check that the backup ``db_remote`` can be restored as asked. Returns
+        the (remote, local) paths to download, none for --stream.
+        """
+        db_local = os.path.join(self.tempdir, db_remote)
+        if self.is_encrypted(db_remote) and not self.encrypt_password:
+            raise CommandError(
+                '%s is encrypted, please specify its password'
+                ' using the BACKUP_PASSWORD environment variable.' % db_remote
+            )
+        pg_format = get_pg_format(self.get_dump_name(db_remote))
+        if self.tables and not pg_format:
+            raise CommandError('--table needs a PostgreSQL custom or directory format backup, '
+                               'made with backup --pg-format.')
+        if self.stream:
+            if self.engine == 'django.db.backends.sqlite3':
+                raise CommandError('--stream can not restore SQLite databases')
+            if os.path.splitext(self.get_dump_name(db_remote))[1] == '.zip':
+                raise CommandError('--stream can not restore zip encrypted backups')
+            if pg_format == 'directory':
+                raise CommandError('--stream can not restore directory format backups')
+        elif not is_manifest(db_remote):
+            return [(os.path.join(self.remote_restore_dir, db_remote), db_local)]
+        return []
+
+    def restore_database(self, db_remote, logs=()):
+        """
+        Restore the database from the downloaded backup ``db_remote``, or
+        straight from the remote server with --stream, and replay the
+        downloaded binary log backups ``logs`` on top.
+        """
+        if self.stream:
+            self.stream_restore(db_remote)
+            return
+        db_local = os.path.join(self.tempdir, db_remote)
+        if is_manifest(db_remote):
+            db_local = db_local[:-len(MANIFEST_EXTENSION)]
+            self.stdout.write('Reassembling database %s from repository...' % db_remote)
+            with self.stage('reassemble') as stage:
+                with open(db_local, 'wb') as out:
+                    Repository(self.get_connection(), self.remote_restore_dir).restore(db_remote, out)
+                stage.bytes_out = path_size(db_local)
+        sql_local = self.unpack(db_local)
+        position = self.get_binlog_position(sql_local) if logs else None
+        with self.stage('restore', path_size(sql_local)):
+            if get_pg_format(sql_local):
+                self.pg_restore(sql_local)
+            elif os.path.splitext(sql_local)[1] == '.tar':
+                self.restore_archive(sql_local)
+            else:
+                self.restore_file(sql_local)
+        if logs:
+            self.replay_logs(logs, position)
+
+    def unpack(self, db_local):
+        """
+        Decrypt and uncompress the downloaded backup ``db_local``. Returns the
+        name of the plain file.
+        """
+        if self.is_encrypted(db_local):
+            self.stdout.write('Decrypting and uncompressing %s...' % os.path.basename(db_local))
+            with self.stage('decrypt+uncompress', path_size(db_local)) as stage:
+                sql_local = self.decrypt(db_local)
+                stage.bytes_out = path_size(sql_local)
+            return sql_local
+        # unpacking zipfile
+        if os.path.splitext(db_local)[1] == '.zip':
+            with self.stage('decrypt', path_size(db_local)) as stage:
+                db_local = self.unzip(db_local)
+                stage.bytes_out = path_size(db_local)
+        self.stdout.write('Uncompressing %s...' % os.path.basename(db_local))
+        with self.stage('uncompress', path_size(db_local)) as stage:
+            sql_local = self.uncompress(db_local)
+            stage.bytes_out = path_size(sql_local)
+        return sql_local
+
+    def get_binlog_position(self, filename):
+        """
+        Return the binary log file and position the MySQL backup ``filename``
+        was taken at, from the manifest of a --parallel backup or the top of
+        a dump.
+        """
+        if os.path.splitext(filename)[1] == '.tar':
+            archive = tarfile.open(filename)
+            try:
+                manifest = json.loads(archive.extractfile(MANIFEST_NAME).read().decode('utf-8'))
+            finally:
+                archive.close()
+            position = manifest.get('binlog')
+        else:
+            position = read_position(filename)
+        if not position:
+            raise CommandError('%s does not record its binary log position, binary logs can only be replayed on '
+                               'backups made with BACKUP_MYSQL_BINLOGS.' % os.path.basename(filename))
+        return position
+
+    def replay_logs(self, logs, position):
+        """
+        Feed the binary logs of the downloaded backups ``logs`` to mysql with
+        mysqlbinlog, from ``position`` on, and up to --until if given.
+        """
+        workdir = mkdtemp(dir=self.tempdir)
+        try:
+            names = set()
+            for log in logs:
+                log_local = self.unpack(os.path.join(self.tempdir, log))
+                archive = tarfile.open(log_local)
+                try:
+                    archive.extractall(workdir)
+                    names.update(archive.getnames())
+                finally:
+                    archive.close()
+                os.remove(log_local)
+            # Logs shipped before the full backup was taken aren't needed.
+            names = sorted(name for name in names if name >= position[0])
+            try:
+                check_sequence(names, position)
+            except ValueError as e:
+                raise CommandError(str(e))
+            args = ['--start-position=%s' % position[1]]
+            if self.until:
+                args.append("--stop-datetime='%s'" % format_until(self.until))
+            command = '%s %s %s | %s' % (
+                getattr(settings, 'BACKUP_MYSQLBINLOG_PATH', 'mysqlbinlog'), ' '.join(args),
+                ' '.join(os.path.join(workdir, name) for name in names), self.get_mysql_restore_command(),
+            )
+            self.stdout.write('Replaying binary logs %s to database %s...\n\t%s' % (', '.join(names), self.db, command))
+            with self.stage('binlog', sum(path_size(os.path.join(workdir, name)) for name in names)):
+                returncode = subprocess.call(command, shell=True, env=self.get_environ())
+            if returncode:
+                raise CommandError('Replaying binary logs failed with exit code %s' % returncode)
+        finally:
+            shutil.rmtree(workdir)
+
+    def restore_file(self, sql_local):
+        if self.engine == 'django.db.backends.mysql' or 'mysql' in self.engine:
+            self.stdout.write('Doing Mysql restore to database %s from %s...' % (self.db, sql_local))
+            self.mysql_restore(sql_local)
+        # TODO reinstate postgres support
+        elif self.engine == 'django.db.backends.postgresql_psycopg2':
+            self.stdout.write('Doing Postgresql restore to database %s from %s...' % (self.db, sql_local))
+            self.posgresql_restore(sql_local)
+        elif self.engine == 'django.db.backends.sqlite3':
+            self.stdout.write('Doing SQLite restore to database %s from %s...' % (self.db, sql_local))
+            self.sqlite_restore(sql_local)
+        else:
+            raise CommandError('Backup in %s engine not implemented' % self.engine)
+
+    def restore_archive(self, filename):
+        """
+        Restore a multi-file backup made by ``backup --parallel``, loading the
+        steps listed in its manifest one after the other. The files of a step
+        are independent and loaded by --jobs concurrent clients.
+        """
+        workdir = mkdtemp(dir=self.tempdir)
+        try:
+            self.stdout.write('Unpacking %s...' % filename)
+            archive = tarfile.open(filename)
+            try:
+                archive.extractall(workdir)
+            finally:
+                archive.close()
+            with open(os.path.join(workdir, MANIFEST_NAME)) as manifest_file:
+                manifest = json.load(manifest_file)
+            pool = ThreadPool(self.jobs)
+            try:
+                for step in manifest['steps']:
+                    pool.map(self.restore_file, [os.path.join(workdir, name) for name in step], 1)
+            finally:
+                pool.close()
+        finally:
+            shutil.rmtree(workdir)
+
+    def pg_restore(self, filename):
+        """
+        Load a custom or directory format backup with pg_restore, running
+        --jobs jobs in parallel. A directory format backup is unpacked first.
+        """
+        if get_pg_format(filename) == 'custom':
+            self.run_pg_restore(filename)
+            return
+        workdir = mkdtemp(dir=self.tempdir)
+        try:
+            self.stdout.write('Unpacking %s...' % filename)
+            archive = tarfile.open(filename)
+            try:
+                archive.extractall(workdir)
+            finally:
+                archive.close()
+            self.run_pg_restore(workdir)
+        finally:
+            shutil.rmtree(workdir)
+
+    def run_pg_restore(self, path):
+        command = self.get_pg_restore_command(path)
+        self.stdout.write('Doing Postgresql restore to database %s from %s...\n\t%s' % (self.db, path, command))
+        returncode = subprocess.call(command, shell=True, env=self.get_environ())
+        if returncode:
+            raise CommandError('pg_restore failed with exit code %s' % returncode)
+
+    def get_pg_restore_command(self, path=None):
+        """
+        Return the pg_restore command loading the archive ``path``, or stdin.
+        Objects are dropped before they're recreated, so restoring on top of
+        an existing database works.
+        """
+        args = [getattr(settings, 'BACKUP_PG_RESTORE_PATH', 'pg_restore'), '--clean', '--if-exists']
+        if self.user:
+            args.append('--username=%s' % self.user)
+        if self.host:
+            args.append('--host=%s' % self.host)
+        if self.port:
+            args.append('--port=%s' % self.port)
+        args.append('--dbname=%s' % self.db)
+        # pg_restore can only run jobs in parallel on a file it can seek in.
+        if path and self.jobs > 1:
+            args.append('--jobs=%s' % self.jobs)
+        args += ['--table=%s' % table for table in self.tables]
+        if path:
+            args.append(path)
+        return ' '.join(args)
+
+    def get_dump_name(self, db_remote):
+        """
+        Name of the dump ``db_remote`` holds, without manifest, encryption or
+        compression extension.
+        """
+        name = db_remote[:-len(MANIFEST_EXTENSION)] if is_manifest(db_remote) else db_remote
+        if self.is_encrypted(name):
+            name = name[:-len(ENCRYPTED_EXTENSION)]
+        for codec in CODECS.values():
+            if name.endswith(codec.extension):
+                return name[:-len(codec.extension)]
+        return name
+
+    def read_remote(self, db_remote, out):
+        """
+        Write the plain contents of the backup ``db_remote`` into the file-like
+        ``out`` as they arrive, decrypting and decompressing them on the way.
+        Returns the number of bytes written.
+        """
+        counter = MultiWriter(out)
+        writer = StageWriter(counter, self.get_decode_stages(db_remote))
+        if is_manifest(db_remote):
+            Repository(self.get_connection(), self.remote_restore_dir).restore(db_remote, writer)
+        else:
+            with self.get_connection().open(os.path.join(self.remote_restore_dir, db_remote), 'rb') as remote_file:
+                remote_file.prefetch()
+                pump(remote_file, writer, buffer_size=self.buffer_size)
+        writer.close()
+        return counter.size
+
+    @staticmethod
+    def is_encrypted(filename):
+        return filename.endswith(ENCRYPTED_EXTENSION)
+
+    def get_decode_stages(self, filename):
+        """
+        Stages turning the contents of the backup ``filename`` into the plain
+        dump.
+        """
+        stages = [DetectDecompressStage()]
+        if self.is_encrypted(filename):
+            stages.insert(0, DecryptStage(self.encrypt_password))
+        return stages
+
+    def decrypt(self, filename):
+        """
+        Decrypt and uncompress ``filename`` in a single pass. Returns the name
+        of the plain dump.
+        """
+        new_filename = os.path.join(os.path.dirname(filename), self.get_dump_name(os.path.basename(filename)))
+        self.stdout.write('\t%s > %s' % (filename, new_filename))
+        try:
+            with open(filename, 'rb') as source:
+                with open(new_filename, 'wb') as sink:
+                    pump(source, sink, self.get_decode_stages(filename), buffer_size=self.buffer_size)
+        except DecryptionError as e:
+            os.remove(new_filename)
+            raise CommandError('Can not decrypt %s: %s' % (filename, e))
+        os.remove(filename)
+        return new_filename
+
+    def stream_restore(self, db_remote):
+        """
+        Restore ``db_remote`` without writing it to disk: the remote file is
+        read, decompressed and fed to the database client as it arrives.
+        """
+        self.stdout.write('Streaming database %s into %s...' % (db_remote, self.db))
+        with self.stage('stream_restore') as stage:
+            try:
+                if os.path.splitext(self.get_dump_name(db_remote))[1] == '.tar':
+                    stage.bytes_out = self.stream_restore_archive(db_remote)
+                else:
+                    command = None
+                    if get_pg_format(self.get_dump_name(db_remote)) == 'custom':
+                        if self.jobs > 1:
+                            self.stdout.write('pg_restore can not load a stream in parallel, ignoring --jobs')
+                        command = self.get_pg_restore_command()
+                    sizes = []
+                    self.run_restore_client(lambda stdin: sizes.append(self.read_remote(db_remote, stdin)), command)
+                    stage.bytes_out = sum(sizes)
+            except DecryptionError as e:
+                # Whatever was loaded before the failure has been authenticated.
+                raise CommandError('Can not decrypt %s: %s' % (db_remote, e))
+
+    def stream_restore_archive(self, db_remote):
+        """
+        Stream a backup made by ``backup --parallel``. Its members are stored
+        in the order of the steps of the manifest, so they're restored one
+        after the other as they come out of the archive. Returns the size of
+        the archive.
+        """
+        read_fd, write_fd = os.pipe()
+        errors = []
+        sizes = []
+
+        def produce():
+            sink = os.fdopen(write_fd, 'wb')
+            try:
+                sizes.append(self.read_remote(db_remote, sink))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                sink.close()
+
+        producer = threading.Thread(target=produce)
+        producer.start()
+        source = os.fdopen(read_fd, 'rb')
+        try:
+            archive = tarfile.open(fileobj=source, mode='r|')
+            for member in archive:
+                if member.name == MANIFEST_NAME or not member.isfile():
+                    continue
+                self.stdout.write('\t%s' % member.name)
+                member_file = archive.extractfile(member)
+                self.run_restore_client(
+                    lambda stdin: pump(member_file, stdin, buffer_size=self.buffer_size))
+        finally:
+            # Closing the read end stops the producer if we failed early.
+            source.close()
+            producer.join()
+        if errors:
+            raise errors[0]
+        return sum(sizes)
+
+    def run_restore_client(self, feed, command=None):
+        """
+        Start the database client, or ``command``, and let ``feed`` write the
+        SQL to its stdin.
+        """
+        if command is None:
             if self.engine == 'django.db.backends.mysql' or 'mysql' in self.engine:
-                self.stdout.write('Doing Mysql restore to database %s from %s...' % (self.db, sql_local))
-                self.mysql_restore(sql_local)
-            # TODO reinstate postgres support
+                command = self.get_mysql_restore_command()
             elif self.engine == 'django.db.backends.postgresql_psycopg2':
-                self.stdout.write('Doing Postgresql restore to database %s from %s...' % (self.db, sql_local))
-                self.posgresql_restore(sql_local)
+                command = self.get_postgresql_restore_command()
             else:
                 raise CommandError('Backup in %s engine not implemented' % self.engine)
+        self.stdout.write('\t<stream> | %s' % command)
+        process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, env=self.get_environ())
+        try:
+            feed(process.stdin)
+            process.stdin.close()
+        except EnvironmentError:
+            # A client exiting early breaks the pipe, its exit code tells why.
+            if process.wait() == 0:
+                raise
+        except Exception:
+            # Closing its input would let the client take a partial dump for
+            # a complete one.
+            process.kill()
+            process.wait()
+            raise
+        returncode = process.wait()
+        if returncode:
+            raise CommandError('Database restore failed with exit code %s' % returncode)
 
     def is_folder(self, path):
         from paramiko.sftp import SFTPError
@@ -113,11 +598,75 @@ class Command(BaseBackupCommand):
         return result
 
     def uncompress(self, filename):
-        cmd = 'cd %s;gzip -df %s' % (self.tempdir, filename)
-        self.stdout.write('\t%s' % cmd)
-        return os.system(cmd)
+        """
+        Uncompress ``filename`` if it's compressed with one of the supported
+        codecs, which is told by its magic number. Returns the name of the
+        uncompressed file.
+        """
+        with open(filename, 'rb') as source:
+            header = source.read(8)
+        try:
+            codec = detect_codec(header)
+        except ImportError as e:
+            raise CommandError('%s is compressed with a codec that needs a missing library: %s' % (filename, e))
+        if codec is None:
+            return filename
+        if filename.endswith(codec.extension):
+            new_filename = filename[:-len(codec.extension)]
+        else:
+            new_filename = filename + '.uncompressed'
+        self.stdout.write('\t%s: %s > %s' % (codec.name, filename, new_filename))
+        with open(filename, 'rb') as source:
+            with open(new_filename, 'wb') as sink:
+                pump(source, sink, [DecompressStage(codec)], buffer_size=self.buffer_size)
+        os.remove(filename)
+        return new_filename
+
+    def get_shard_downloads(self, manifest):
+        return [
+            (os.path.join(self.remote_restore_dir, shard['name']), os.path.join(self.tempdir, shard['name']))
+            for shard in read_manifest(manifest)
+        ]
+
+    def extract_shards(self, manifest):
+        """
+        Extract the shards of ``manifest`` on a pool of processes. A shard
+        that doesn't match the manifest or can't be extracted is downloaded
+        again, up to BACKUP_FTP_RETRIES times.
+        """
+        shards = read_manifest(manifest)
+        downloads = dict(zip([shard['name'] for shard in shards], self.get_shard_downloads(manifest)))
+        for attempt in range(self.ftp_retries + 1):
+            errors = extract_shards(
+                [(downloads[shard['name']][1], shard, self.directory_to_backup) for shard in shards],
+                processes=self.compression_threads,
+            )
+            failed = [(shard, error) for shard, error in zip(shards, errors) if error]
+            if not failed:
+                break
+            for shard, error in failed:
+                self.stdout.write('\tshard %s failed: %s' % (shard['name'], error))
+            if attempt == self.ftp_retries:
+                raise CommandError('Could not restore %s of the shards of %s' % (len(failed), manifest))
+            shards = [shard for shard, error in failed]
+            self.get_transfer().get([downloads[shard['name']] for shard in shards])
+        for remote, local in downloads.values():
+            os.remove(local)
 
     def uncompress_media(self, filename):
+        if is_shard_manifest(filename):
+            self.stdout.write('\textracting the shards of %s' % filename)
+            self.extract_shards(filename)
+            return
+        storage = self.get_media_storage()
+        if storage is not None:
+            self.stdout.write('\textracting into media storage %s' % self.media_storage)
+            extract_to_storage(filename, storage, threads=self.media_fetch_threads)
+            return
+        if is_incremental(filename):
+            self.stdout.write('\tapplying incremental archive %s' % filename)
+            apply_incremental_archive(filename, self.directory_to_backup)
+            return
         cmd = u'tar -C %s -xzf %s' % (self.directory_to_backup, filename)
         self.stdout.write('\t%s' % cmd)
         os.system(cmd)
@@ -132,7 +681,7 @@ class Command(BaseBackupCommand):
         os.system(cmd)
         return new_filename
 
-    def mysql_restore(self, infile):
+    def get_mysql_restore_command(self, infile=None):
         args = []
         if self.user:
             args += ["--user=%s" % self.user]
@@ -143,23 +692,57 @@ class Command(BaseBackupCommand):
         if self.port:
             args += ["--port=%s" % self.port]
         args += [self.db]
-        cmd = 'mysql %s < %s' % (' '.join(args), infile)
-        self.stdout.write('\t%s' % cmd)
-        os.system(cmd)
+        if infile:
+            args += ['<', infile]
+        return 'mysql %s' % ' '.join(args)
 
-    def posgresql_restore(self, infile):
-        args = ['psql']
+    def run_restore_command(self, command):
+        """
+        Run the database client ``command``, raising CommandError with what
+        it wrote to stderr if it fails.
+        """
+        self.stdout.write('\t%s' % command)
+        process = subprocess.Popen(command, shell=True, stderr=subprocess.PIPE, env=self.get_environ())
+        stderr = process.communicate()[1].decode('utf-8', 'replace').strip()
+        if process.returncode:
+            raise CommandError('Database restore failed with exit code %s: %s' % (process.returncode, stderr))
+        if stderr:
+            self.stderr.write(stderr)
+
+    def mysql_restore(self, infile):
+        self.run_restore_command(self.get_mysql_restore_command(infile))
+
+    def get_postgresql_restore_command(self, infile=None):
+        """
+        Return the psql command loading the plain SQL file ``infile``, or
+        stdin. psql only exits with an error on a failed statement with
+        ON_ERROR_STOP, and a file is loaded in a single transaction so that
+        it isn't left half applied.
+        """
+        args = ['psql', '-v ON_ERROR_STOP=1']
         if self.user:
             args.append("-U %s" % self.user)
-        if self.passwd:
-            os.environ['PGPASSWORD'] = self.passwd
         if self.host:
             args.append("-h %s" % self.host)
         if self.port:
             args.append("-p %s" % self.port)
-        args.append('-f %s' % infile)
+        if infile:
+            args.append('--single-transaction')
+            args.append('-f %s' % infile)
         args.append("-o %s" % os.path.join(self.tempdir, 'dump.log'))
         args.append(self.db)
-        cmd = ' '.join(args)
-        self.stdout.write('\t%s' % cmd)
-        os.system(cmd)
+        return ' '.join(args)
+
+    def posgresql_restore(self, infile):
+        self.run_restore_command(self.get_postgresql_restore_command(infile))
+
+    def sqlite_restore(self, infile):
+        """
+        Copy the database file ``infile`` over the database with sqlite3's
+        online backup API.
+        """
+        if not infile.endswith(SQLITE_EXTENSION):
+            raise CommandError('%s is not an SQLite backup.' % os.path.basename(infile))
+        # Our own connection would hold on to the old schema.
+        self.db_connection.close()
+        copy_database(infile, self.db, pages=self.sqlite_pages, pause=self.sqlite_pause)
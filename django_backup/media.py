@@ -0,0 +1,197 @@
+"""
+Incremental media backups.
+
+A persistent index of every file backed up (path, size, mtime, inode and
+content hash) lets a backup archive only the files that changed since the
+previous one. Such a ``dir_<timestamp>.inc.tar.gz`` archive also records the
+files deleted since then. Restoring means extracting the latest full archive
+and then every incremental archive after it, in order.
+"""
+import hashlib
+import io
+import json
+import os
+import shutil
+import sqlite3
+import tarfile
+
+from django_backup.shards import get_manifest_name, is_shard
+from django_backup.streams import BUFFER_SIZE
+from django_backup.utils import decide_remove
+
+
+INDEX_NAME = '.media_index.sqlite3'
+INCREMENTAL_SUFFIX = '.inc.tar.gz'
+METADATA_NAME = '.backup_incremental.json'
+
+
+def is_incremental(filename):
+    return filename.endswith(INCREMENTAL_SUFFIX)
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file_:
+        while True:
+            data = file_.read(BUFFER_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+class MediaIndex(object):
+    """
+    The index of the files in the last media backup, kept in an SQLite
+    database. Changes made by ``scan`` only stick once ``commit`` is called,
+    which should happen after the archive has safely been stored.
+
+    The index is scanned, committed and closed by different tasks of a
+    backup, one after the other, so the connection isn't tied to a thread.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            'path TEXT PRIMARY KEY, arcname TEXT, size INTEGER, mtime REAL, inode INTEGER, sha256 TEXT, seen INTEGER)'
+        )
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.db.commit()
+
+    def get_meta(self, key, default=None):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    def is_empty(self):
+        return self.db.execute('SELECT COUNT(*) FROM files').fetchone()[0] == 0
+
+    def scan(self, directories, full=False):
+        """
+        Walk ``directories`` and update the index.
+
+        Returns ``(changed, deleted)``: a list of ``(path, arcname)`` for the
+        files that are new or whose content changed (every file if ``full``)
+        and a list of the arcnames of the files that disappeared. Files whose
+        size, mtime and inode are unchanged aren't read at all.
+        """
+        cursor = self.db.cursor()
+        cursor.execute('UPDATE files SET seen = 0')
+        changed = []
+        for directory in directories:
+            for root, dirs, files in os.walk(directory):
+                for name in files:
+                    path = os.path.join(root, name)
+                    arcname = os.path.relpath(path, directory)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    row = cursor.execute(
+                        'SELECT size, mtime, inode, sha256 FROM files WHERE path = ?', (path,)
+                    ).fetchone()
+                    if row and tuple(row[:3]) == (stat.st_size, stat.st_mtime, stat.st_ino):
+                        cursor.execute('UPDATE files SET seen = 1 WHERE path = ?', (path,))
+                        if full:
+                            changed.append((path, arcname))
+                        continue
+                    sha256 = file_hash(path)
+                    if full or not row or row[3] != sha256:
+                        changed.append((path, arcname))
+                    cursor.execute(
+                        'INSERT OR REPLACE INTO files (path, arcname, size, mtime, inode, sha256, seen)'
+                        ' VALUES (?, ?, ?, ?, ?, ?, 1)',
+                        (path, arcname, stat.st_size, stat.st_mtime, stat.st_ino, sha256)
+                    )
+        deleted = [arcname for (arcname,) in cursor.execute('SELECT arcname FROM files WHERE seen = 0')]
+        cursor.execute('DELETE FROM files WHERE seen = 0')
+        return changed, deleted
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        # Anything not committed is rolled back.
+        self.db.close()
+
+
+def write_archive(outfile, changed, deleted, full):
+    """
+    Write the ``changed`` files into the archive ``outfile``. An incremental
+    archive also gets the metadata restore needs, a full one is a plain
+    archive of the files.
+    """
+    archive = tarfile.open(outfile, 'w:gz')
+    try:
+        for path, arcname in changed:
+            archive.add(path, arcname, recursive=False)
+        if not full:
+            metadata = json.dumps({'deleted': deleted}).encode('utf-8')
+            info = tarfile.TarInfo(METADATA_NAME)
+            info.size = len(metadata)
+            archive.addfile(info, io.BytesIO(metadata))
+    finally:
+        archive.close()
+
+
+def apply_incremental_archive(filename, directory):
+    """
+    Extract an incremental archive into ``directory`` and remove the files
+    deleted since the archive before it.
+    """
+    archive = tarfile.open(filename, 'r:gz')
+    try:
+        metadata = json.loads(archive.extractfile(METADATA_NAME).read().decode('utf-8'))
+        archive.extractall(directory, [m for m in archive.getmembers() if m.name != METADATA_NAME])
+    finally:
+        archive.close()
+    for arcname in metadata['deleted']:
+        path = os.path.join(directory, arcname)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.remove(path)
+
+
+def get_restore_chain(backups):
+    """
+    Given the names of the media backups, return the archives to restore in
+    order: the latest full archive, or shard manifest, and the incremental
+    ones after it.
+    """
+    chain = []
+    for backup in sorted(backups):
+        if is_shard(backup):
+            continue
+        if is_incremental(backup):
+            if chain:
+                chain.append(backup)
+        else:
+            chain = [backup]
+    return chain
+
+
+def decide_remove_media(backups, config):
+    """
+    Like decide_remove, but retention is decided on the full archives only
+    and an incremental archive is removed together with its full archive, as
+    it's useless without it. Shards are removed together with their
+    manifest.
+    """
+    full_backups = [backup for backup in backups if not is_incremental(backup) and not is_shard(backup)]
+    remove_full = set(decide_remove(full_backups, config))
+    remove_list = []
+    base = None
+    for backup in sorted(backups):
+        if is_shard(backup):
+            if get_manifest_name(backup) in remove_full:
+                remove_list.append(backup)
+            continue
+        if not is_incremental(backup):
+            base = backup
+        if base in remove_full:
+            remove_list.append(backup)
+    return remove_list
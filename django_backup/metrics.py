@@ -0,0 +1,163 @@
+"""
+Timing and byte counts of the stages of a backup or restore run.
+
+Every stage (dump, compression, encryption, media archive, upload, ...)
+records how long it took, how many bytes it read and wrote and how many
+transfers it had to retry. The report of a run can be written as JSON and in
+the format of the Prometheus node exporter's textfile collector, so slow runs
+can be told apart by stage and throughput drops can be alerted on.
+"""
+import json
+import os
+import time
+from contextlib import contextmanager
+
+
+PROMETHEUS_PREFIX = 'django_backup'
+
+
+class Stage(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = None
+        self.bytes_in = None
+        self.bytes_out = None
+        self.retries = 0
+
+    @property
+    def throughput(self):
+        """
+        Bytes processed per second, counting what the stage read, or what it
+        wrote if that's unknown.
+        """
+        processed = self.bytes_in if self.bytes_in is not None else self.bytes_out
+        if processed is None or not self.seconds:
+            return None
+        return processed / self.seconds
+
+    @property
+    def compression_ratio(self):
+        if not self.bytes_in or not self.bytes_out:
+            return None
+        return float(self.bytes_in) / self.bytes_out
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'seconds': self.seconds,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'throughput': self.throughput,
+            'compression_ratio': self.compression_ratio,
+            'retries': self.retries,
+        }
+
+
+class RunReport(object):
+    """
+    The stages of one run of ``command``.
+    """
+
+    def __init__(self, command=None):
+        self.command = command
+        self.started = time.time()
+        self.seconds = None
+        self.success = None
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name, bytes_in=None):
+        """
+        Time the ``with`` block as the stage ``name``. The block sets
+        ``bytes_in``, ``bytes_out`` and ``retries`` on the Stage it's given.
+        """
+        stage = Stage(name)
+        stage.bytes_in = bytes_in
+        start = time.time()
+        try:
+            yield stage
+        finally:
+            stage.seconds = time.time() - start
+            self.stages.append(stage)
+
+    def finish(self, success):
+        self.seconds = time.time() - self.started
+        self.success = success
+
+    def as_dict(self):
+        return {
+            'command': self.command,
+            'started': self.started,
+            'seconds': self.seconds,
+            'success': self.success,
+            'stages': [stage.as_dict() for stage in self.stages],
+        }
+
+    def write_json(self, path):
+        _write_atomic(path, json.dumps(self.as_dict(), indent=2, sort_keys=True) + '\n')
+
+    def prometheus(self):
+        """
+        Return the report in the Prometheus text exposition format.
+        """
+        lines = []
+
+        def metric(name, type_, help_, samples):
+            name = '%s_%s' % (PROMETHEUS_PREFIX, name)
+            lines.append('# HELP %s %s' % (name, help_))
+            lines.append('# TYPE %s %s' % (name, type_))
+            for labels, value in samples:
+                if value is None:
+                    continue
+                labels = ','.join('%s="%s"' % (key, _escape(value_)) for key, value_ in sorted(labels.items()))
+                lines.append('%s{%s} %r' % (name, labels, float(value)))
+
+        run = {'command': self.command}
+        metric('last_run_timestamp_seconds', 'gauge', 'When the last run started.', [(run, self.started)])
+        metric('last_run_duration_seconds', 'gauge', 'How long the last run took.', [(run, self.seconds)])
+        metric('last_run_success', 'gauge', 'Whether the last run succeeded.',
+               [(run, None if self.success is None else int(self.success))])
+
+        stages = [(dict(run, stage=stage.name), stage) for stage in self.stages]
+        for name, attribute, help_ in (
+            ('stage_duration_seconds', 'seconds', 'How long the stage took in the last run.'),
+            ('stage_bytes_in', 'bytes_in', 'Bytes the stage read in the last run.'),
+            ('stage_bytes_out', 'bytes_out', 'Bytes the stage wrote in the last run.'),
+            ('stage_throughput_bytes_per_second', 'throughput', 'Bytes the stage processed per second in the last run.'),
+            ('stage_compression_ratio', 'compression_ratio', 'Bytes in per byte out of the stage in the last run.'),
+            ('stage_retries', 'retries', 'Transfers the stage retried in the last run.'),
+        ):
+            metric(name, 'gauge', help_, [(labels, getattr(stage, attribute)) for labels, stage in stages])
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        # The collector may read the file at any time, so it's replaced at once.
+        _write_atomic(path, self.prometheus())
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _write_atomic(path, text):
+    partial_path = '%s.%s.tmp' % (path, os.getpid())
+    with open(partial_path, 'w') as report_file:
+        report_file.write(text)
+    os.rename(partial_path, path)
+
+
+def path_size(path):
+    """
+    Size of the file ``path``, or of all files below the directory ``path``.
+    """
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
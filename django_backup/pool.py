@@ -0,0 +1,167 @@
+"""
+Connections to the remote server.
+
+``ConnectionPool`` hands out up to a fixed number of SFTP connections to the
+threads that need one, replacing connections that died. ``remove_many``,
+``stat_many`` and ``mkdir_many`` send many metadata requests on a single
+connection without waiting for each answer, so purging hundreds of files
+costs a few round-trips instead of hundreds.
+"""
+import threading
+from contextlib import contextmanager
+
+from paramiko import SFTPAttributes, SSHException
+from paramiko.sftp import CMD_ATTRS, CMD_MKDIR, CMD_REMOVE, CMD_STAT, CMD_STATUS
+
+
+CHANNELS = 4
+KEEPALIVE = 30
+WINDOW = 64
+
+# Errors after which a connection can't be trusted anymore.
+CONNECTION_ERRORS = (EnvironmentError, EOFError, SSHException)
+
+
+class ConnectionPool(object):
+    """
+    Up to ``size`` connections opened by calling ``connect``. ``is_alive``
+    tells whether an idle connection can still be used.
+    """
+
+    def __init__(self, connect, size=CHANNELS, is_alive=None):
+        self.connect = connect
+        self.size = size
+        self.is_alive = is_alive
+        self.semaphore = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def acquire(self):
+        self.semaphore.acquire()
+        try:
+            with self.lock:
+                connection = self.idle.pop() if self.idle else None
+            if connection is not None and self.is_alive and not self.is_alive(connection):
+                self._close(connection)
+                connection = None
+            return connection if connection is not None else self.connect()
+        except Exception:
+            self.semaphore.release()
+            raise
+
+    def release(self, connection):
+        with self.lock:
+            self.idle.append(connection)
+        self.semaphore.release()
+
+    def discard(self, connection):
+        self._close(connection)
+        self.semaphore.release()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection. It's thrown away if a network error happens
+        while it's borrowed.
+        """
+        connection = self.acquire()
+        try:
+            yield connection
+        except CONNECTION_ERRORS:
+            self.discard(connection)
+            raise
+        except Exception:
+            self.release(connection)
+            raise
+        else:
+            self.release(connection)
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            self._close(connection)
+
+
+class _Responses(object):
+    """
+    Receives the answers paramiko reads for pipelined requests.
+    """
+
+    def __init__(self):
+        self.received = {}
+
+    def _async_response(self, t, msg, num):
+        self.received[num] = (t, msg)
+
+
+def pipeline(connection, requests, window=WINDOW):
+    """
+    Send the SFTP ``requests``, ``(command, args)`` tuples, on ``connection``
+    with up to ``window`` of them in flight.
+
+    Returns a list with, for every request, the SFTPAttributes it returned,
+    None for a plain success, or the IOError it failed with.
+    """
+    client = getattr(connection, 'sftp_client', connection)
+    responses = _Responses()
+    results = [None] * len(requests)
+    in_flight = {}
+    pending = list(enumerate(requests))
+    pending.reverse()
+    while pending or in_flight:
+        while pending and len(in_flight) < window:
+            index, (command, args) = pending.pop()
+            in_flight[client._async_request(responses, command, *args)] = index
+        client._read_response()
+        for num, (t, msg) in list(responses.received.items()):
+            index = in_flight.pop(num)
+            del responses.received[num]
+            if t == CMD_STATUS:
+                try:
+                    client._convert_status(msg)
+                except (IOError, EOFError) as e:
+                    results[index] = e
+            elif t == CMD_ATTRS:
+                results[index] = SFTPAttributes._from_msg(msg)
+    return results
+
+
+def _path(connection, path):
+    client = getattr(connection, 'sftp_client', connection)
+    return client._adjust_cwd(path)
+
+
+def remove_many(connection, paths, window=WINDOW):
+    """
+    Remove ``paths``. Returns a dict mapping the paths that couldn't be
+    removed to the error.
+    """
+    results = pipeline(connection, [(CMD_REMOVE, (_path(connection, path),)) for path in paths], window)
+    return dict((path, result) for path, result in zip(paths, results) if result is not None)
+
+
+def stat_many(connection, paths, window=WINDOW):
+    """
+    Return the SFTPAttributes of every path in ``paths``, None for the ones
+    that don't exist.
+    """
+    results = pipeline(connection, [(CMD_STAT, (_path(connection, path),)) for path in paths], window)
+    return [result if isinstance(result, SFTPAttributes) else None for result in results]
+
+
+def mkdir_many(connection, paths, mode=0o777, window=WINDOW):
+    """
+    Create the directories ``paths``, ignoring the ones that already exist.
+    The server may handle the requests in any order, so their parents have to
+    exist already.
+    """
+    attributes = SFTPAttributes()
+    attributes.st_mode = mode
+    pipeline(connection, [(CMD_MKDIR, (_path(connection, path), attributes)) for path in paths], window)
@@ -0,0 +1,251 @@
+"""
+Deduplicating backup repository on the remote server.
+
+A database dump is split into content-defined chunks. Every chunk is stored
+once under its SHA-256 in ``<remote dir>/chunks`` and every backup is a small
+``backup_<timestamp>.sql.manifest`` file listing its chunks in order. As most
+of a dump is the same as the day before, a backup only uploads the chunks
+that changed.
+
+Removing a manifest doesn't remove any chunk, ``collect_garbage`` removes the
+chunks no remaining manifest refers to. Don't run it while another backup is
+uploading into the same repository.
+"""
+import hashlib
+import json
+import posixpath
+import zlib
+
+from django_backup.pool import mkdir_many, remove_many, stat_many
+from django_backup.streams import DecompressStage, get_codec
+from django_backup.transfer import partial_name
+
+
+CHUNK_SIZE = 1024 * 1024
+CHUNKS_DIR = 'chunks'
+MANIFEST_EXTENSION = '.manifest'
+
+
+def is_manifest(filename):
+    return filename.endswith(MANIFEST_EXTENSION)
+
+
+def latest_manifest(names):
+    manifests = sorted(filter(is_manifest, names))
+    return manifests[-1] if manifests else None
+
+
+class Chunker(object):
+    """
+    Split a stream into content-defined chunks of ``average_size`` bytes on
+    average.
+
+    Chunks end after a line whose CRC-32 falls below a threshold proportional
+    to the line's length, so a boundary only depends on the line before it and
+    an insertion early in a dump doesn't shift every chunk after it. Chunks
+    are at least a quarter and at most four times the average size; lines
+    longer than that are cut where the maximum is reached.
+    """
+
+    def __init__(self, average_size=CHUNK_SIZE):
+        self.min_size = average_size // 4
+        self.max_size = average_size * 4
+        self.threshold = (1 << 32) // average_size
+        self.buffer = b''
+        self.resume = 0
+
+    def _find_boundary(self):
+        buffer = self.buffer
+        start = max(self.resume, buffer.rfind(b'\n', 0, self.min_size) + 1)
+        while True:
+            end = buffer.find(b'\n', start, self.max_size) + 1
+            if not end:
+                if len(buffer) >= self.max_size:
+                    return self.max_size
+                # Carry on from this line once more data arrives.
+                self.resume = start
+                return None
+            if end > self.min_size and (zlib.crc32(buffer[start:end]) & 0xffffffff) < (end - start) * self.threshold:
+                return end
+            start = end
+
+    def process(self, data):
+        """
+        Add ``data`` and return the list of chunks completed by it.
+        """
+        self.buffer += data
+        chunks = []
+        while len(self.buffer) > self.min_size:
+            end = self._find_boundary()
+            if end is None:
+                break
+            chunks.append(self.buffer[:end])
+            self.buffer = self.buffer[end:]
+            self.resume = 0
+        return chunks
+
+    def finish(self):
+        chunks = [self.buffer] if self.buffer else []
+        self.buffer = b''
+        return chunks
+
+
+class Repository(object):
+    """
+    A backup repository in ``remote_dir`` on the server ``sftp`` is connected
+    to. New chunks are compressed with ``codec`` if one is given.
+    """
+
+    def __init__(self, sftp, remote_dir, codec=None, level=None, chunk_size=None):
+        self.sftp = sftp
+        self.remote_dir = remote_dir or ''
+        self.codec = codec
+        self.level = codec.default_level if codec and level is None else level
+        self.chunk_size = chunk_size or CHUNK_SIZE
+        self.chunks_dir = posixpath.join(self.remote_dir, CHUNKS_DIR)
+        self.prepared = False
+
+    def exists(self):
+        return self.sftp.isdir(self.chunks_dir)
+
+    def chunk_path(self, chunk_id):
+        return posixpath.join(self.chunks_dir, chunk_id[:2], chunk_id)
+
+    def has_chunks(self, chunk_ids):
+        """
+        Return the set of ``chunk_ids`` stored in the repository, looked up
+        in one batch.
+        """
+        attributes = stat_many(self.sftp, [self.chunk_path(chunk_id) for chunk_id in chunk_ids])
+        return set(chunk_id for chunk_id, attribute in zip(chunk_ids, attributes) if attribute is not None)
+
+    def prepare(self):
+        """
+        Create the chunk directories, all 256 of them at once.
+        """
+        if self.prepared:
+            return
+        try:
+            self.sftp.mkdir(self.chunks_dir)
+        except IOError:
+            pass
+        mkdir_many(self.sftp, [posixpath.join(self.chunks_dir, '%02x' % i) for i in range(256)])
+        self.prepared = True
+
+    def put_chunk(self, chunk_id, data):
+        if self.codec:
+            data = self.codec.compress(data, self.level)
+        self.prepare()
+        path = self.chunk_path(chunk_id)
+        directory, filename = posixpath.split(path)
+        partial_path = posixpath.join(directory, partial_name(filename))
+        with self.sftp.open(partial_path, 'wb') as remote_file:
+            remote_file.write(data)
+        self.sftp.rename(partial_path, path)
+        return len(data)
+
+    def get_chunk(self, chunk_id, codec_name):
+        with self.sftp.open(self.chunk_path(chunk_id), 'rb') as remote_file:
+            remote_file.prefetch()
+            data = remote_file.read()
+        if codec_name:
+            stage = DecompressStage(get_codec(codec_name))
+            data = stage.process(data) + stage.finish()
+        return data
+
+    def read_manifest(self, name):
+        with self.sftp.open(posixpath.join(self.remote_dir, name), 'rb') as remote_file:
+            remote_file.prefetch()
+            return json.loads(remote_file.read().decode('utf-8'))
+
+    def write_manifest(self, name, manifest):
+        """
+        Store ``manifest`` as ``name``. Returns the size and SHA-256 of the
+        manifest file.
+        """
+        data = json.dumps(manifest).encode('utf-8')
+        partial_path = posixpath.join(self.remote_dir, partial_name(name))
+        with self.sftp.open(partial_path, 'wb') as remote_file:
+            remote_file.write(data)
+        self.sftp.rename(partial_path, posixpath.join(self.remote_dir, name))
+        return len(data), hashlib.sha256(data).hexdigest()
+
+    def writer(self, name, previous=None):
+        """
+        Return a file-like object storing everything written to it as the
+        backup ``name``. Chunks listed in the ``previous`` manifest are
+        assumed to exist, any other chunk is looked up before uploading it.
+        """
+        return RepositoryWriter(self, name, previous)
+
+    def restore(self, name, out):
+        """
+        Reassemble the backup ``name`` into the file-like ``out``.
+        """
+        manifest = self.read_manifest(name)
+        for chunk_id, size in manifest['chunks']:
+            out.write(self.get_chunk(chunk_id, manifest['codec']))
+
+    def collect_garbage(self, manifest_names):
+        """
+        Remove every chunk not referenced by one of ``manifest_names``.
+        Returns the list of removed chunk ids.
+        """
+        referenced = set()
+        for name in manifest_names:
+            referenced.update(chunk_id for chunk_id, size in self.read_manifest(name)['chunks'])
+        removed = []
+        for prefix in self.sftp.listdir(self.chunks_dir):
+            directory = posixpath.join(self.chunks_dir, prefix)
+            for chunk_id in self.sftp.listdir(directory):
+                # Partial uploads start with a dot, leave them to their writer.
+                if chunk_id.startswith('.') or chunk_id in referenced:
+                    continue
+                removed.append(chunk_id)
+        failed = remove_many(self.sftp, [self.chunk_path(chunk_id) for chunk_id in removed])
+        return [chunk_id for chunk_id in removed if self.chunk_path(chunk_id) not in failed]
+
+
+class RepositoryWriter(object):
+    """
+    File-like object chunking and uploading a backup. The backup only becomes
+    visible once ``commit`` writes its manifest.
+    """
+
+    def __init__(self, repository, name, previous=None):
+        self.repository = repository
+        self.name = name
+        self.chunker = Chunker(repository.chunk_size)
+        self.known = set(chunk_id for chunk_id, size in (previous or {}).get('chunks', []))
+        self.chunks = []
+        self.size = 0
+        self.uploaded = 0
+
+    def _store(self, chunks):
+        chunk_ids = [hashlib.sha256(chunk).hexdigest() for chunk in chunks]
+        unknown = list(set(chunk_id for chunk_id in chunk_ids if chunk_id not in self.known))
+        if unknown:
+            self.known.update(self.repository.has_chunks(unknown))
+        for chunk_id, chunk in zip(chunk_ids, chunks):
+            if chunk_id not in self.known:
+                self.uploaded += self.repository.put_chunk(chunk_id, chunk)
+            self.known.add(chunk_id)
+            self.chunks.append([chunk_id, len(chunk)])
+            self.size += len(chunk)
+
+    def write(self, data):
+        self._store(self.chunker.process(data))
+
+    def close(self):
+        self._store(self.chunker.finish())
+
+    def commit(self):
+        """
+        Write the manifest, which makes the backup visible. Returns the size
+        and SHA-256 of the manifest file.
+        """
+        return self.repository.write_manifest(self.name, {
+            'codec': self.repository.codec.name if self.repository.codec else None,
+            'size': self.size,
+            'chunks': self.chunks,
+        })
@@ -0,0 +1,109 @@
+"""
+Retention planning: which backups to keep and which to remove.
+
+A policy maps tiers to the number of intervals to keep a backup for, e.g.
+``{'daily': 7, 'weekly': 4, 'monthly': 12}``. Every tier counts intervals back
+from an anchor derived from the current time, and the oldest backup inside
+each of those intervals is kept. Everything not kept by any tier is removed.
+
+Every timestamp is parsed once and every backup is put into its interval of
+every tier arithmetically, so planning costs a sort plus a single pass.
+"""
+import re
+from datetime import datetime, timedelta
+
+from django.core.management import CommandError
+
+
+TIMESTAMP = re.compile(r'(\d{4})(\d{2})(\d{2})-(\d{2})(\d{2})(\d{2})')
+
+
+def parse_timestamp(filename):
+    """
+    Return the datetime in the name of a backup file.
+    """
+    return datetime(*[int(part) for part in TIMESTAMP.search(filename).groups()])
+
+
+def _hourly(now):
+    return datetime(now.year, now.month, now.day, now.hour) + timedelta(minutes=60)
+
+
+def _daily(now):
+    return datetime(now.year, now.month, now.day) + timedelta(1)
+
+
+def _weekly(now):
+    # Beginning of the week.
+    return datetime(now.year, now.month, now.day) - timedelta(now.weekday())
+
+
+def _monthly(now):
+    # Beginning of the month.
+    return datetime(now.year, now.month, 1)
+
+
+def _yearly(now):
+    # Beginning of the year.
+    return datetime(now.year, 1, 1)
+
+
+# Tier name: (interval length, function returning the end of the newest interval).
+TIERS = {
+    'hourly': (timedelta(minutes=60), _hourly),
+    'daily': (timedelta(1), _daily),
+    'weekly': (timedelta(7), _weekly),
+    'monthly': (timedelta(30), _monthly),
+    'yearly': (timedelta(365), _yearly),
+}
+
+
+class RetentionPlan(object):
+    """
+    Decide which of ``backups`` the policy ``config`` keeps, as of ``now``.
+
+    ``keep`` and ``remove`` are lists of backup names in their original order
+    and ``reasons`` maps every kept backup to the ``(tier, interval)`` pairs
+    it's kept for, interval 0 being the newest.
+    """
+
+    def __init__(self, backups, config, now=None):
+        now = now or datetime.now()
+        tiers = []
+        for tier, count in sorted(config.items()):
+            if tier not in TIERS:
+                raise CommandError("Unknown backup interval")
+            if count:
+                delta, anchor = TIERS[tier]
+                end = anchor(now)
+                tiers.append((tier, count, end - count * delta, end, delta.total_seconds()))
+
+        dated = sorted((parse_timestamp(backup), backup) for backup in backups)
+        taken = set()
+        self.reasons = {}
+        for date, backup in dated:
+            for tier, count, start, end, seconds in tiers:
+                if not start < date <= end:
+                    continue
+                # Intervals are (end - (i + 1) * delta, end - i * delta].
+                age = (end - date).total_seconds()
+                interval = int(age // seconds)
+                if (tier, interval) in taken:
+                    continue
+                taken.add((tier, interval))
+                self.reasons.setdefault(backup, []).append((tier, interval))
+        self.keep = [backup for backup in backups if backup in self.reasons]
+        self.remove = [backup for backup in backups if backup not in self.reasons]
+
+    def describe(self, backups=None, remove=None):
+        """
+        Return one line per backup telling what happens to it. ``backups`` and
+        ``remove`` override the backups to list and the ones to remove.
+        """
+        remove = set(self.remove if remove is None else remove)
+        lines = []
+        for backup in sorted(self.keep + self.remove if backups is None else backups):
+            reasons = ', '.join('%s #%s' % (tier, interval + 1) for tier, interval in self.reasons.get(backup, []))
+            action = 'remove' if backup in remove else 'keep'
+            lines.append('%-6s %s%s' % (action, backup, ' (%s)' % reasons if reasons else ''))
+        return lines
@@ -0,0 +1,154 @@
+"""
+Media backups split into shards.
+
+Instead of one dir_<timestamp>.tar.gz, the media files are split into
+dir_<timestamp>.shard-0001.tar.gz, ... archives of about ``max_size`` bytes
+each, which are compressed concurrently on a pool of processes. The
+dir_<timestamp>.shards.json manifest lists the shards with their size and
+SHA-256, so restore can download and extract them in parallel and fetch a
+single broken shard again instead of the whole backup.
+"""
+import json
+import os
+import re
+import tarfile
+import zlib
+from multiprocessing import Pool
+
+from django_backup.streams import DigestWriter, MultiWriter, pump
+
+
+MANIFEST_SUFFIX = '.shards.json'
+SHARD_SUFFIX = '.shard-%04d.tar.gz'
+shard_regex = re.compile(r'\.shard-\d+\.tar\.gz$')
+
+
+class ShardError(Exception):
+    pass
+
+
+def is_shard(filename):
+    return bool(shard_regex.search(filename))
+
+
+def is_shard_manifest(filename):
+    return filename.endswith(MANIFEST_SUFFIX)
+
+
+def get_manifest_name(shard):
+    """
+    Return the name of the manifest the shard ``shard`` belongs to.
+    """
+    return shard_regex.sub('', shard) + MANIFEST_SUFFIX
+
+
+def plan_shards(directories, max_size):
+    """
+    Split the files below ``directories`` into lists of (path, arcname) of
+    at most ``max_size`` bytes each, unless a single file is larger. Arcnames
+    are relative to the directory the file is in, like for compress_dir.
+    """
+    shard, size = [], 0
+    for directory in directories:
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for name in dirs + sorted(files):
+                path = os.path.join(root, name)
+                file_size = 0 if name in dirs else os.lstat(path).st_size
+                if shard and size + file_size > max_size:
+                    yield shard
+                    shard, size = [], 0
+                shard.append((path, os.path.relpath(path, directory)))
+                size += file_size
+    if shard:
+        yield shard
+
+
+def build_shard(job):
+    """
+    Write the (path, arcname) files of the (outfile, files) ``job`` into the
+    shard outfile. Returns its manifest entry.
+    """
+    outfile, files = job
+    digest = DigestWriter()
+    with open(outfile, 'wb') as out:
+        archive = tarfile.open(fileobj=MultiWriter(out, digest), mode='w|gz')
+        try:
+            for path, arcname in files:
+                archive.add(path, arcname, recursive=False)
+        finally:
+            archive.close()
+    return {'name': os.path.basename(outfile), 'size': digest.size, 'sha256': digest.hexdigest(), 'files': len(files)}
+
+
+def build_shards(directories, prefix, max_size, processes=None):
+    """
+    Archive ``directories`` into shards named ``prefix`` + .shard-0001.tar.gz,
+    ... on a pool of ``processes`` processes and write their manifest.
+
+    Returns the names of the shards and of the manifest, the latter last.
+    """
+    jobs = (
+        (prefix + SHARD_SUFFIX % number, files)
+        for number, files in enumerate(plan_shards(directories, max_size), 1)
+    )
+    pool = Pool(processes)
+    try:
+        shards = list(pool.imap(build_shard, jobs))
+    finally:
+        pool.close()
+        pool.join()
+    manifest = prefix + MANIFEST_SUFFIX
+    with open(manifest, 'w') as manifest_file:
+        json.dump({'version': 1, 'shards': shards}, manifest_file, indent=2)
+    directory = os.path.dirname(prefix)
+    return [os.path.join(directory, shard['name']) for shard in shards] + [manifest]
+
+
+def read_manifest(filename):
+    with open(filename) as manifest_file:
+        return json.load(manifest_file)['shards']
+
+
+def check_shard(filename, entry):
+    """
+    Raise ShardError unless ``filename`` has the size and SHA-256 of its
+    manifest ``entry``.
+    """
+    digest = DigestWriter()
+    with open(filename, 'rb') as source:
+        pump(source, digest)
+    if digest.size != entry['size'] or digest.hexdigest() != entry['sha256']:
+        raise ShardError('%s does not match its manifest' % entry['name'])
+
+
+def extract_shard(job):
+    """
+    Check the shard ``filename`` against its manifest entry and extract it
+    into ``directory``. Returns None, or why that failed.
+    """
+    filename, entry, directory = job
+    try:
+        check_shard(filename, entry)
+        archive = tarfile.open(filename, 'r:gz')
+        try:
+            archive.extractall(directory)
+        finally:
+            archive.close()
+    except (EnvironmentError, EOFError, ShardError, tarfile.TarError, zlib.error) as e:
+        return str(e) or e.__class__.__name__
+    return None
+
+
+def extract_shards(jobs, processes=None):
+    """
+    Run the (filename, entry, directory) ``jobs`` of extract_shard on a pool
+    of ``processes`` processes. Returns what extract_shard returned for
+    every job.
+    """
+    pool = Pool(processes)
+    try:
+        return pool.map(extract_shard, jobs, 1)
+    finally:
+        pool.close()
+        pool.join()
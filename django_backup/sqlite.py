@@ -0,0 +1,91 @@
+"""
+Copying live SQLite databases.
+
+sqlite3's online backup API copies a database a few pages at a time while
+other connections keep using it: the source is only locked during a step,
+and we pause between steps so that writers waiting for the lock get their
+turn. A write through another connection makes the copy start over, so that
+the result is always a consistent snapshot. On a database written to more
+often than a copy takes that would never end: after ``restarts`` restarts a
+last copy is made in a single step, which holds the lock until it's done.
+
+Python only has the backup API from 3.7 on. Older versions copy the SQL
+text of the database, read in a single transaction.
+"""
+import sqlite3
+import time
+
+
+EXTENSION = '.sqlite3'
+PAGES = 256
+PAUSE = 0.05
+RESTARTS = 3
+
+
+class _Restarted(Exception):
+    pass
+
+
+def copy_database(source, target, pages=PAGES, pause=PAUSE, restarts=RESTARTS):
+    """
+    Replace the contents of the SQLite database file ``target`` with a copy
+    of ``source``, ``pages`` pages per step with a pause of ``pause``
+    seconds between steps.
+
+    Returns the number of times the copy started over.
+    """
+    restarted = [0]
+    source_db = sqlite3.connect(source, isolation_level=None)
+    try:
+        target_db = sqlite3.connect(target, isolation_level=None)
+        try:
+            if hasattr(source_db, 'backup'):
+                last = [None]
+
+                def progress(status, remaining, total):
+                    if last[0] is not None and remaining > last[0]:
+                        restarted[0] += 1
+                        if restarted[0] >= restarts:
+                            raise _Restarted()
+                    last[0] = remaining
+                    if remaining:
+                        time.sleep(pause)
+                try:
+                    source_db.backup(target_db, pages=pages, progress=progress)
+                except _Restarted:
+                    source_db.backup(target_db, pages=-1)
+            else:
+                _copy_statements(source_db, target_db)
+        finally:
+            target_db.close()
+    finally:
+        source_db.close()
+    return restarted[0]
+
+
+def _copy_statements(source_db, target_db):
+    source_db.execute('BEGIN')
+    try:
+        target_db.execute('BEGIN IMMEDIATE')
+        try:
+            tables = target_db.execute(
+                "SELECT type, name FROM sqlite_master"
+                " WHERE type IN ('table', 'view') AND name NOT LIKE 'sqlite_%'"
+            ).fetchall()
+            for kind, name in tables:
+                target_db.execute('DROP %s IF EXISTS "%s"' % (kind.upper(), name.replace('"', '""')))
+            # iterdump fills sqlite_sequence before the tables creating it.
+            sequences = []
+            for statement in source_db.iterdump():
+                if 'INTO "sqlite_sequence"' in statement or statement.startswith('DELETE FROM "sqlite_sequence"'):
+                    sequences.append(statement)
+                elif statement not in ('BEGIN TRANSACTION;', 'COMMIT;'):
+                    target_db.execute(statement)
+            for statement in sequences:
+                target_db.execute(statement)
+        except Exception:
+            target_db.execute('ROLLBACK')
+            raise
+        target_db.execute('COMMIT')
+    finally:
+        source_db.execute('ROLLBACK')
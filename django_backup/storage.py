@@ -0,0 +1,200 @@
+"""
+Media backups of a Django storage backend.
+
+Media kept behind a Storage (an S3 bucket, ...) isn't on the local disk, so
+instead of running tar on a directory the files are listed through the
+storage API, one directory at a time, and fetched by a bounded pool of
+threads straight into the archive, in listing order. Nothing is staged on
+disk: files up to ``memory_limit`` bytes wait in memory for their turn, at
+most two per thread, larger ones are streamed into the archive as they're
+read. Restoring saves the members of an archive back into the storage the
+same way.
+"""
+import os
+import posixpath
+import tarfile
+import time
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from django.core.files import File
+from django.core.files.base import ContentFile
+
+
+FETCH_THREADS = 8
+MEMORY_LIMIT = 4 * 1024 * 1024
+
+
+def walk(storage, path=''):
+    """
+    Yield the names of the files below ``path`` in ``storage``. Only the
+    listing of one directory is held at a time.
+    """
+    pending = [path]
+    while pending:
+        directory = pending.pop()
+        directories, files = storage.listdir(directory)
+        for name in sorted(files):
+            yield posixpath.join(directory, name)
+        pending.extend(posixpath.join(directory, name) for name in sorted(directories, reverse=True))
+
+
+class _PrefixedFile(object):
+    """
+    File-like object reading ``prefix`` and then the rest of ``file_``.
+    """
+
+    def __init__(self, prefix, file_):
+        self.prefix = prefix
+        self.file = file_
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.file.read(size)
+        if size < 0:
+            data, self.prefix = self.prefix + self.file.read(), b''
+        else:
+            data, self.prefix = self.prefix[:size], self.prefix[size:]
+            if len(data) < size:
+                data += self.file.read(size - len(data))
+        return data
+
+
+def _fetch(storage, name, memory_limit):
+    """
+    Read the file ``name``. Returns its contents and None, or, if it's
+    larger than ``memory_limit``, what was read so far and the open file.
+    """
+    file_ = storage.open(name, 'rb')
+    try:
+        data = file_.read(memory_limit + 1)
+    except Exception:
+        file_.close()
+        raise
+    if len(data) > memory_limit:
+        return data, file_
+    file_.close()
+    return data, None
+
+
+def _save(storage, name, content):
+    # Storage.save picks another name for a file that exists.
+    if storage.exists(name):
+        storage.delete(name)
+    storage.save(name, content)
+
+
+class _Pool(object):
+    """
+    Runs jobs on ``threads`` threads, with at most two jobs per thread in
+    flight.
+    """
+
+    def __init__(self, threads):
+        self.threads = threads
+        self.pool = ThreadPool(threads)
+        self.pending = deque()
+
+    def submit(self, key, function, *args):
+        self.pending.append((key, self.pool.apply_async(function, args)))
+
+    def collect(self, limit=None):
+        """
+        Yield the (key, result) of the oldest jobs while more than ``limit``
+        jobs, two per thread by default, are in flight.
+        """
+        limit = 2 * self.threads if limit is None else limit
+        while len(self.pending) > limit:
+            key, result = self.pending.popleft()
+            yield key, result.get()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+def archive_storage(storage, outfile, directories=(), threads=FETCH_THREADS, memory_limit=MEMORY_LIMIT):
+    """
+    Write every file of ``storage``, after the contents of the local
+    ``directories``, into the gzipped tar archive ``outfile``.
+
+    Returns the number of bytes archived.
+    """
+    mtime = time.time()
+    total = [0]
+    archive = tarfile.open(outfile, 'w:gz')
+
+    def add(name, fetched):
+        data, file_ = fetched
+        info = tarfile.TarInfo(name)
+        info.mtime = mtime
+        if file_ is None:
+            info.size = len(data)
+            archive.addfile(info, ContentFile(data))
+        else:
+            try:
+                info.size = storage.size(name)
+                archive.addfile(info, _PrefixedFile(data, file_))
+            finally:
+                file_.close()
+        total[0] += info.size
+
+    pool = _Pool(threads)
+    try:
+        for directory in directories:
+            for name in sorted(os.listdir(directory)):
+                archive.add(os.path.join(directory, name), name)
+        for name in walk(storage):
+            pool.submit(name, _fetch, storage, name, memory_limit)
+            for key, fetched in pool.collect():
+                add(key, fetched)
+        for key, fetched in pool.collect(0):
+            add(key, fetched)
+    except Exception:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        archive.close()
+    return total[0]
+
+
+def extract_to_storage(filename, storage, threads=FETCH_THREADS, memory_limit=MEMORY_LIMIT):
+    """
+    Save every file of the gzipped tar archive ``filename`` into
+    ``storage``, replacing the files that exist.
+
+    Returns the number of bytes extracted.
+    """
+    total = 0
+    archive = tarfile.open(filename, 'r:gz')
+    pool = _Pool(threads)
+    try:
+        for member in archive:
+            if not member.isfile():
+                continue
+            source = archive.extractfile(member)
+            if member.size > memory_limit:
+                content = File(source, member.name)
+                content.size = member.size
+                _save(storage, member.name, content)
+            else:
+                pool.submit(member.name, _save, storage, member.name, ContentFile(source.read()))
+            total += member.size
+            for _ in pool.collect():
+                pass
+        for _ in pool.collect(0):
+            pass
+    except Exception:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        archive.close()
+    return total
@@ -0,0 +1,327 @@
+"""
+Building blocks for moving backup data from one place to another without
+writing intermediate files.
+
+A pipeline reads a source in fixed-size chunks, pushes every chunk through a
+list of stages (compression, ...) and writes the result to a sink. A stage is
+any object with ``process(data)`` and ``finish()`` methods returning bytes.
+"""
+import hashlib
+import zlib
+from collections import deque
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+
+BUFFER_SIZE = 1024 * 1024
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+class Codec(object):
+    """
+    A compression format. ``compress`` turns a block into a complete, self
+    contained member of the format, so that compressed blocks can simply be
+    concatenated.
+    """
+    name = None
+    extension = None
+    magic = None
+    default_level = None
+
+    def compress(self, data, level):
+        raise NotImplementedError
+
+    def decompressor(self):
+        raise NotImplementedError
+
+
+class GzipCodec(Codec):
+    name = 'gzip'
+    extension = '.gz'
+    magic = b'\x1f\x8b'
+    default_level = 6
+
+    def compress(self, data, level):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompressor(self):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+class XzCodec(Codec):
+    name = 'xz'
+    extension = '.xz'
+    magic = b'\xfd7zXZ\x00'
+    default_level = 6
+
+    def __init__(self):
+        import lzma
+        self.lzma = lzma
+
+    def compress(self, data, level):
+        return self.lzma.compress(data, preset=level)
+
+    def decompressor(self):
+        return self.lzma.LZMADecompressor()
+
+
+class ZstdCodec(Codec):
+    name = 'zstd'
+    extension = '.zst'
+    magic = b'\x28\xb5\x2f\xfd'
+    default_level = 3
+
+    def __init__(self):
+        import zstandard
+        self.zstandard = zstandard
+
+    def compress(self, data, level):
+        return self.zstandard.ZstdCompressor(level=level).compress(data)
+
+    def decompressor(self):
+        return self.zstandard.ZstdDecompressor().decompressobj()
+
+
+class Lz4Codec(Codec):
+    name = 'lz4'
+    extension = '.lz4'
+    magic = b'\x04\x22\x4d\x18'
+    default_level = 0
+
+    def __init__(self):
+        import lz4.frame
+        self.lz4_frame = lz4.frame
+
+    def compress(self, data, level):
+        return self.lz4_frame.compress(data, compression_level=level)
+
+    def decompressor(self):
+        return self.lz4_frame.LZ4FrameDecompressor()
+
+
+CODECS = dict((codec.name, codec) for codec in (GzipCodec, ZstdCodec, Lz4Codec, XzCodec))
+
+
+def get_codec(name):
+    """
+    Return the codec called ``name``. Raises KeyError for unknown codecs and
+    ImportError if the library the codec needs isn't installed.
+    """
+    return CODECS[name]()
+
+
+def detect_codec(header):
+    """
+    Return the codec whose magic number ``header`` starts with, or None.
+    """
+    for codec in CODECS.values():
+        if header.startswith(codec.magic):
+            return codec()
+    return None
+
+
+class CompressStage(object):
+    """
+    Compress the data passing through the pipeline in independent blocks on
+    a pool of threads. The compression libraries release the GIL, so this
+    scales with the number of cores. At most two blocks per thread are in
+    flight at any time.
+    """
+
+    def __init__(self, codec, level=None, threads=None, block_size=BLOCK_SIZE):
+        self.codec = codec
+        self.level = codec.default_level if level is None else level
+        self.threads = threads or cpu_count()
+        self.block_size = block_size
+        self.pool = ThreadPool(self.threads)
+        self.pending = deque()
+        self.buffer = b''
+        self.blocks = 0
+
+    def _submit(self, block):
+        self.pending.append(self.pool.apply_async(self.codec.compress, (block, self.level)))
+        self.blocks += 1
+
+    def _collect(self, limit):
+        output = []
+        while self.pending and (len(self.pending) > limit or self.pending[0].ready()):
+            output.append(self.pending.popleft().get())
+        return b''.join(output)
+
+    def process(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(self.buffer[:self.block_size])
+            self.buffer = self.buffer[self.block_size:]
+        return self._collect(2 * self.threads)
+
+    def finish(self):
+        # Empty input still becomes one (empty) member, or it wouldn't be a
+        # valid compressed file.
+        if self.buffer or not self.blocks:
+            self._submit(self.buffer)
+            self.buffer = b''
+        output = self._collect(0)
+        self.pool.close()
+        self.pool.join()
+        return output
+
+
+class DecompressStage(object):
+    """
+    Decompress a stream made of one or more concatenated members.
+    """
+
+    def __init__(self, codec):
+        self.codec = codec
+        self._decompressor = codec.decompressor()
+
+    def process(self, data):
+        output = []
+        while data:
+            output.append(self._decompressor.decompress(data))
+            eof = getattr(self._decompressor, 'eof', None)
+            if eof is None:
+                # Python 2's zlib doesn't tell, but leftovers mean the end.
+                eof = bool(self._decompressor.unused_data)
+            if not eof:
+                break
+            # The member is complete, whatever is left starts the next one.
+            data = self._decompressor.unused_data
+            self._decompressor = self.codec.decompressor()
+        return b''.join(output)
+
+    def finish(self):
+        return b''
+
+
+class DetectDecompressStage(object):
+    """
+    Decompress a stream with the codec its magic number belongs to, or pass
+    it through unchanged if it isn't compressed.
+    """
+    header_size = 8
+
+    def __init__(self):
+        self.header = b''
+        self.stage = None
+        self.codec = None
+
+    def _detect(self):
+        self.codec = detect_codec(self.header)
+        self.stage = DecompressStage(self.codec) if self.codec else PassStage()
+        data, self.header = self.header, b''
+        return self.stage.process(data)
+
+    def process(self, data):
+        if self.stage is None:
+            self.header += data
+            if len(self.header) < self.header_size:
+                return b''
+            return self._detect()
+        return self.stage.process(data)
+
+    def finish(self):
+        output = self._detect() if self.stage is None else b''
+        return output + self.stage.finish()
+
+
+class PassStage(object):
+
+    def process(self, data):
+        return data
+
+    def finish(self):
+        return b''
+
+
+class MultiWriter(object):
+    """
+    File-like object that writes every chunk to several files. ``size`` counts
+    the bytes written.
+    """
+
+    def __init__(self, *files):
+        self.files = files
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        for file_ in self.files:
+            file_.write(data)
+
+    def close(self):
+        for file_ in self.files:
+            file_.close()
+
+
+class DigestWriter(object):
+    """
+    File-like object that only keeps the size and SHA-256 of what's written
+    to it.
+    """
+
+    def __init__(self):
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+    def close(self):
+        pass
+
+
+class StageWriter(object):
+    """
+    File-like object that pushes everything written to it through ``stages``
+    into ``file_``.
+    """
+
+    def __init__(self, file_, stages=()):
+        self.file = file_
+        self.stages = stages
+
+    def write(self, data):
+        for stage in self.stages:
+            data = stage.process(data)
+        if data:
+            self.file.write(data)
+
+    def finish(self):
+        """
+        Flush every stage in order, feeding what's left into the stages after it.
+        """
+        data = b''
+        for stage in self.stages:
+            data = stage.process(data) + stage.finish()
+        if data:
+            self.file.write(data)
+
+    def close(self):
+        self.finish()
+        self.file.close()
+
+
+def pump(source, sink, stages=(), buffer_size=BUFFER_SIZE):
+    """
+    Read ``source`` in ``buffer_size`` chunks, feed every chunk through
+    ``stages`` and write the output to ``sink``.
+
+    Returns the number of bytes read from ``source``.
+    """
+    total = 0
+    writer = StageWriter(sink, stages)
+    while True:
+        data = source.read(buffer_size)
+        if not data:
+            break
+        total += len(data)
+        writer.write(data)
+    writer.finish()
+    return total
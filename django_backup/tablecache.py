@@ -0,0 +1,86 @@
+"""
+Reusing the dumps of tables that didn't change.
+
+A --parallel backup dumps the data of every table into a file of its own.
+With --skip-unchanged on MySQL these files are also kept in a local cache,
+next to a signature of their table read from the cheap table level
+statistics: its last update time and columns. A table whose signature is
+the same next time isn't dumped again, its file is taken from the cache.
+
+A signature of None means the statistics can't tell, and the table is
+always dumped.
+"""
+import json
+import os
+import shutil
+
+
+CACHE_NAME = '.table_cache'
+SIGNATURES_NAME = 'signatures.json'
+
+
+def _link(source, target):
+    if os.path.exists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+class TableCache(object):
+    """
+    The data files of the tables last dumped and their signatures, kept in
+    the directory ``path``.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.current = {}
+        try:
+            with open(os.path.join(path, SIGNATURES_NAME)) as signatures_file:
+                self.entries = json.load(signatures_file)
+        except (IOError, OSError):
+            self.entries = {}
+
+    def unchanged(self, signatures):
+        """
+        Take the current ``signatures``, a dict mapping tables to their
+        signature, and return the tables whose cached file is still good.
+        """
+        self.current = signatures
+        return sorted(
+            table for table, signature in signatures.items()
+            if signature is not None and table in self.entries and self.entries[table]['signature'] == signature
+            and os.path.exists(os.path.join(self.path, self.entries[table]['name']))
+        )
+
+    def copy(self, tables, workdir):
+        """
+        Put the cached files of ``tables`` into ``workdir``. Returns their
+        names.
+        """
+        names = [self.entries[table]['name'] for table in tables]
+        for name in names:
+            _link(os.path.join(self.path, name), os.path.join(workdir, name))
+        return names
+
+    def update(self, workdir, names):
+        """
+        Cache the files of the dump in ``workdir``, ``names`` mapping the
+        tables dumped to their file, with the signatures taken by
+        ``unchanged``. The entries of tables left out of the dump, say by
+        --application, stay.
+        """
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        for table, name in names.items():
+            if table in self.current and os.path.exists(os.path.join(workdir, name)):
+                _link(os.path.join(workdir, name), os.path.join(self.path, name))
+                self.entries[table] = {'name': name, 'signature': self.current[table]}
+            elif table in self.entries:
+                entry = self.entries.pop(table)
+                if os.path.exists(os.path.join(self.path, entry['name'])):
+                    os.remove(os.path.join(self.path, entry['name']))
+        with open(os.path.join(self.path, SIGNATURES_NAME), 'w') as signatures_file:
+            json.dump(self.entries, signatures_file, indent=2, sort_keys=True)
@@ -0,0 +1,95 @@
+"""
+Running the steps of a backup as a graph of tasks.
+
+A task starts on a thread of its own as soon as the tasks it comes after
+are done, up to ``threads`` tasks at once, so that steps waiting on the
+network, the CPU and the disk overlap: the remote cleanup and the media
+archive run while the database is dumped, and every file starts uploading
+as soon as it's written. Tasks of a group run at most ``limits[group]`` at
+a time.
+
+Once a task fails no new task starts; the error is raised when the tasks
+already running are done.
+"""
+import threading
+
+
+THREADS = 4
+
+
+class TaskGraph(object):
+    """
+    Tasks run on up to ``threads`` threads, ``limits`` mapping groups of
+    tasks to how many of them may run at once.
+    """
+
+    def __init__(self, threads=THREADS, limits=None):
+        self.threads = max(1, threads)
+        self.limits = limits or {}
+        self.tasks = []
+        self.results = {}
+
+    def __contains__(self, name):
+        return any(task[0] == name for task in self.tasks)
+
+    def add(self, name, function, after=(), group=None):
+        """
+        Add the task ``name`` calling ``function``, once the tasks named in
+        ``after``, which have to be added first, are done. What it returns
+        goes into ``results``.
+        """
+        unknown = [dependency for dependency in after if dependency not in self]
+        if unknown:
+            raise ValueError('Task %s comes after unknown tasks %s' % (name, ', '.join(unknown)))
+        self.tasks.append((name, function, tuple(after), group))
+
+    def run(self):
+        """
+        Run the tasks and return ``results``.
+        """
+        condition = threading.Condition()
+        pending = list(self.tasks)
+        done = set()
+        errors = []
+        running = []
+        groups = dict((group, 0) for _, _, _, group in self.tasks)
+
+        def work(name, function, group):
+            try:
+                result = function()
+            except Exception as e:
+                with condition:
+                    errors.append(e)
+            else:
+                with condition:
+                    self.results[name] = result
+                    done.add(name)
+            finally:
+                with condition:
+                    running.remove(name)
+                    groups[group] -= 1
+                    condition.notify()
+
+        def ready(after, group):
+            if group is not None and groups[group] >= self.limits.get(group, self.threads):
+                return False
+            return all(dependency in done for dependency in after)
+
+        with condition:
+            while True:
+                for task in list(pending):
+                    name, function, after, group = task
+                    if errors or len(running) >= self.threads or not ready(after, group):
+                        continue
+                    pending.remove(task)
+                    running.append(name)
+                    groups[group] += 1
+                    thread = threading.Thread(target=work, args=(name, function, group))
+                    thread.daemon = True
+                    thread.start()
+                if not running:
+                    break
+                condition.wait()
+        if errors:
+            raise errors[0]
+        return self.results
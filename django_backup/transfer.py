@@ -0,0 +1,231 @@
+"""
+Parallel transfers to and from the remote server.
+
+A single SFTP channel reaches only a fraction of the bandwidth of a high
+latency link, so files are split into ranges which are transferred by several
+connections at once. A file is written under a temporary name and only
+renamed into place once every range has landed. A range that fails is retried
+on a fresh connection, without starting the whole file over.
+
+Uploads can hash the files as they read them, the pieces read by every range
+going through the digest in file order.
+"""
+import hashlib
+import os
+import posixpath
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from django_backup.pool import CONNECTION_ERRORS
+from django_backup.streams import BUFFER_SIZE
+
+
+CHUNK_SIZE = 32 * 1024 * 1024
+RETRIES = 3
+# Bytes read ahead of a file's digest that are held for it, past which the
+# ranges reading further ahead wait.
+DIGEST_BUFFER = 64 * 1024 * 1024
+
+
+def partial_name(filename):
+    """
+    Name a backup file is uploaded under until it is complete. The leading dot
+    keeps it from being mistaken for a backup.
+    """
+    return '.%s.part' % filename
+
+
+def partial_path(path, module=posixpath):
+    directory, filename = module.split(path)
+    return module.join(directory, partial_name(filename))
+
+
+class OrderedDigest(object):
+    """
+    SHA-256 of a file whose pieces arrive out of order, from the ranges
+    reading it. Pieces ahead of what's hashed so far are held until their
+    turn, up to ``buffer_size`` bytes. Once ``abandon`` is called nothing is
+    held or waited for any more and ``hexdigest`` returns None.
+    """
+
+    def __init__(self, buffer_size=DIGEST_BUFFER):
+        self.digest = hashlib.sha256()
+        self.buffer_size = buffer_size
+        self.offset = 0
+        self.pending = {}
+        self.held = 0
+        self.abandoned = False
+        self.condition = threading.Condition()
+
+    def update(self, offset, data):
+        with self.condition:
+            while not self.abandoned and offset > self.offset and self.held + len(data) > self.buffer_size:
+                self.condition.wait()
+            # Pieces already hashed come again when a range is retried.
+            if self.abandoned or offset < self.offset or offset in self.pending:
+                return
+            self.pending[offset] = data
+            self.held += len(data)
+            while self.offset in self.pending:
+                data = self.pending.pop(self.offset)
+                self.held -= len(data)
+                self.digest.update(data)
+                self.offset += len(data)
+            self.condition.notify_all()
+
+    def abandon(self):
+        with self.condition:
+            self.abandoned = True
+            self.pending = {}
+            self.held = 0
+            self.condition.notify_all()
+
+    def hexdigest(self):
+        return None if self.abandoned else self.digest.hexdigest()
+
+
+class ParallelTransfer(object):
+    """
+    Transfers files in ranges of ``chunk_size`` bytes over the connections of
+    ``pool``. ``connection`` is used for metadata operations. A range is tried
+    up to ``retries`` more times if it fails, on a new connection. ``retried``
+    counts the ranges that had to be tried again.
+    """
+
+    def __init__(self, connection, pool, chunk_size=CHUNK_SIZE, retries=RETRIES):
+        self.connection = connection
+        self.pool = pool
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.retried = 0
+        self.lock = threading.Lock()
+
+    def retrying(self, function):
+        """
+        Wrap ``function`` so that it's run again when it fails with a network
+        error. The pool has thrown the connection it failed on away by then.
+        """
+        def wrapper(job):
+            for attempt in range(self.retries + 1):
+                try:
+                    return function(job)
+                except CONNECTION_ERRORS:
+                    if attempt == self.retries:
+                        raise
+                    with self.lock:
+                        self.retried += 1
+                    time.sleep(2 ** attempt)
+        return wrapper
+
+    def ranges(self, size):
+        """
+        Split ``size`` bytes into ``(offset, length)`` ranges. An empty file
+        is still one (empty) range.
+        """
+        return [(offset, min(self.chunk_size, size - offset)) for offset in range(0, size, self.chunk_size)] or [(0, 0)]
+
+    def run(self, function, jobs):
+        pool = ThreadPool(max(1, min(self.pool.size, len(jobs))))
+        try:
+            return pool.map(self.retrying(function), jobs, 1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def put(self, files, checksum=False):
+        """
+        Upload ``(local_path, remote_path)`` pairs, the ranges of all files
+        sharing the pool of connections. With ``checksum``, return the SHA-256
+        of every local path, read while uploading it, or None for the files
+        one of whose ranges failed on the way.
+        """
+        jobs = []
+        digests = {}
+        created = []
+        try:
+            for local_path, remote_path in files:
+                # Create (or truncate) the file every range is written into.
+                self.connection.open(partial_path(remote_path), 'wb').close()
+                created.append(partial_path(remote_path))
+                digests[local_path] = OrderedDigest() if checksum else None
+                jobs += [
+                    (local_path, partial_path(remote_path), offset, length, digests[local_path])
+                    for offset, length in self.ranges(os.path.getsize(local_path))
+                ]
+            self.run(self._put_range, jobs)
+        except Exception:
+            # Nothing lists or cleans up partial files, don't leave them behind.
+            for path in created:
+                try:
+                    self.connection.remove(path)
+                except CONNECTION_ERRORS:
+                    pass
+            raise
+        for local_path, remote_path in files:
+            try:
+                self.connection.remove(remote_path)
+            except IOError:
+                pass
+            self.connection.rename(partial_path(remote_path), remote_path)
+        if checksum:
+            return dict((local_path, digest.hexdigest()) for local_path, digest in digests.items())
+
+    def _put_range(self, job):
+        local_path, remote_path, offset, length, digest = job
+        try:
+            with self.pool.connection() as connection:
+                with open(local_path, 'rb') as local_file, connection.open(remote_path, 'r+b') as remote_file:
+                    remote_file.set_pipelined(True)
+                    local_file.seek(offset)
+                    remote_file.seek(offset)
+                    while length:
+                        data = local_file.read(min(BUFFER_SIZE, length))
+                        if not data:
+                            raise ValueError('%s changed while uploading it' % local_path)
+                        remote_file.write(data)
+                        if digest is not None:
+                            digest.update(offset, data)
+                        offset += len(data)
+                        length -= len(data)
+        except Exception:
+            # Ranges ahead of this one mustn't wait for it to be hashed.
+            if digest is not None:
+                digest.abandon()
+            raise
+
+    def get(self, files):
+        """
+        Download ``(remote_path, local_path)`` pairs, the ranges of all files
+        sharing the pool of connections.
+        """
+        jobs = []
+        for remote_path, local_path in files:
+            size = self.connection.stat(remote_path).st_size
+            local_partial = partial_path(local_path, os.path)
+            with open(local_partial, 'wb') as local_file:
+                local_file.truncate(size)
+            jobs += [
+                (remote_path, local_partial, offset, length)
+                for offset, length in self.ranges(size)
+            ]
+        self.run(self._get_range, jobs)
+        for remote_path, local_path in files:
+            if os.path.exists(local_path):
+                os.remove(local_path)
+            os.rename(partial_path(local_path, os.path), local_path)
+
+    def _get_range(self, job):
+        remote_path, local_path, offset, length = job
+        if not length:
+            return
+        pieces = [
+            (start, min(BUFFER_SIZE, offset + length - start))
+            for start in range(offset, offset + length, BUFFER_SIZE)
+        ]
+        with self.pool.connection() as connection:
+            with connection.open(remote_path, 'rb') as remote_file, open(local_path, 'r+b') as local_file:
+                local_file.seek(offset)
+                # readv keeps the requests for every piece in flight at once.
+                for data in remote_file.readv(pieces):
+                    local_file.write(data)
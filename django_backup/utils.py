@@ -1,11 +1,28 @@
-import calendar
-from datetime import datetime, timedelta
+from contextlib import contextmanager
+from copy import copy
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
 import os
 import re
+import threading
 from django.conf import settings
-from django.core.management import BaseCommand, CommandError
+from django.core.management import BaseCommand
+from django.core.files.storage import default_storage, get_storage_class
+from django.core.management.base import CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
 from pysftp import Connection
 
+from django_backup.catalog import Catalog, make_entry
+from django_backup.mail import EMAIL_MAX_SIZE
+from django_backup.metrics import RunReport
+from django_backup.retention import RetentionPlan
+from django_backup.sqlite import PAGES, PAUSE
+from django_backup.storage import FETCH_THREADS
+from django_backup.streams import BLOCK_SIZE, BUFFER_SIZE
+from django_backup.tasks import THREADS
+from django_backup.pool import CHANNELS, KEEPALIVE, ConnectionPool
+from django_backup.transfer import CHUNK_SIZE, RETRIES, ParallelTransfer
+
 try:
     from urllib.parse import splitport
 except ImportError:
@@ -15,21 +32,83 @@ except ImportError:
 DEFAULT_PORT = 22
 TIME_FORMAT = '%Y%m%d-%H%M%S'
 GOOD_RSYNC_FLAG = '__good_backup'
+MANIFEST_NAME = 'manifest.json'
+# Extensions of the pg_dump custom and directory format backups, the latter
+# being a tar archive of the dump directory.
+PG_FORMATS = {
+    'custom': '.pgdump',
+    'directory': '.pgdir.tar',
+}
+LOG_EXTENSION = '.binlog.tar'
 regex = re.compile(r'(\d){8}-(\d){6}')
+db_backup_regex = re.compile(r'^backup_(?:(?P<alias>.+?)_)?\d{8}-\d{6}')
+rsync_backup_regex = re.compile(r'^dir_\d{8}-\d{6}$')
 
 
 def is_db_backup(filename):
     return filename.startswith('backup_')
 
 
+def db_backup_prefix(alias):
+    """
+    Prefix of the names of the backups of the database ``alias``. Backups of
+    the default database keep the names they always had.
+    """
+    if alias == DEFAULT_DB_ALIAS:
+        return 'backup_'
+    return 'backup_%s_' % alias
+
+
+def get_db_alias(filename):
+    """
+    Return the alias of the database the backup ``filename`` was made of.
+    """
+    match = db_backup_regex.match(filename)
+    return match and match.group('alias') or DEFAULT_DB_ALIAS
+
+
+def is_log_backup(filename):
+    """
+    Whether ``filename`` holds binary logs shipped by backup --logs.
+    """
+    return LOG_EXTENSION in filename
+
+
 def is_media_backup(filename):
     return filename.startswith('dir_')
 
 
+def is_rsync_backup(filename):
+    """
+    Whether ``filename`` is an rsync media backup, a directory rather than an
+    archive.
+    """
+    return rsync_backup_regex.match(filename) is not None
+
+
 def is_backup(filename):
     return is_db_backup(filename) or is_media_backup(filename)
 
 
+def get_pg_format(filename):
+    """
+    Return the pg_dump format of the dump ``filename``, None for plain SQL.
+    """
+    for pg_format, extension in PG_FORMATS.items():
+        if filename.endswith(extension):
+            return pg_format
+    return None
+
+
+def describe_backup(filename, size=None, sha256=None):
+    """
+    Return the catalog entry of the backup file ``filename``.
+    """
+    return make_entry(
+        filename, 'db' if is_db_backup(filename) else 'media', regex.search(filename).group(), size, sha256
+    )
+
+
 def get_date(filename):
     """
     Given the name of the backup file, return the datetime it was created.
@@ -55,61 +134,45 @@ def decide_remove(backups, config):
     """
     Given a list of backup filenames and setttings, decide the files to be deleted.
     """
-    reserve = []
-    remove_list = []
-    reserve += reserve_interval(backups, 'monthly', config['monthly'])
-    reserve += reserve_interval(backups, 'weekly', config['weekly'])
-    reserve += reserve_interval(backups, 'daily', config['daily'])
-    if config.get('hourly', 0):
-        reserve += reserve_interval(backups, 'hourly', config.get('hourly', 0))
-    for i in backups:
-        if i not in reserve:
-            remove_list.append(i)
-    return remove_list
+    return RetentionPlan(backups, config).remove
+
+
+def group_by_alias(backups):
+    """
+    Return a dict mapping database aliases to their backups in ``backups``.
+    """
+    groups = {}
+    for backup in backups:
+        groups.setdefault(get_db_alias(backup), []).append(backup)
+    return groups
+
+
+def decide_remove_db(backups, config):
+    """
+    Like decide_remove, but the backups of every database are kept or
+    removed on their own. Retention is decided on full backups, a binary
+    log backup is removed together with the full backup before it, or when
+    there is no full backup before it to replay it on.
+    """
+    remove = []
+    for alias, group in sorted(group_by_alias(backups).items()):
+        remove_full = set(decide_remove([backup for backup in group if not is_log_backup(backup)], config))
+        base = None
+        for backup in sorted(group, key=get_date):
+            if not is_log_backup(backup):
+                base = backup
+            if base is None or base in remove_full:
+                remove.append(backup)
+    return sorted(remove)
 
 
 def reserve_interval(backups, type, num):
     """
-    Given a list of backup filenames, interval type(monthly, weekly, daily),
-    and the number of backups to keep, return a list of filenames to reserve.
+    Given a list of backup filenames, interval type(hourly, daily, weekly,
+    monthly, yearly), and the number of backups to keep, return a list of
+    filenames to reserve.
     """
-    
-    result = []
-    now = datetime.now()
-    
-    if type == 'monthly':
-        delta = timedelta(30)
-        interval_end = datetime(now.year, now.month, 1)  # begin of the month
-        interval_start = interval_end - delta
-        
-    elif type == 'weekly':
-        delta = timedelta(7)
-        weekday = calendar.weekday(now.year, now.month, now.day)
-        weekday_delta = timedelta(weekday)
-        interval_end = datetime(now.year, now.month, now.day) - weekday_delta  # begin of the week
-        interval_start = interval_end - delta
-        
-    elif type == 'daily':
-        delta = timedelta(1)
-        interval_end = datetime(now.year, now.month, now.day) + delta
-        interval_start = interval_end - delta
-        
-    elif type == 'hourly':
-        delta = timedelta(minutes=60)
-        interval_end = datetime(now.year, now.month, now.day, now.hour) + delta
-        interval_start = interval_end - delta
-        
-    else:
-        raise CommandError("Unknown backup interval")
-        
-    for i in range(1, num + 1):
-        for backup in backups:
-            if between_interval(backup, interval_start, interval_end):
-                result.append(backup)
-                break  # reserve only one backup per interval
-        interval_end = interval_end - delta
-        interval_start = interval_start - delta
-    return result
+    return RetentionPlan(backups, {type: num}).keep
 
 
 class BaseBackupCommand(BaseCommand):
@@ -119,13 +182,9 @@ class BaseBackupCommand(BaseCommand):
         super(BaseBackupCommand, self).__init__()
 
         try:
-            self.engine = settings.DATABASES['default']['ENGINE']
-            self.db = settings.DATABASES['default']['NAME']
-            self.user = settings.DATABASES['default']['USER']
-            self.passwd = settings.DATABASES['default']['PASSWORD']
-            self.host = settings.DATABASES['default']['HOST']
-            self.port = settings.DATABASES['default']['PORT']
+            self.set_database(DEFAULT_DB_ALIAS)
         except NameError:
+            self.alias = DEFAULT_DB_ALIAS
             self.engine = settings.DATABASE_ENGINE
             self.db = settings.DATABASE_NAME
             self.user = settings.DATABASE_USER
@@ -141,14 +200,173 @@ class BaseBackupCommand(BaseCommand):
         self.ftp_password = getattr(settings, 'BACKUP_FTP_PASSWORD', '')
         self.private_key = getattr(settings, 'BACKUP_FTP_PRIVATE_KEY', None)
         self.directory_to_backup = getattr(settings, 'DIRECTORY_TO_BACKUP', settings.MEDIA_ROOT)
+        self.buffer_size = getattr(settings, 'BACKUP_BUFFER_SIZE', BUFFER_SIZE)
+        self.compression_threads = getattr(settings, 'BACKUP_COMPRESSION_THREADS', None)
+        self.compression_block_size = getattr(settings, 'BACKUP_COMPRESSION_BLOCK_SIZE', BLOCK_SIZE)
+        self.repository_chunk_size = getattr(settings, 'BACKUP_REPOSITORY_CHUNK_SIZE', None)
+        self.media_index_path = getattr(settings, 'BACKUP_MEDIA_INDEX', None)
+        self.media_incremental_chain = getattr(settings, 'BACKUP_MEDIA_INCREMENTAL_CHAIN', 6)
+        self.media_storage = getattr(settings, 'BACKUP_MEDIA_STORAGE', None)
+        self.media_storage_options = getattr(settings, 'BACKUP_MEDIA_STORAGE_OPTIONS', {})
+        self.media_fetch_threads = getattr(settings, 'BACKUP_MEDIA_FETCH_THREADS', FETCH_THREADS)
+        self.media_shard_size = getattr(settings, 'BACKUP_MEDIA_SHARD_SIZE', None)
+        self.ftp_streams = getattr(settings, 'BACKUP_FTP_STREAMS', CHANNELS)
+        self.ftp_keepalive = getattr(settings, 'BACKUP_FTP_KEEPALIVE', KEEPALIVE)
+        self.ftp_chunk_size = getattr(settings, 'BACKUP_FTP_CHUNK_SIZE', CHUNK_SIZE)
+        self.ftp_retries = getattr(settings, 'BACKUP_FTP_RETRIES', RETRIES)
+        self.use_catalog = getattr(settings, 'BACKUP_CATALOG', False)
+        self.mysql_binlogs = getattr(settings, 'BACKUP_MYSQL_BINLOGS', False)
+        self.log_state_path = getattr(settings, 'BACKUP_BINLOG_STATE', None)
+        self.table_cache_path = getattr(settings, 'BACKUP_TABLE_CACHE', None)
+        self.sqlite_pages = getattr(settings, 'BACKUP_SQLITE_PAGES', PAGES)
+        self.sqlite_pause = getattr(settings, 'BACKUP_SQLITE_PAUSE', PAUSE)
+        self.email_max_size = getattr(settings, 'BACKUP_EMAIL_MAX_SIZE', EMAIL_MAX_SIZE)
+        self.email_policy = getattr(settings, 'BACKUP_EMAIL_POLICY', 'summary')
+        self.report_file = getattr(settings, 'BACKUP_REPORT_FILE', None)
+        self.prometheus_file = getattr(settings, 'BACKUP_PROMETHEUS_FILE', None)
+        self.databases = getattr(settings, 'BACKUP_DATABASES', [DEFAULT_DB_ALIAS])
+        self.database_concurrency = getattr(settings, 'BACKUP_DATABASE_CONCURRENCY', 2)
+        self.task_concurrency = getattr(settings, 'BACKUP_TASK_CONCURRENCY', THREADS)
+        self.report = RunReport()
+        # Keeps the appends and removal records of concurrent tasks from
+        # interleaving in the catalog, a file shared over SFTP.
+        self.catalog_lock = threading.Lock()
 
-    def get_connection(self):
+    def set_database(self, alias):
         """
-        Get the ssh connection to the remote server.
+        Work on the database ``alias`` of settings.DATABASES.
         """
-        if getattr(self, '_ssh', None):
-            return self._ssh
+        database = settings.DATABASES[alias]
+        self.alias = alias
+        self.engine = database['ENGINE']
+        self.db = database['NAME']
+        self.user = database.get('USER', '')
+        self.passwd = database.get('PASSWORD', '')
+        self.host = database.get('HOST', '')
+        self.port = database.get('PORT', '')
+
+    def for_database(self, alias):
+        """
+        Return a copy of the command working on the database ``alias``.
+        """
+        command = copy(self)
+        command.set_database(alias)
+        return command
+
+    @property
+    def db_connection(self):
+        return connections[self.alias]
 
+    def get_database_aliases(self, options):
+        """
+        Aliases of the databases chosen with --database or --all-databases,
+        BACKUP_DATABASES by default.
+        """
+        if options.get('all_databases'):
+            return sorted(settings.DATABASES, key=lambda alias: (alias != DEFAULT_DB_ALIAS, alias))
+        aliases = options.get('databases') or self.databases
+        unknown = [alias for alias in aliases if alias not in settings.DATABASES]
+        if unknown:
+            raise CommandError('Unknown database %s, configured databases are %s.' % (
+                ', '.join(unknown), ', '.join(sorted(settings.DATABASES))))
+        return aliases
+
+    def get_database_commands(self, aliases):
+        """
+        One command per database of ``aliases``, this one for its own.
+        """
+        return [self if alias == self.alias else self.for_database(alias) for alias in aliases]
+
+    def for_each_database(self, commands, function):
+        """
+        Call ``function`` with each of ``commands``, for up to
+        BACKUP_DATABASE_CONCURRENCY databases at once. Returns the results in
+        order. Each database runs on a copy of its command, using its own
+        connection to the remote server.
+        """
+        if len(commands) < 2:
+            return [function(command) for command in commands]
+
+        def run(command):
+            try:
+                if getattr(self, '_ssh', None) is None:
+                    return function(command)
+                # An SFTP connection can't be used by several threads at
+                # once, every database borrows one from the pool.
+                with self.get_pool().connection() as ssh:
+                    worker = copy(command)
+                    worker._ssh = ssh
+                    return function(worker)
+            finally:
+                # Database connections belong to the thread that opened them.
+                connections[command.alias].close()
+
+        pool = ThreadPool(min(self.database_concurrency, len(commands)))
+        try:
+            return pool.map(run, commands, 1)
+        finally:
+            pool.close()
+
+    def get_media_storage(self):
+        """
+        The storage backend holding the media when BACKUP_MEDIA_STORAGE is
+        set, 'default' meaning DEFAULT_FILE_STORAGE. None when the media is
+        in DIRECTORY_TO_BACKUP.
+        """
+        if not self.media_storage:
+            return None
+        if self.media_storage == 'default':
+            return default_storage
+        return get_storage_class(self.media_storage)(**self.media_storage_options)
+
+    def get_environ(self):
+        """
+        Environment of the database client processes. The PostgreSQL password
+        goes there rather than into os.environ, which is shared by the threads
+        working on other databases.
+        """
+        environ = dict(os.environ)
+        if self.passwd and 'postgresql' in self.engine:
+            environ['PGPASSWORD'] = self.passwd
+        return environ
+
+    @contextmanager
+    def reporting(self, command):
+        """
+        Collect the stages run in the ``with`` block into a new report and
+        write it to BACKUP_REPORT_FILE and BACKUP_PROMETHEUS_FILE when done,
+        even if the block fails.
+        """
+        self.report = RunReport(command)
+        success = False
+        try:
+            yield self.report
+            success = True
+        finally:
+            self.report.finish(success)
+            self.write_report()
+
+    def stage(self, name, bytes_in=None):
+        if self.alias != DEFAULT_DB_ALIAS:
+            name = '%s:%s' % (self.alias, name)
+        return self.report.stage(name, bytes_in)
+
+    def write_report(self):
+        for stage in self.report.stages:
+            self.stdout.write('Stage %s: %.1fs, %s bytes in, %s bytes out%s' % (
+                stage.name, stage.seconds,
+                '?' if stage.bytes_in is None else stage.bytes_in,
+                '?' if stage.bytes_out is None else stage.bytes_out,
+                ', %s retries' % stage.retries if stage.retries else '',
+            ))
+        # %(command)s keeps the reports of backup and restore apart.
+        names = {'command': self.report.command}
+        if self.report_file:
+            self.report.write_json(self.report_file % names)
+        if self.prometheus_file:
+            self.report.write_prometheus(self.prometheus_file % names)
+
+    def get_connection_config(self):
         conn_config = {
             'host': self.ftp_server,
             'username': self.ftp_username,
@@ -171,11 +389,88 @@ class BaseBackupCommand(BaseCommand):
             conn_config['password'] = None
         else:
             conn_config['password'] = self.ftp_password
+        return conn_config
 
-        self._ssh = Connection(**conn_config)
+    def open_connection(self):
+        """
+        Open a new ssh connection to the remote server.
+        """
+        connection = Connection(**self.get_connection_config())
+        if self.ftp_keepalive:
+            connection.sftp_client.get_channel().get_transport().set_keepalive(self.ftp_keepalive)
+        return connection
+
+    @staticmethod
+    def connection_is_alive(connection):
+        try:
+            return connection.sftp_client.get_channel().get_transport().is_active()
+        except Exception:
+            return False
+
+    def get_connection(self):
+        """
+        Get the ssh connection to the remote server, reconnecting if it was
+        lost.
+        """
+        if getattr(self, '_ssh', None):
+            if self.connection_is_alive(self._ssh):
+                return self._ssh
+            self._ssh.close()
+
+        self._ssh = self.open_connection()
         return self._ssh
 
+    def get_pool(self):
+        """
+        Pool of up to BACKUP_FTP_STREAMS connections for parallel work, on top
+        of the one returned by get_connection.
+        """
+        if getattr(self, '_pool', None) is None:
+            self._pool = ConnectionPool(self.open_connection, self.ftp_streams, self.connection_is_alive)
+        return self._pool
+
+    def get_transfer(self):
+        return ParallelTransfer(
+            self.get_connection(), self.get_pool(), chunk_size=self.ftp_chunk_size, retries=self.ftp_retries,
+        )
+
+    def make_remote_dir(self):
+        """
+        Create the remote backup directory if it doesn't exist yet.
+        """
+        if self.remote_dir:
+            try:
+                self.get_connection().mkdir(self.remote_dir)
+            except IOError:
+                pass
+
+    def list_remote_backups(self, remote_dir):
+        """
+        Return the names in ``remote_dir``, taken from the backup catalog when
+        BACKUP_CATALOG is set and the catalog exists.
+        """
+        sftp = self.get_connection()
+        if self.use_catalog:
+            names = Catalog(sftp, remote_dir).names()
+            if names is not None:
+                return names
+            self.stdout.write('No backup catalog in %s, listing the directory. '
+                              'Run the rebuild_catalog command to recreate it.' % remote_dir)
+        return [i.strip() for i in sftp.listdir(remote_dir)]
+
+    def catalog_add(self, entries):
+        if self.use_catalog:
+            with self.catalog_lock:
+                Catalog(self.get_connection(), self.remote_dir).add(entries)
+
+    def catalog_remove(self, names):
+        if self.use_catalog:
+            with self.catalog_lock:
+                Catalog(self.get_connection(), self.remote_dir).remove(names)
+
     def close_connection(self):
+        if getattr(self, '_pool', None):
+            self._pool.close()
         if getattr(self, '_ssh', None):
             self._ssh.close()
 
@@ -13,6 +13,11 @@ setup(
     packages=find_packages(exclude=('test_project',)),
     include_package_data=True,
     install_requires=['pysftp'],
+    extras_require={
+        'zstd': ['zstandard'],
+        'lz4': ['lz4'],
+        'encrypt': ['cryptography'],
+    },
     classifiers=[
         'Programming Language :: Python',
         'Programming Language :: Python :: 2.7',
@@ -1,9 +1,13 @@
 import datetime
+import json
 import os
 import pytest
 import re
 import subprocess
+import tarfile
+import threading
 
+from django.core import mail
 from django.core.management import call_command, CommandError
 
 
@@ -22,6 +26,32 @@ def test_compressed_backup_generation(tmpdir, settings, db):
                     tmpdir.listdir()[0].basename)
 
 
+def test_backup_report(tmpdir, settings, db):
+    settings.BACKUP_LOCAL_DIRECTORY = str(tmpdir.mkdir('backups'))
+    settings.BACKUP_REPORT_FILE = str(tmpdir.join('%(command)s.json'))
+    settings.BACKUP_PROMETHEUS_FILE = str(tmpdir.join('%(command)s.prom'))
+    call_command('backup', compress=True)
+    report = json.loads(tmpdir.join('backup.json').read())
+    assert report['success'] is True
+    assert [stage['name'] for stage in report['stages']] == ['dump', 'compress']
+    dump, compress = report['stages']
+    assert dump['bytes_out'] == compress['bytes_in']
+    assert compress['bytes_out'] == os.path.getsize(tmpdir.join('backups').listdir()[0].strpath)
+    assert 'django_backup_last_run_success{command="backup"} 1.0' in tmpdir.join('backup.prom').read()
+
+
+def test_backup_email_in_parts(tmpdir, settings, db):
+    settings.BACKUP_LOCAL_DIRECTORY = str(tmpdir)
+    settings.BACKUP_EMAIL_MAX_SIZE = 1024
+    settings.BACKUP_EMAIL_POLICY = 'split'
+    call_command('backup', email='admin@example.com')
+    backup = tmpdir.listdir()[0]
+    assert len(mail.outbox) == -(-backup.size() // 1024)
+    attached = [part.get_payload(decode=True)
+                for message in mail.outbox for part in message.message().get_payload()[1:]]
+    assert b''.join(attached) == backup.read_binary()
+
+
 def test_zipencrypt_without_password(tmpdir, settings, db):
     """
     If you don't specify a password for the zipencrypt option, the call should
@@ -46,6 +76,30 @@ def test_zipencrypt_of_backup(tmpdir, settings, db):
         assert len(tmpdir.listdir()) == 2
 
 
+def test_encrypted_backup(tmpdir, settings, db):
+    pytest.importorskip('cryptography')
+    from django_backup.crypto import DecryptStage
+    from django_backup.streams import DetectDecompressStage, pump
+
+    settings.BACKUP_LOCAL_DIRECTORY = str(tmpdir)
+    os.environ['BACKUP_PASSWORD'] = 'password'
+    call_command('backup', compress=True, encrypt=True)
+    assert len(tmpdir.listdir()) == 1
+    file_ = tmpdir.listdir()[0]
+    assert re.match(r'backup_\d{8}-\d{6}\.sql\.gz\.aes', file_.basename)
+    with open(str(file_), 'rb') as source:
+        with open(str(tmpdir.join('plain.sql')), 'wb') as sink:
+            pump(source, sink, [DecryptStage('password'), DetectDecompressStage()])
+    assert 'auth_user' in tmpdir.join('plain.sql').read()
+
+
+def test_encrypt_with_zipencrypt(tmpdir, settings, db):
+    settings.BACKUP_LOCAL_DIRECTORY = str(tmpdir)
+    os.environ['BACKUP_PASSWORD'] = 'password'
+    with pytest.raises(CommandError):
+        call_command('backup', encrypt=True, zipencrypt=True)
+
+
 def test_backup_sftp_upload(tmpdir, settings, db, sftpserver):
     settings.BACKUP_LOCAL_DIRECTORY = str(tmpdir)
     settings.BACKUP_FTP_SERVER = '{}:{}'.format(
@@ -82,6 +136,14 @@ def test_backup_with_media(tmpdir, settings, db):
     assert len([f for f in tmpdir.listdir() if f.basename.startswith('dir_')]) == 1
 
 
+def test_media_directory_is_not_kept_for_the_next_run(tmpdir, settings, db):
+    settings.BACKUP_LOCAL_DIRECTORY = str(tmpdir.mkdir('media'))
+    call_command('backup', media=True)
+    settings.BACKUP_LOCAL_DIRECTORY = str(tmpdir.mkdir('database'))
+    call_command('backup')
+    assert len(tmpdir.join('database').listdir()) == 1
+
+
 def test_surplus_local_db_removal_without_setting(tmpdir, settings, db):
     """
     If the user requests a cleanup but forgets to set the
@@ -123,6 +185,62 @@ def test_surplus_local_db_removal(tmpdir, settings, db):
     assert (old_files - set([todays_file])).isdisjoint(found_files)
 
 
+def test_surplus_local_db_removal_per_database(tmpdir, settings, db):
+    settings.BACKUP_LOCAL_DIRECTORY = str(tmpdir)
+    settings.BACKUP_DATABASE_COPIES = {
+        'daily': 1,
+    }
+    today = datetime.datetime.now().strftime('%Y%m%d')
+    todays_files = set([
+        'backup_{}-010000.sql'.format(today),
+        'backup_analytics_{}-010000.sql'.format(today),
+    ])
+    old_files = set(['backup_20140101-010000.sql', 'backup_analytics_20140101-010000.sql'])
+    for f in todays_files | old_files:
+        tmpdir.join(f).write('')
+    call_command('backup', clean_local_db=True)
+    found_files = set([f.basename for f in tmpdir.listdir()])
+    # Every database keeps its own daily backup.
+    assert todays_files <= found_files
+    assert old_files.isdisjoint(found_files)
+
+
+def test_backup_of_unknown_database(tmpdir, settings, db):
+    settings.BACKUP_LOCAL_DIRECTORY = str(tmpdir)
+    with pytest.raises(CommandError):
+        call_command('backup', databases=['nope'])
+
+
+def test_application_backup(tmpdir, settings, db):
+    settings.BACKUP_LOCAL_DIRECTORY = str(tmpdir)
+    call_command('backup', apps=['sessions'])
+    dump = tmpdir.listdir()[0].read()
+    assert 'django_session' in dump
+    assert 'auth_user' not in dump
+
+
+def test_backup_of_unknown_application(tmpdir, settings, db):
+    settings.BACKUP_LOCAL_DIRECTORY = str(tmpdir)
+    with pytest.raises(CommandError):
+        call_command('backup', apps=['nope'])
+
+
+def test_surplus_local_db_removal_dry_run(tmpdir, settings, db):
+    settings.BACKUP_LOCAL_DIRECTORY = str(tmpdir)
+    settings.BACKUP_DATABASE_COPIES = {
+        'daily': 1,
+    }
+    old_files = set([
+        'backup_20140101-010000.sql',
+        'backup_20140102-010000.sql',
+    ])
+    for f in old_files:
+        tmpdir.join(f).write('')
+    call_command('backup', clean_local_db=True, cleanlocaldb=True, dry_run=True)
+    # Nothing is removed and no backup is made.
+    assert set([f.basename for f in tmpdir.listdir()]) == old_files
+
+
 def test_surplus_remote_db_removal(tmpdir, settings, db, sftpserver):
     settings.BACKUP_FTP_SERVER = '{}:{}'.format(
         sftpserver.host, sftpserver.port)
@@ -181,3 +299,169 @@ def test_surplus_media_removal(tmpdir, settings, db, sftpserver):
             removed_files)
         assert todays_file in [f.basename for f in tmpdir.listdir()]
         assert set(server_fs['backups'].keys()).isdisjoint(removed_files)
+
+
+def test_streamed_backup_sftp_upload(tmpdir, settings, db, sftpserver):
+    settings.BACKUP_LOCAL_DIRECTORY = str(tmpdir)
+    settings.BACKUP_FTP_SERVER = '{}:{}'.format(
+        sftpserver.host, sftpserver.port)
+    settings.BACKUP_FTP_USERNAME = 'username'
+    settings.BACKUP_FTP_PASSWORD = 'password'
+    settings.BACKUP_FTP_DIRECTORY = '/backups'
+    server_fs = {'backups': {}}
+    with sftpserver.serve_content(server_fs):
+        call_command('backup', ftp=True, stream=True, compress=True,
+                     no_local=True)
+        assert 1 == len(server_fs['backups'])
+        assert re.match(r'backup_\d{8}-\d{6}\.sql\.gz',
+                        list(server_fs['backups'].keys())[0])
+        # Nothing is written locally with --nolocal.
+        assert 0 == len(tmpdir.listdir())
+
+
+def test_failed_stream_leaves_nothing_behind(tmpdir, settings, db, sftpserver, monkeypatch):
+    from django_backup.management.commands.backup import Command
+    monkeypatch.setattr(Command, 'get_dump_command', lambda self: 'echo partial; exit 1')
+    settings.BACKUP_LOCAL_DIRECTORY = str(tmpdir)
+    settings.BACKUP_FTP_SERVER = '{}:{}'.format(
+        sftpserver.host, sftpserver.port)
+    settings.BACKUP_FTP_USERNAME = 'username'
+    settings.BACKUP_FTP_PASSWORD = 'password'
+    settings.BACKUP_FTP_DIRECTORY = '/backups'
+    server_fs = {'backups': {}}
+    with sftpserver.serve_content(server_fs):
+        with pytest.raises(CommandError):
+            call_command('backup', ftp=True, stream=True, compress=True)
+        assert 0 == len(server_fs['backups'])
+        assert 0 == len(tmpdir.listdir())
+
+
+def test_stream_with_zipencrypt(tmpdir, settings, db):
+    settings.BACKUP_LOCAL_DIRECTORY = str(tmpdir)
+    os.environ['BACKUP_PASSWORD'] = 'password'
+    with pytest.raises(CommandError):
+        call_command('backup', stream=True, zipencrypt=True)
+
+
+def test_parallel_backup_generation(tmpdir, settings, db):
+    settings.BACKUP_LOCAL_DIRECTORY = str(tmpdir)
+    call_command('backup', parallel=2)
+    assert len(tmpdir.listdir()) == 1
+    file_ = tmpdir.listdir(lambda f: f.basename.startswith('backup_'))[0]
+    assert re.match(r'backup_\d{8}-\d{6}\.tar', file_.basename)
+    with tarfile.open(str(file_)) as archive:
+        manifest = json.loads(
+            archive.extractfile('manifest.json').read().decode('utf-8'))
+        names = archive.getnames()
+    assert manifest['steps']
+    for step in manifest['steps']:
+        assert set(step) <= set(names)
+
+
+def test_mysql_parallel_backup_is_split_per_table(tmpdir, settings, db):
+    if 'mysql' not in settings.DATABASES['default']['ENGINE']:
+        pytest.skip('MySQL only')
+    settings.BACKUP_LOCAL_DIRECTORY = str(tmpdir)
+    call_command('backup', parallel=2)
+    file_ = tmpdir.listdir(lambda f: f.basename.startswith('backup_'))[0]
+    with tarfile.open(str(file_)) as archive:
+        manifest = json.loads(
+            archive.extractfile('manifest.json').read().decode('utf-8'))
+        schema = archive.extractfile('schema.sql').read().decode('utf-8')
+    assert manifest['steps'][0] == ['schema.sql']
+    assert 'data_auth_user.sql' in manifest['steps'][1]
+    assert 'indexes_auth_user_groups.sql' in manifest['steps'][2]
+    assert manifest['steps'][3] == ['constraints.sql']
+    assert 'CONSTRAINT' not in schema
+
+
+def test_pg_format_backup_generation(tmpdir, settings, db):
+    if 'postgresql' not in settings.DATABASES['default']['ENGINE']:
+        with pytest.raises(CommandError):
+            call_command('backup', pg_format='custom')
+        return
+    settings.BACKUP_LOCAL_DIRECTORY = str(tmpdir)
+    call_command('backup', pg_format='custom')
+    call_command('backup', pg_format='directory', parallel=2)
+    names = sorted(f.basename for f in tmpdir.listdir())
+    assert re.match(r'backup_\d{8}-\d{6}\.pgdir\.tar$', names[0])
+    assert re.match(r'backup_\d{8}-\d{6}\.pgdump$', names[1])
+    assert tmpdir.join(names[1]).read('rb').startswith(b'PGDMP')
+    assert 'toc.dat' in tarfile.open(str(tmpdir.join(names[0]))).getnames()
+
+
+def test_compressed_backup_generation_with_codec(tmpdir, settings, db):
+    pytest.importorskip('lzma')
+    settings.BACKUP_LOCAL_DIRECTORY = str(tmpdir)
+    call_command('backup', compress='xz')
+    assert len(tmpdir.listdir()) == 1
+    assert re.match(r'backup_\d{8}-\d{6}\.sql\.xz',
+                    tmpdir.listdir()[0].basename)
+
+
+def test_compress_with_unknown_codec(tmpdir, settings, db):
+    settings.BACKUP_LOCAL_DIRECTORY = str(tmpdir)
+    with pytest.raises(CommandError):
+        call_command('backup', compress='rar')
+
+
+def test_repository_backup(tmpdir, settings, db, sftpserver):
+    settings.BACKUP_LOCAL_DIRECTORY = str(tmpdir)
+    settings.BACKUP_FTP_SERVER = '{}:{}'.format(
+        sftpserver.host, sftpserver.port)
+    settings.BACKUP_FTP_USERNAME = 'username'
+    settings.BACKUP_FTP_PASSWORD = 'password'
+    settings.BACKUP_FTP_DIRECTORY = '/backups'
+    server_fs = {'backups': {}}
+    with sftpserver.serve_content(server_fs):
+        call_command('backup', ftp=True, repository=True, no_local=True)
+        manifests = [f for f in server_fs['backups']
+                     if f.endswith('.manifest')]
+        assert 1 == len(manifests)
+        assert re.match(r'backup_\d{8}-\d{6}\.sql\.manifest', manifests[0])
+        assert server_fs['backups']['chunks']
+        assert 0 == len(tmpdir.listdir())
+
+
+def test_incremental_media_backup(tmpdir, settings, db):
+    settings.BACKUP_LOCAL_DIRECTORY = str(tmpdir)
+    media = tmpdir.mkdir('media')
+    settings.DIRECTORY_TO_BACKUP = str(media)
+    media.join('a.txt').write('a')
+    call_command('backup', media=True, incremental=True)
+    media.join('b.txt').write('b')
+    call_command('backup', media=True, incremental=True)
+    archives = sorted(f.basename for f in tmpdir.listdir()
+                      if f.basename.startswith('dir_'))
+    assert len(archives) == 2
+    assert [a for a in archives if a.endswith('.inc.tar.gz')]
+    assert [a for a in archives if not a.endswith('.inc.tar.gz')]
+
+
+def test_sharded_media_backup(tmpdir, settings, db):
+    settings.BACKUP_LOCAL_DIRECTORY = str(tmpdir)
+    media = tmpdir.mkdir('media')
+    settings.DIRECTORY_TO_BACKUP = str(media)
+    for name in ('a.bin', 'b.bin', 'c.bin'):
+        media.join(name).write(os.urandom(600 * 1024), mode='wb')
+    call_command('backup', media=True, shard_size=1)
+    archives = sorted(f.basename for f in tmpdir.listdir()
+                      if f.basename.startswith('dir_'))
+    assert len(archives) == 4
+    assert archives[-1].endswith('.shards.json')
+    shards = json.loads(tmpdir.join(archives[-1]).read())['shards']
+    assert [shard['name'] for shard in shards] == archives[:-1]
+
+
+def test_marker_split_across_reads_starts_the_dump(tmpdir):
+    from django_backup.management.commands.backup import MYSQLDUMP_DATA_MARKER, dump_to_file
+    started = threading.Event()
+    command = "printf %%s '%s'; sleep 0.2; printf %%s '%s'; sleep 2" % (
+        MYSQLDUMP_DATA_MARKER[:10].decode(), MYSQLDUMP_DATA_MARKER[10:].decode())
+    thread = threading.Thread(target=dump_to_file, args=(command, str(tmpdir.join('dump.sql')), started,
+                                                         MYSQLDUMP_DATA_MARKER))
+    thread.start()
+    # Set before the command ends.
+    assert started.wait(1.5)
+    thread.join()
+    assert tmpdir.join('dump.sql').read_binary() == MYSQLDUMP_DATA_MARKER
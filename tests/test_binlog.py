@@ -0,0 +1,62 @@
+from datetime import datetime
+
+import pytest
+
+from django_backup.binlog import LogState, check_sequence, get_log_chain, read_position
+from django_backup.utils import decide_remove_db
+
+
+BACKUPS = [
+    'backup_20150616-010000.sql.gz',
+    'backup_20150616-020000.binlog.tar.gz',
+    'backup_20150617-010000.sql.gz',
+    'backup_20150617-020000.binlog.tar.gz',
+    'backup_20150617-030000.binlog.tar.gz',
+]
+
+
+def test_log_chain():
+    assert get_log_chain(BACKUPS) == BACKUPS[2:]
+    assert get_log_chain(BACKUPS, datetime(2015, 6, 17, 2, 30)) == BACKUPS[2:]
+    assert get_log_chain(BACKUPS, datetime(2015, 6, 17, 2, 0)) == BACKUPS[2:4]
+    # Logs are shipped continuously, those after the next full backup hold
+    # what happened before it as well.
+    assert get_log_chain(BACKUPS, datetime(2015, 6, 16, 12, 0)) == BACKUPS[:2] + BACKUPS[3:4]
+    assert get_log_chain(BACKUPS, datetime(2015, 6, 15)) == []
+
+
+def test_logs_are_removed_with_their_full_backup():
+    # The yearly tier keeps the first backup of the year.
+    assert decide_remove_db(BACKUPS, {'yearly': 20}) == BACKUPS[2:]
+
+
+def test_logs_without_a_full_backup_are_removed():
+    # Left over once the full backup before them was removed.
+    backups = ['backup_20150615-020000.binlog.tar.gz'] + BACKUPS
+    assert decide_remove_db(backups, {'yearly': 20}) == backups[:1] + BACKUPS[2:]
+
+
+def test_read_position(tmpdir):
+    dump = tmpdir.join('backup_20150617-010000.sql')
+    dump.write("-- MySQL dump\n--\n-- CHANGE MASTER TO MASTER_LOG_FILE='binlog.000042', MASTER_LOG_POS=1234;\n")
+    assert read_position(str(dump)) == ('binlog.000042', 1234)
+    dump.write('-- MySQL dump\n')
+    assert read_position(str(dump)) is None
+
+
+def test_check_sequence():
+    check_sequence(['binlog.000009', 'binlog.000010'], ('binlog.000009', 120))
+    with pytest.raises(ValueError):
+        check_sequence(['binlog.000010'], ('binlog.000009', 120))
+    with pytest.raises(ValueError):
+        check_sequence(['binlog.000009', 'binlog.000011'], ('binlog.000009', 120))
+
+
+def test_log_state_is_committed(tmpdir):
+    path = str(tmpdir.join('.binlog_state.json'))
+    state = LogState(path)
+    assert state.get('default') is None
+    state.ship('default', 'binlog.000003')
+    assert LogState(path).get('default') is None
+    state.commit()
+    assert LogState(path).get('default') == 'binlog.000003'
@@ -0,0 +1,59 @@
+import io
+import os
+
+from django_backup.catalog import Catalog, make_entry
+
+
+class LocalFile(io.FileIO):
+
+    def prefetch(self):
+        pass
+
+
+class LocalConnection(object):
+    """
+    Stands in for a pysftp connection, on the local filesystem.
+    """
+
+    def open(self, path, mode):
+        return LocalFile(path, {'rb': 'r', 'wb': 'w', 'a': 'a'}[mode])
+
+    def remove(self, path):
+        os.remove(path)
+
+    def rename(self, old_path, new_path):
+        os.rename(old_path, new_path)
+
+
+def entry(name, size=10):
+    return make_entry(name, 'db', name[7:22], size, None)
+
+
+def test_missing_catalog(tmpdir):
+    assert Catalog(LocalConnection(), str(tmpdir)).read() is None
+
+
+def test_add_and_remove(tmpdir):
+    catalog = Catalog(LocalConnection(), str(tmpdir))
+    catalog.add([entry('backup_20150102-000000.sql'), entry('backup_20150101-000000.sql')])
+    catalog.add([entry('backup_20150103-000000.sql')])
+    catalog.remove(['backup_20150102-000000.sql'])
+    assert catalog.names() == ['backup_20150101-000000.sql', 'backup_20150103-000000.sql']
+    assert catalog.read()[0] == dict(entry('backup_20150101-000000.sql'), op='add')
+
+
+def test_interrupted_append_is_ignored(tmpdir):
+    catalog = Catalog(LocalConnection(), str(tmpdir))
+    catalog.add([entry('backup_20150101-000000.sql')])
+    with open(catalog.path, 'a') as catalog_file:
+        catalog_file.write('{"name": "backup_2015')
+    catalog.add([entry('backup_20150102-000000.sql')])
+    assert catalog.names() == ['backup_20150101-000000.sql', 'backup_20150102-000000.sql']
+
+
+def test_rewrite(tmpdir):
+    catalog = Catalog(LocalConnection(), str(tmpdir))
+    catalog.add([entry('backup_20150101-000000.sql')])
+    catalog.rewrite([entry('backup_20150102-000000.sql')])
+    assert catalog.names() == ['backup_20150102-000000.sql']
+    assert sorted(os.listdir(str(tmpdir))) == ['.backup_catalog.jsonl']
@@ -0,0 +1,68 @@
+import io
+
+import pytest
+
+from django_backup.crypto import HEADER, DecryptionError, DecryptStage, EncryptStage, is_encrypted
+from django_backup.streams import CompressStage, DetectDecompressStage, get_codec, pump
+
+pytest.importorskip('cryptography')
+
+
+def encrypt(data, password='secret', **kwargs):
+    out = io.BytesIO()
+    kwargs.setdefault('iterations', 1000)
+    pump(io.BytesIO(data), out, [EncryptStage(password, **kwargs)], buffer_size=1000)
+    return out.getvalue()
+
+
+def decrypt(data, password='secret'):
+    out = io.BytesIO()
+    pump(io.BytesIO(data), out, [DecryptStage(password, threads=2)], buffer_size=777)
+    return out.getvalue()
+
+
+def test_roundtrip():
+    data = b'INSERT INTO foo VALUES (1);\n' * 10000
+    encrypted = encrypt(data, threads=4, chunk_size=4096)
+    assert is_encrypted(encrypted)
+    assert b'INSERT' not in encrypted
+    assert decrypt(encrypted) == data
+
+
+@pytest.mark.parametrize('size', [0, 4096, 4097])
+def test_chunk_boundaries(size):
+    data = b'x' * size
+    assert decrypt(encrypt(data, chunk_size=4096)) == data
+
+
+def test_compressed_roundtrip():
+    data = b'INSERT INTO foo VALUES (1);\n' * 10000
+    out = io.BytesIO()
+    pump(io.BytesIO(data), out, [CompressStage(get_codec('gzip'), block_size=5000), EncryptStage('secret')])
+    plain = io.BytesIO()
+    pump(io.BytesIO(out.getvalue()), plain, [DecryptStage('secret'), DetectDecompressStage()])
+    assert plain.getvalue() == data
+
+
+def test_wrong_password():
+    with pytest.raises(DecryptionError):
+        decrypt(encrypt(b'data'), 'wrong')
+
+
+def test_tampering_is_detected():
+    encrypted = bytearray(encrypt(b'x' * 10000, chunk_size=4096))
+    encrypted[HEADER.size + 100] ^= 1
+    with pytest.raises(DecryptionError):
+        decrypt(bytes(encrypted))
+
+
+def test_truncation_is_detected():
+    encrypted = encrypt(b'x' * 10000, chunk_size=4096)
+    # Cut after the first of three chunks, on a chunk boundary.
+    with pytest.raises(DecryptionError):
+        decrypt(encrypted[:HEADER.size + 5 + 4096 + 16])
+
+
+def test_not_encrypted():
+    with pytest.raises(DecryptionError):
+        decrypt(b'-- SQL dump\n' * 10)
@@ -0,0 +1,46 @@
+import base64
+import hashlib
+
+from django_backup.mail import backup_messages, plan_messages
+
+
+def test_plan_messages():
+    files = [('/b/one.sql', 40), ('/b/two.sql', 70), ('/b/dir.tar.gz', 250), ('/b/three.sql', 0)]
+    assert plan_messages(files, 100) == [
+        [('/b/one.sql', 0, 40, 'one.sql')],
+        [('/b/two.sql', 0, 70, 'two.sql'), ('/b/dir.tar.gz', 0, 30, 'dir.tar.gz.part-001')],
+        [('/b/dir.tar.gz', 30, 100, 'dir.tar.gz.part-002')],
+        [('/b/dir.tar.gz', 130, 100, 'dir.tar.gz.part-003')],
+        [('/b/dir.tar.gz', 230, 20, 'dir.tar.gz.part-004'), ('/b/three.sql', 0, 0, 'three.sql')],
+    ]
+
+
+def test_split_backup_is_joined_again(tmpdir):
+    data = bytes(bytearray(range(256))) * 10
+    backup = tmpdir.join('backup_20150617-010000.sql')
+    backup.write(data, mode='wb')
+    messages = list(backup_messages(
+        [str(backup)], 'Backup', 'Body', 'from@example.com', ['to@example.com'], 1000, policy='split',
+    ))
+    assert [message.subject for message in messages] == ['Backup (1/3)', 'Backup (2/3)', 'Backup (3/3)']
+    parts = [part for message in messages for part in message.message().get_payload()[1:]]
+    assert [part.get_filename() for part in parts] == [
+        'backup_20150617-010000.sql.part-001',
+        'backup_20150617-010000.sql.part-002',
+        'backup_20150617-010000.sql.part-003',
+    ]
+    assert b''.join(base64.b64decode(part.get_payload()) for part in parts) == data
+    assert 'cat name.part-* > name' in messages[0].body
+
+
+def test_summary_instead_of_large_backup(tmpdir):
+    backup = tmpdir.join('backup_20150617-010000.sql')
+    backup.write(b'x' * 2000, mode='wb')
+    messages = list(backup_messages(
+        [str(backup)], 'Backup', 'Body', 'from@example.com', ['to@example.com'], 1000,
+        location=lambda path: 'sftp.example.com:/backups/backup_20150617-010000.sql',
+    ))
+    assert len(messages) == 1
+    assert not messages[0].attachments
+    assert 'SHA-256 %s' % hashlib.sha256(b'x' * 2000).hexdigest() in messages[0].body
+    assert 'sftp.example.com:/backups/backup_20150617-010000.sql' in messages[0].body
@@ -0,0 +1,60 @@
+import json
+
+from django_backup.metrics import RunReport, path_size
+
+
+def test_stage_measures():
+    report = RunReport('backup')
+    with report.stage('compress', bytes_in=1000) as stage:
+        stage.bytes_out = 250
+    report.finish(True)
+    stage = report.stages[0]
+    assert stage.seconds >= 0
+    assert stage.compression_ratio == 4.0
+    assert report.as_dict()['stages'][0]['name'] == 'compress'
+
+
+def test_failed_stage_is_recorded():
+    report = RunReport('restore')
+    try:
+        with report.stage('download'):
+            raise IOError('connection lost')
+    except IOError:
+        pass
+    assert [stage.name for stage in report.stages] == ['download']
+
+
+def test_json_report(tmpdir):
+    report = RunReport('backup')
+    with report.stage('dump') as stage:
+        stage.bytes_out = 10
+    report.finish(False)
+    path = str(tmpdir.join('report.json'))
+    report.write_json(path)
+    data = json.loads(tmpdir.join('report.json').read())
+    assert data['success'] is False
+    assert data['stages'][0]['bytes_out'] == 10
+    assert data['stages'][0]['bytes_in'] is None
+
+
+def test_prometheus_textfile(tmpdir):
+    report = RunReport('backup')
+    with report.stage('upload', bytes_in=100) as stage:
+        stage.retries = 2
+    report.finish(True)
+    path = tmpdir.join('backup.prom')
+    report.write_prometheus(str(path))
+    lines = path.read().splitlines()
+    assert 'django_backup_last_run_success{command="backup"} 1.0' in lines
+    assert 'django_backup_stage_retries{command="backup",stage="upload"} 2.0' in lines
+    assert '# TYPE django_backup_stage_bytes_in gauge' in lines
+    # Unknown values are left out.
+    assert not [line for line in lines if line.startswith('django_backup_stage_bytes_out{')]
+    assert len(tmpdir.listdir()) == 1
+
+
+def test_path_size(tmpdir):
+    tmpdir.join('a').write('12345')
+    tmpdir.mkdir('sub').join('b').write('123')
+    assert path_size(str(tmpdir.join('a'))) == 5
+    assert path_size(str(tmpdir)) == 8
@@ -0,0 +1,73 @@
+from django_backup.mysql import BULK_FOOTER, BULK_HEADER, TableSplitter, defer_indexes
+
+
+DATA_DUMP = b'''-- MySQL dump 10.13
+/*!40014 SET @OLD_FOREIGN_KEY_CHECKS=@@FOREIGN_KEY_CHECKS, FOREIGN_KEY_CHECKS=0 */;
+
+--
+-- Dumping data for table `auth_group`
+--
+
+LOCK TABLES `auth_group` WRITE;
+INSERT INTO `auth_group` VALUES (1,'staff');
+UNLOCK TABLES;
+
+--
+-- Dumping data for table `auth_user`
+--
+
+LOCK TABLES `auth_user` WRITE;
+INSERT INTO `auth_user` VALUES (1,'admin'),(2,'test');
+UNLOCK TABLES;
+/*!40014 SET FOREIGN_KEY_CHECKS=@OLD_FOREIGN_KEY_CHECKS */;
+'''
+
+SCHEMA = u'''DROP TABLE IF EXISTS `auth_user_groups`;
+CREATE TABLE `auth_user_groups` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `user_id` int(11) NOT NULL,
+  `group_id` int(11) NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `user_id` (`user_id`,`group_id`),
+  KEY `auth_user_groups_0e939a4f` (`group_id`),
+  CONSTRAINT `auth_user_groups_group_id_fk` FOREIGN KEY (`group_id`) REFERENCES `auth_group` (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+CREATE TABLE `counter` (
+  `n` int(11) NOT NULL AUTO_INCREMENT,
+  KEY `n` (`n`)
+) ENGINE=InnoDB;
+'''
+
+
+def test_split_per_table(tmpdir):
+    splitter = TableSplitter(str(tmpdir))
+    # Feed it in pieces that cut lines and markers.
+    for i in range(0, len(DATA_DUMP), 7):
+        splitter.write(DATA_DUMP[i:i + 7])
+    splitter.close()
+    assert splitter.names == ['data_auth_group.sql', 'data_auth_user.sql']
+    group = tmpdir.join('data_auth_group.sql').read('rb')
+    user = tmpdir.join('data_auth_user.sql').read('rb')
+    for data in (group, user):
+        assert data.startswith(b'-- MySQL dump 10.13\n')
+        assert BULK_HEADER in data
+        assert data.endswith(BULK_FOOTER)
+    assert b"(1,'staff')" in group and b'auth_user`' not in group
+    assert b"(2,'test')" in user and b'auth_group`' not in user
+
+
+def test_defer_indexes():
+    schema, indexes, constraints = defer_indexes(SCHEMA)
+    assert 'KEY `auth_user_groups_0e939a4f`' not in schema
+    assert 'CONSTRAINT' not in schema
+    assert '  PRIMARY KEY (`id`)\n) ENGINE=InnoDB' in schema
+    assert indexes == {
+        'auth_user_groups': 'ALTER TABLE `auth_user_groups` ADD UNIQUE KEY `user_id` (`user_id`,`group_id`), '
+                            'ADD KEY `auth_user_groups_0e939a4f` (`group_id`);\n',
+    }
+    assert constraints == [
+        'ALTER TABLE `auth_user_groups` ADD CONSTRAINT `auth_user_groups_group_id_fk` '
+        'FOREIGN KEY (`group_id`) REFERENCES `auth_group` (`id`);\n',
+    ]
+    # The index of an AUTO_INCREMENT column can't wait.
+    assert 'KEY `n` (`n`)' in schema
@@ -0,0 +1,42 @@
+import hashlib
+
+from django_backup.repository import Chunker
+
+
+def chunk(data, average_size=4096):
+    chunker = Chunker(average_size)
+    chunks = []
+    for i in range(0, len(data), 1000):
+        chunks += chunker.process(data[i:i + 1000])
+    return chunks + chunker.finish()
+
+
+def make_dump(rows):
+    return ''.join(
+        "INSERT INTO foo VALUES (%d, '%s');\n" % (
+            i, hashlib.md5(str(i).encode('ascii')).hexdigest())
+        for i in rows
+    ).encode('ascii')
+
+
+def test_chunks_add_up_to_the_input():
+    data = make_dump(range(5000))
+    chunks = chunk(data)
+    assert b''.join(chunks) == data
+    assert all(len(c) <= 4 * 4096 for c in chunks)
+
+
+def test_insertion_only_changes_nearby_chunks():
+    """
+    Inserting a row at the start of a dump must not change every chunk
+    after it, like fixed-size chunking would.
+    """
+    before = chunk(make_dump(range(5000)))
+    after = chunk(make_dump([-1]) + make_dump(range(5000)))
+    assert len(set(after) - set(before)) <= 2
+
+
+def test_lines_longer_than_the_maximum_are_cut():
+    chunks = chunk(b'x' * 50000)
+    assert b''.join(chunks) == b'x' * 50000
+    assert max(len(c) for c in chunks) == 4 * 4096
@@ -1,7 +1,13 @@
 import datetime
-from django.core.management import call_command
+import os
+from tempfile import gettempdir
+
+import pytest
+from django.core.management import CommandError, call_command
 from django.contrib.auth.models import User
 
+from django_backup.management.commands.restore import Command
+
 
 def test_full_roundtrip(db, tmpdir, settings, sftpserver):
     """
@@ -47,3 +53,42 @@ def test_simple_restore(db, sftpserver, settings, tmpdir):
     with sftpserver.serve_content(server_fs):
         call_command('restore')
         User.objects.get(username='test')
+
+
+def test_streamed_restore(db, sftpserver, settings, tmpdir):
+    settings.BACKUP_LOCAL_DIRECTORY = str(tmpdir)
+    settings.RESTORE_FROM_FTP_DIRECTORY = '/backups'
+    settings.BACKUP_FTP_SERVER = '{}:{}'.format(
+        sftpserver.host, sftpserver.port)
+    settings.BACKUP_FTP_USERNAME = 'username'
+    settings.BACKUP_FTP_PASSWORD = 'password'
+    settings.BACKUP_FTP_DIRECTORY = '/backups'
+    server_fs = {'backups': {}}
+    backup_file_name = 'backup_{}.sql'.format(
+        datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    )
+    backup_data = '''INSERT INTO auth_user (id, username, first_name, last_name, email, password, is_staff, is_active, is_superuser, last_login, date_joined) VALUES (5, 'streamed', 'Tester', 'Test', 'test@test.com', 'pbkdf2_sha256$10000$Wgz0Lavtdp42$QKv6th80A30rfRTdoI5gXUV9sOGHf07i/FZiy3l25/g=', false, true, false, '2012-05-28 15:04:32.360306+02', '2012-05-28 15:04:06.835383+02');'''
+    server_fs['backups'][backup_file_name] = backup_data
+    with sftpserver.serve_content(server_fs):
+        call_command('restore', stream=True)
+        User.objects.get(username='streamed')
+    # Nothing was written to the temporary directory.
+    assert not os.path.exists(os.path.join(gettempdir(), backup_file_name))
+
+
+def test_bad_statement_fails_the_restore(db, settings, tmpdir):
+    settings.BACKUP_LOCAL_DIRECTORY = str(tmpdir)
+    dump = tmpdir.join('backup_20150617-010000.sql')
+    dump.write('SELECT 1;\nSELECT * FROM no_such_table;\nSELECT 2;\n')
+    command = Command()
+    command.tempdir = str(tmpdir)
+    with pytest.raises(CommandError) as error:
+        command.restore_file(str(dump))
+    assert 'no_such_table' in str(error.value)
+
+
+def test_failed_client_stops_the_restore(settings, tmpdir):
+    settings.BACKUP_LOCAL_DIRECTORY = str(tmpdir)
+    with pytest.raises(CommandError) as error:
+        Command().run_restore_command('echo access denied >&2; exit 1')
+    assert 'exit code 1: access denied' in str(error.value)
@@ -0,0 +1,77 @@
+from datetime import datetime
+
+import pytest
+from django.core.management import CommandError
+
+from django_backup.retention import RetentionPlan, parse_timestamp
+from django_backup.utils import db_backup_prefix, describe_backup, get_db_alias, group_by_alias, is_rsync_backup
+
+
+NOW = datetime(2015, 6, 17, 12, 30)
+
+
+def test_parse_timestamp():
+    assert parse_timestamp('backup_20150617-123000.sql.gz') == datetime(2015, 6, 17, 12, 30)
+
+
+def test_oldest_backup_of_every_interval_is_kept():
+    backups = [
+        'backup_20150616-010000.sql',
+        'backup_20150616-020000.sql',
+        'backup_20150617-010000.sql',
+        'backup_20150617-020000.sql',
+    ]
+    plan = RetentionPlan(backups, {'daily': 2}, now=NOW)
+    assert plan.keep == ['backup_20150616-010000.sql', 'backup_20150617-010000.sql']
+    assert plan.remove == ['backup_20150616-020000.sql', 'backup_20150617-020000.sql']
+    assert plan.reasons['backup_20150617-010000.sql'] == [('daily', 0)]
+
+
+def test_tiers():
+    backups = [
+        'backup_20120301-000000.sql',
+        'backup_20130301-000000.sql',
+        'backup_20140301-000000.sql',
+        'backup_20150301-000000.sql',
+        'backup_20150617-110000.sql',
+        'backup_20150617-121500.sql',
+    ]
+    plan = RetentionPlan(backups, {'yearly': 2, 'hourly': 1, 'monthly': 0}, now=NOW)
+    # 2015's backups are after the start of the year, the yearly tier covers
+    # the two 365 days intervals before it.
+    assert plan.keep == [
+        'backup_20130301-000000.sql',
+        'backup_20140301-000000.sql',
+        'backup_20150617-121500.sql',
+    ]
+
+
+def test_unknown_tier():
+    with pytest.raises(CommandError):
+        RetentionPlan([], {'fortnightly': 1})
+
+
+def test_describe():
+    backups = ['backup_20150616-010000.sql', 'backup_20150617-010000.sql']
+    plan = RetentionPlan(backups, {'daily': 1}, now=NOW)
+    assert plan.describe() == [
+        'remove backup_20150616-010000.sql',
+        'keep   backup_20150617-010000.sql (daily #1)',
+    ]
+
+
+def test_backups_of_every_database_are_kept_apart():
+    backups = [
+        'backup_20150616-010000.sql', 'backup_20150617-010000.sql',
+        'backup_audit_log_20150616-010000.sql', 'backup_audit_log_20150617-010000.sql.gz',
+    ]
+    assert [get_db_alias(backup) for backup in backups] == ['default', 'default', 'audit_log', 'audit_log']
+    assert get_db_alias(db_backup_prefix('audit_log') + '20150617-010000.sql') == 'audit_log'
+    assert group_by_alias(backups) == {'default': backups[:2], 'audit_log': backups[2:]}
+
+
+def test_rsync_backups_are_media_backups():
+    assert is_rsync_backup('dir_20150617-010000')
+    assert not is_rsync_backup('dir_20150617-010000.tar.gz')
+    assert not is_rsync_backup('backup_20150617-010000.sql')
+    assert describe_backup('dir_20150617-010000')['type'] == 'media'
@@ -0,0 +1,57 @@
+import json
+import os
+
+from django_backup.media import decide_remove_media, get_restore_chain
+from django_backup.shards import build_shards, extract_shard, get_manifest_name, is_shard, plan_shards, read_manifest
+
+
+def make_media(tmpdir):
+    media = tmpdir.mkdir('media')
+    for i in range(6):
+        media.join('dir%d' % (i % 2), 'file%d' % i).write(os.urandom(1000), mode='wb', ensure=True)
+    return media
+
+
+def test_plan_shards(tmpdir):
+    media = make_media(tmpdir)
+    shards = list(plan_shards([str(media)], 2500))
+    assert [len(shard) for shard in shards] == [4, 2, 2]
+    assert shards[0][0] == (str(media.join('dir0')), 'dir0')
+    # Directories take no room; a file larger than the maximum gets a shard of its own.
+    assert len(list(plan_shards([str(media)], 10))) == 7
+
+
+def test_build_and_extract_shards(tmpdir):
+    media = make_media(tmpdir)
+    prefix = str(tmpdir.join('dir_20150617-010000'))
+    outfiles = build_shards([str(media)], prefix, 2500, processes=2)
+    assert [os.path.basename(outfile) for outfile in outfiles] == [
+        'dir_20150617-010000.shard-0001.tar.gz',
+        'dir_20150617-010000.shard-0002.tar.gz',
+        'dir_20150617-010000.shard-0003.tar.gz',
+        'dir_20150617-010000.shards.json',
+    ]
+    shards = read_manifest(outfiles[-1])
+    assert all(is_shard(outfile) for outfile in outfiles[:-1])
+    assert get_manifest_name(outfiles[0]) == outfiles[-1]
+
+    target = tmpdir.mkdir('target')
+    for outfile, shard in zip(outfiles, shards):
+        assert extract_shard((outfile, shard, str(target))) is None
+    for i in range(6):
+        path = os.path.join('dir%d' % (i % 2), 'file%d' % i)
+        assert target.join(path).read_binary() == media.join(path).read_binary()
+
+    tmpdir.join(shards[0]['name']).write('broken')
+    assert 'does not match' in extract_shard((outfiles[0], shards[0], str(target)))
+
+
+def test_shards_follow_their_manifest():
+    backups = [
+        'dir_20150616-010000.shard-0001.tar.gz',
+        'dir_20150616-010000.shard-0002.tar.gz',
+        'dir_20150616-010000.shards.json',
+        'dir_20150617-010000.tar.gz',
+    ]
+    assert get_restore_chain(backups[:3]) == ['dir_20150616-010000.shards.json']
+    assert decide_remove_media(backups, {}) == backups
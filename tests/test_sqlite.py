@@ -0,0 +1,51 @@
+import sqlite3
+
+from django_backup.sqlite import _copy_statements, copy_database
+
+
+def make_database(path):
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE item (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT)')
+    db.execute('CREATE INDEX item_name ON item (name)')
+    db.executemany('INSERT INTO item (name) VALUES (?)', [('item %s' % i,) for i in range(1000)])
+    db.commit()
+    db.close()
+
+
+def read_items(path):
+    db = sqlite3.connect(path)
+    try:
+        return db.execute('SELECT id, name FROM item ORDER BY id').fetchall()
+    finally:
+        db.close()
+
+
+def test_copy_database(tmpdir):
+    source = str(tmpdir.join('source.sqlite3'))
+    target = str(tmpdir.join('target.sqlite3'))
+    make_database(source)
+    db = sqlite3.connect(target)
+    db.execute('CREATE TABLE old (id INTEGER)')
+    db.commit()
+    db.close()
+
+    assert copy_database(source, target, pages=2, pause=0) == 0
+    assert read_items(target) == read_items(source)
+    db = sqlite3.connect(target)
+    assert [name for name, in db.execute('SELECT name FROM sqlite_master ORDER BY name')] == [
+        'item', 'item_name', 'sqlite_sequence',
+    ]
+    db.close()
+
+
+def test_copy_statements(tmpdir):
+    # The copy of Pythons without the backup API.
+    source = str(tmpdir.join('source.sqlite3'))
+    target = str(tmpdir.join('target.sqlite3'))
+    make_database(source)
+    make_database(target)
+    _copy_statements(sqlite3.connect(source, isolation_level=None), sqlite3.connect(target, isolation_level=None))
+    assert read_items(target) == read_items(source)
+    db = sqlite3.connect(target)
+    assert db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'item'").fetchone() == (1000,)
+    db.close()
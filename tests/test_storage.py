@@ -0,0 +1,35 @@
+import tarfile
+
+from django.core.files.storage import FileSystemStorage
+
+from django_backup.storage import archive_storage, extract_to_storage, walk
+
+
+def make_storage(tmpdir, files):
+    for name, data in files.items():
+        tmpdir.join(name).write(data, mode='wb', ensure=True)
+    return FileSystemStorage(location=str(tmpdir), base_url='/media/')
+
+
+def test_walk_lists_every_file(tmpdir):
+    storage = make_storage(tmpdir, {'a.txt': b'a', 'photos/b.jpg': b'b', 'photos/2015/c.jpg': b'c'})
+    assert sorted(walk(storage)) == ['a.txt', 'photos/2015/c.jpg', 'photos/b.jpg']
+
+
+def test_archive_and_extract(tmpdir):
+    files = {'a.txt': b'a' * 10, 'photos/big.jpg': b'b' * 5000, 'photos/2015/c.jpg': b'c' * 100}
+    source = make_storage(tmpdir.mkdir('source'), files)
+    tmpdir.mkdir('local').join('local.txt').write('local')
+    outfile = str(tmpdir.join('dir.tar.gz'))
+
+    # Files larger than the memory limit are streamed.
+    archived = archive_storage(source, outfile, [str(tmpdir.join('local'))], threads=2, memory_limit=1000)
+    assert archived == sum(len(data) for data in files.values())
+    with tarfile.open(outfile) as archive:
+        assert sorted(archive.getnames()) == ['a.txt', 'local.txt', 'photos/2015/c.jpg', 'photos/big.jpg']
+
+    target = make_storage(tmpdir.mkdir('target'), {'a.txt': b'old'})
+    extract_to_storage(outfile, target, threads=2, memory_limit=1000)
+    for name, data in files.items():
+        assert target.open(name).read() == data
+    assert sorted(target.listdir('')[1]) == ['a.txt', 'local.txt']
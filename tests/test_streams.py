@@ -0,0 +1,55 @@
+import gzip
+import io
+
+from django_backup.streams import (
+    CompressStage,
+    DecompressStage,
+    DetectDecompressStage,
+    detect_codec,
+    get_codec,
+    pump,
+)
+
+
+def compress(data, codec_name, **kwargs):
+    out = io.BytesIO()
+    stage = CompressStage(get_codec(codec_name), **kwargs)
+    pump(io.BytesIO(data), out, [stage], buffer_size=1000)
+    return out.getvalue()
+
+
+def test_block_compression_is_a_standard_stream():
+    """
+    Every block is a gzip member of its own, which the gzip module reads
+    back as one stream.
+    """
+    data = b'INSERT INTO foo VALUES (1);\n' * 10000
+    compressed = compress(data, 'gzip', threads=4, block_size=4096)
+    assert gzip.GzipFile(fileobj=io.BytesIO(compressed)).read() == data
+
+
+def test_compression_roundtrip_with_detected_codec():
+    data = b'INSERT INTO foo VALUES (1);\n' * 10000
+    compressed = compress(data, 'gzip', threads=2, block_size=5000)
+    codec = detect_codec(compressed[:8])
+    assert codec.name == 'gzip'
+    out = io.BytesIO()
+    pump(io.BytesIO(compressed), out, [DecompressStage(codec)], buffer_size=333)
+    assert out.getvalue() == data
+
+
+def test_empty_input_is_still_valid():
+    compressed = compress(b'', 'gzip')
+    assert gzip.GzipFile(fileobj=io.BytesIO(compressed)).read() == b''
+
+
+def test_detect_uncompressed():
+    assert detect_codec(b'-- SQL d') is None
+
+
+def test_detect_decompress_stage():
+    data = b'INSERT INTO foo VALUES (1);\n' * 10000
+    for payload in (compress(data, 'gzip', block_size=4096), data, b'abc'):
+        out = io.BytesIO()
+        pump(io.BytesIO(payload), out, [DetectDecompressStage()], buffer_size=3)
+        assert out.getvalue() == (data if payload != b'abc' else b'abc')
@@ -0,0 +1,53 @@
+import os
+
+from django_backup.tablecache import TableCache
+
+
+def dump(workdir, tables):
+    names = {}
+    for table in tables:
+        names[table] = 'data_%s.sql' % table
+        with open(os.path.join(workdir, names[table]), 'w') as f:
+            f.write('INSERT INTO %s VALUES (1);\n' % table)
+    return names
+
+
+def test_unchanged_tables_are_reused(tmpdir):
+    path = str(tmpdir.join('cache'))
+    first, second = tmpdir.mkdir('first'), tmpdir.mkdir('second')
+    cache = TableCache(path)
+    assert cache.unchanged({'a': ['t1'], 'b': ['t1'], 'c': None}) == []
+    cache.update(str(first), dump(str(first), ['a', 'b', 'c']))
+
+    cache = TableCache(path)
+    # c has no signature and is dumped every time.
+    unchanged = cache.unchanged({'a': ['t1'], 'b': ['t2'], 'c': None})
+    assert unchanged == ['a']
+    assert cache.copy(unchanged, str(second)) == ['data_a.sql']
+    assert second.join('data_a.sql').read() == 'INSERT INTO a VALUES (1);\n'
+
+    names = dump(str(second), ['b', 'c'])
+    names['a'] = 'data_a.sql'
+    cache.update(str(second), names)
+    assert TableCache(path).unchanged({'a': ['t1'], 'b': ['t2'], 'c': None}) == ['a', 'b']
+
+
+def test_tables_left_out_stay_cached(tmpdir):
+    path = str(tmpdir.join('cache'))
+    workdir = str(tmpdir.mkdir('work'))
+    cache = TableCache(path)
+    cache.unchanged({'a': ['t1'], 'b': ['t1']})
+    cache.update(workdir, dump(workdir, ['a', 'b']))
+
+    # A backup of some applications only dumps a.
+    cache = TableCache(path)
+    cache.unchanged({'a': ['t2']})
+    cache.update(workdir, {'a': 'data_a.sql'})
+    assert TableCache(path).unchanged({'a': ['t2'], 'b': ['t1']}) == ['a', 'b']
+
+    # a has no file this time and leaves the cache.
+    cache = TableCache(path)
+    cache.unchanged({'a': ['t3']})
+    cache.update(str(tmpdir.mkdir('empty')), {'a': 'data_a.sql'})
+    assert not os.path.exists(os.path.join(path, 'data_a.sql'))
+    assert TableCache(path).unchanged({'a': ['t3'], 'b': ['t1']}) == ['b']
@@ -0,0 +1,85 @@
+import threading
+import time
+
+import pytest
+
+from django_backup.media import MediaIndex
+from django_backup.tasks import TaskGraph
+
+
+def test_tasks_run_after_their_dependencies():
+    finished = []
+
+    def task(name, seconds=0):
+        def run():
+            time.sleep(seconds)
+            finished.append(name)
+            return name.upper()
+        return run
+
+    graph = TaskGraph(threads=4)
+    graph.add('clean', task('clean', 0.1))
+    graph.add('dump', task('dump', 0.2))
+    graph.add('media', task('media'))
+    graph.add('upload', task('upload'), after=['clean', 'dump'])
+    assert graph.run() == {'clean': 'CLEAN', 'dump': 'DUMP', 'media': 'MEDIA', 'upload': 'UPLOAD'}
+    assert finished == ['media', 'clean', 'dump', 'upload']
+
+
+def test_groups_are_limited():
+    lock = threading.Lock()
+    running, most = [0], [0]
+
+    def upload():
+        with lock:
+            running[0] += 1
+            most[0] = max(most[0], running[0])
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+
+    graph = TaskGraph(threads=4, limits={'upload': 1})
+    for i in range(4):
+        graph.add('upload:%s' % i, upload, group='upload')
+    graph.run()
+    assert most[0] == 1
+
+
+def test_failure_stops_new_tasks():
+    started = []
+
+    def fail():
+        raise IOError('disk full')
+
+    graph = TaskGraph(threads=1)
+    graph.add('dump', fail)
+    graph.add('media', lambda: started.append('media'))
+    graph.add('upload', lambda: started.append('upload'), after=['dump'])
+    with pytest.raises(IOError):
+        graph.run()
+    assert started == []
+
+
+def test_unknown_dependency():
+    graph = TaskGraph()
+    with pytest.raises(ValueError):
+        graph.add('upload', lambda: None, after=['dump'])
+
+
+def test_media_index_is_committed_by_a_later_task(tmpdir):
+    media = tmpdir.mkdir('media')
+    media.join('a.txt').write('a')
+    path = str(tmpdir.join('index.sqlite3'))
+    index = []
+
+    def archive():
+        index.append(MediaIndex(path))
+        return index[0].scan([str(media)])
+
+    graph = TaskGraph(threads=2)
+    graph.add('media', archive)
+    graph.add('upload:media', lambda: None, after=['media'])
+    graph.add('media_index', lambda: index[0].commit(), after=['media', 'upload:media'])
+    graph.run()
+    index[0].close()
+    assert not MediaIndex(path).is_empty()
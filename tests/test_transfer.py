@@ -0,0 +1,137 @@
+import hashlib
+import io
+import os
+import threading
+
+import pytest
+
+from django_backup import transfer
+from django_backup.pool import ConnectionPool
+from django_backup.transfer import OrderedDigest, ParallelTransfer
+
+
+class LocalFile(io.FileIO):
+
+    def set_pipelined(self, pipelined):
+        pass
+
+    def readv(self, chunks):
+        for offset, length in chunks:
+            self.seek(offset)
+            yield self.read(length)
+
+
+class FlakyFile(LocalFile):
+    failures = 1
+
+    def readv(self, chunks):
+        if chunks[0][0] and FlakyFile.failures:
+            FlakyFile.failures -= 1
+            raise EOFError('Connection lost')
+        return super(FlakyFile, self).readv(chunks)
+
+
+class BrokenFile(LocalFile):
+
+    def write(self, data):
+        raise EOFError('Connection lost')
+
+
+class LocalConnection(object):
+    """
+    Stands in for a pysftp connection, on the local filesystem.
+    """
+    file_class = LocalFile
+
+    def open(self, path, mode):
+        return self.file_class(path, {'rb': 'r', 'wb': 'w', 'r+b': 'r+'}[mode])
+
+    def stat(self, path):
+        return os.stat(path)
+
+    def remove(self, path):
+        os.remove(path)
+
+    def rename(self, old_path, new_path):
+        os.rename(old_path, new_path)
+
+    def close(self):
+        pass
+
+
+def test_ranges():
+    parallel = ParallelTransfer(None, None, chunk_size=10)
+    assert parallel.ranges(25) == [(0, 10), (10, 10), (20, 5)]
+    assert parallel.ranges(20) == [(0, 10), (10, 10)]
+    assert parallel.ranges(0) == [(0, 0)]
+
+
+def test_put_and_get_roundtrip(tmpdir):
+    data = os.urandom(100000)
+    tmpdir.join('backup').write(data, 'wb')
+    tmpdir.join('remote').mkdir()
+    tmpdir.join('remote', 'backup').write(b'stale', 'wb')
+    parallel = ParallelTransfer(LocalConnection(), ConnectionPool(LocalConnection, 3), chunk_size=7000)
+    parallel.put([(str(tmpdir.join('backup')), str(tmpdir.join('remote', 'backup')))])
+    parallel.get([(str(tmpdir.join('remote', 'backup')), str(tmpdir.join('restored')))])
+    assert tmpdir.join('remote', 'backup').read('rb') == data
+    assert tmpdir.join('restored').read('rb') == data
+    assert tmpdir.join('remote').listdir() == [tmpdir.join('remote', 'backup')]
+
+
+def test_put_hashes_what_it_reads(tmpdir):
+    data = os.urandom(100000)
+    tmpdir.join('backup').write(data, 'wb')
+    tmpdir.join('remote').mkdir()
+    parallel = ParallelTransfer(LocalConnection(), ConnectionPool(LocalConnection, 3), chunk_size=7000)
+    hashes = parallel.put([(str(tmpdir.join('backup')), str(tmpdir.join('remote', 'backup')))], checksum=True)
+    assert hashes == {str(tmpdir.join('backup')): hashlib.sha256(data).hexdigest()}
+
+
+def test_digest_holds_pieces_until_their_turn():
+    digest = OrderedDigest(buffer_size=1)
+    # The second range doesn't fit in the buffer and waits for the first one.
+    ahead = threading.Thread(target=digest.update, args=(3, b'de'))
+    ahead.start()
+    digest.update(0, b'ab')
+    digest.update(2, b'c')
+    ahead.join()
+    # A retried range is only hashed once.
+    digest.update(0, b'ab')
+    assert digest.hexdigest() == hashlib.sha256(b'abcde').hexdigest()
+    digest.abandon()
+    assert digest.hexdigest() is None
+
+
+def test_failed_range_is_retried(tmpdir, monkeypatch):
+    monkeypatch.setattr(transfer.time, 'sleep', lambda seconds: None)
+    monkeypatch.setattr(LocalConnection, 'file_class', FlakyFile)
+    data = os.urandom(100000)
+    tmpdir.join('backup').write(data, 'wb')
+    parallel = ParallelTransfer(LocalConnection(), ConnectionPool(LocalConnection, 2), chunk_size=7000)
+    parallel.get([(str(tmpdir.join('backup')), str(tmpdir.join('restored')))])
+    assert FlakyFile.failures == 0
+    assert tmpdir.join('restored').read('rb') == data
+
+
+def test_failed_put_removes_partial_files(tmpdir, monkeypatch):
+    monkeypatch.setattr(LocalConnection, 'file_class', BrokenFile)
+    tmpdir.join('backup').write(os.urandom(10000), 'wb')
+    tmpdir.join('remote').mkdir()
+    parallel = ParallelTransfer(LocalConnection(), ConnectionPool(LocalConnection, 2), chunk_size=7000, retries=0)
+    with pytest.raises(EOFError):
+        parallel.put([(str(tmpdir.join('backup')), str(tmpdir.join('remote', 'backup')))])
+    assert tmpdir.join('remote').listdir() == []
+
+
+def test_pool_replaces_broken_connections():
+    pool = ConnectionPool(LocalConnection, 2)
+    with pool.connection() as first:
+        pass
+    with pool.connection() as connection:
+        assert connection is first
+    with pytest.raises(EOFError):
+        with pool.connection() as connection:
+            raise EOFError('Connection lost')
+    with pool.connection() as connection:
+        assert connection is not first